@@ -0,0 +1,66 @@
+"""
+Compares the thread-based SmsActivateWrapper with the native async SmsActivateClient
+against the local fake provider.
+
+    python -m bench.bench_api --requests 2000 --concurrency 100 --latency 0.02
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import time
+
+os.environ.setdefault('SMS_ACTIVATE_API_KEY', 'bench')
+
+from bench.fake_sms_activate import FakeSmsActivate, start_fake_server
+from bot.api import SmsActivateClient, SmsActivateWrapper
+
+
+async def run_load(call, total: int, concurrency: int) -> dict:
+    latencies = []
+    queue = asyncio.Queue()
+    for i in range(total):
+        queue.put_nowait(i)
+
+    async def worker():
+        while not queue.empty():
+            queue.get_nowait()
+            started = time.perf_counter()
+            await call()
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        'requests': total,
+        'seconds': round(elapsed, 3),
+        'rps': round(total / elapsed, 1),
+        'p50_ms': round(statistics.median(latencies) * 1000, 2),
+        'p95_ms': round(latencies[int(len(latencies) * 0.95) - 1] * 1000, 2),
+    }
+
+
+async def main(args):
+    fake = FakeSmsActivate(latency=args.latency)
+    runner, url = await start_fake_server(fake)
+    try:
+        wrapper = SmsActivateWrapper('bench')
+        wrapper.sa._SMSActivateAPI__api_url = url
+        client = SmsActivateClient('bench', api_url=url, max_concurrency=args.concurrency)
+
+        for name, api in (('wrapper', wrapper), ('client', client)):
+            result = await run_load(lambda: api.get_status(100000), args.requests, args.concurrency)
+            print(f"{name:8} {result}")
+        await client.close()
+    finally:
+        await runner.cleanup()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=100)
+    parser.add_argument('--latency', type=float, default=0.02)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,302 @@
+"""
+End-to-end load test of the whole bot, fully offline.
+
+Starts the fake SMS-Activate and fake Telegram Bot API servers, wires the bot
+against them (with a throwaway database) and runs scripted virtual users:
+/start -> browse countries -> open a country -> search a service -> buy -> wait for the SMS.
+Updates are fed straight into the dispatcher, so the numbers cover handler,
+database and upstream time but not update ingestion (see fake_telegram_sender for that).
+
+    python -m bench.bench_e2e --users 200 --concurrency 50 --output run.json
+    python -m bench.bench_e2e --users 200 --baseline run.json --max-regression 0.2
+
+Run it from the project root so the menu images are found.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+os.environ.setdefault('SMS_ACTIVATE_API_KEY', 'bench')
+os.environ.setdefault('BOT_TOKEN', '123456:bench')
+os.environ.setdefault('ADMIN_ID', '1')
+
+from aiogram import Bot, Dispatcher, types
+from aiogram.bot.api import TelegramAPIServer
+from bench.fake_sms_activate import FakeSmsActivate, start_fake_server as start_fake_sms_activate
+from bench.fake_telegram_api import FakeTelegramAPI, start_fake_server as start_fake_telegram
+from bench.fake_telegram_sender import message_update, callback_update
+from bot import callbacks, scheduler as scheduler_module
+from bot.api import SmsActivateClient
+from bot.broadcast import Broadcaster
+from bot.catalog import Catalog
+from bot.db import Database
+from bot.media import preload_media
+from bot.metrics import MetricsMiddleware
+from bot.outbox import Outbox
+from bot.router import ProviderRouter
+from bot.scheduler import ActivationScheduler
+from bot.sender import sender
+from bot.handlers.start import register_start_handlers
+from bot.handlers.balance import register_balance_handlers
+from bot.handlers.buy_number import register_buy_handlers
+from bot.handlers.history import register_history_handlers
+from bot.handlers.billing import register_billing_handlers
+from bot.handlers.admin import register_admin_handlers
+from bot.handlers.search import register_search_handlers
+from config import IMAGE_MAIN_MENU, IMAGE_PROFILE, IMAGE_COUNTRIES, IMAGE_SERVICES
+
+# Balance every virtual user starts with (in kopecks).
+START_BALANCE = 100_000
+SEARCH_QUERIES = ["телега", "telegram", "ватсап", "whatsapp", "вк", "gmail"]
+# Metrics compared against a baseline; a higher value is worse unless listed in HIGHER_IS_BETTER.
+HIGHER_IS_BETTER = {'steps_per_second', 'purchases', 'sms_delivered'}
+
+
+def percentiles(values) -> dict:
+    if not values:
+        return {'count': 0}
+    values = sorted(values)
+    pick = lambda q: values[min(len(values) - 1, int(len(values) * q))]
+    return {
+        'count': len(values),
+        'p50_ms': round(pick(0.5) * 1000, 2),
+        'p95_ms': round(pick(0.95) * 1000, 2),
+        'p99_ms': round(pick(0.99) * 1000, 2),
+        'max_ms': round(values[-1] * 1000, 2),
+    }
+
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes elsewhere
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+class BenchBot:
+    """The bot wired the same way as in main.py, against the fake servers and a temporary database."""
+    def __init__(self, sms_url: str, telegram_url: str, db_path: str):
+        self.bot = Bot(token=os.environ['BOT_TOKEN'], parse_mode=types.ParseMode.MARKDOWN,
+                       server=TelegramAPIServer.from_base(telegram_url))
+        self.dp = Dispatcher(self.bot)
+        self.db = Database(db_path)
+        self.api = SmsActivateClient('bench', api_url=sms_url)
+        self.catalog = Catalog(self.api, self.db)
+        self.router = ProviderRouter([self.api])
+        self.outbox = Outbox(self.router, self.bot, self.db)
+        self.scheduler = ActivationScheduler(self.router, self.db, self.outbox)
+        broadcaster = Broadcaster(self.bot, self.db, int(os.environ['ADMIN_ID']))
+
+        self.dp.middleware.setup(MetricsMiddleware())
+        register_start_handlers(self.dp, self.db)
+        register_balance_handlers(self.dp, self.db, self.api)
+        register_buy_handlers(self.dp, self.db, self.router, self.catalog, self.scheduler)
+        register_history_handlers(self.dp, self.db)
+        register_billing_handlers(self.dp)
+        register_admin_handlers(self.dp, self.db, self.catalog, broadcaster, self.router)
+        register_search_handlers(self.dp, self.catalog)
+
+    async def start(self):
+        Bot.set_current(self.bot)
+        Dispatcher.set_current(self.dp)
+        sender.start()
+        await self.catalog.load()
+        self.outbox.start()
+        self.scheduler.start()
+        await preload_media(self.bot, self.db, int(os.environ['ADMIN_ID']),
+                            [IMAGE_MAIN_MENU, IMAGE_PROFILE, IMAGE_COUNTRIES, IMAGE_SERVICES])
+
+    async def stop(self):
+        await self.scheduler.stop()
+        await self.outbox.stop()
+        await self.catalog.stop()
+        await sender.stop()
+        await self.api.close()
+        await self.db.close()
+        await (await self.bot.get_session()).close()
+
+
+class LoadTest:
+    def __init__(self, args, bench: BenchBot, telegram: FakeTelegramAPI, country_ids: list):
+        self.args = args
+        self.bench = bench
+        self.random = random.Random(args.seed)
+        self.country_ids = country_ids
+        self.step_latencies = {}
+        self.sms_latencies = []
+        self.errors = 0
+        self.purchases = 0
+        self.sms_missing = 0
+        self._sms_waiters = {}
+        telegram.add_listener(self._on_telegram_call)
+
+    def _on_telegram_call(self, method: str, params: dict):
+        if method == 'sendMessage' and "Получено СМС" in params.get('text', ''):
+            waiter = self._sms_waiters.pop(int(params['chat_id']), None)
+            if waiter is not None and not waiter.done():
+                waiter.set_result(time.perf_counter())
+
+    async def _step(self, name: str, update: dict):
+        started = time.perf_counter()
+        try:
+            await self.bench.dp.process_update(types.Update(**update))
+        except Exception as e:
+            self.errors += 1
+            logging.error(f"Шаг {name} завершился ошибкой: {e}")
+        self.step_latencies.setdefault(name, []).append(time.perf_counter() - started)
+        if self.args.think:
+            await asyncio.sleep(self.random.uniform(0, self.args.think))
+
+    async def virtual_user(self, user_id: int):
+        country_id = self.random.choice(self.country_ids)
+        await self._step('start', message_update(user_id, "/start"))
+
+        started = time.perf_counter()
+        await self.bench.db.create_transaction(user_id, START_BALANCE, 'deposit', "bench")
+        self.step_latencies.setdefault('credit', []).append(time.perf_counter() - started)
+
+        await self._step('browse_countries', callback_update(user_id, callbacks.BUY_MENU.new()))
+        await self._step('countries_page', callback_update(user_id, callbacks.BUY_COUNTRY_PAGE.new(1)))
+        await self._step('show_services', callback_update(user_id, callbacks.BUY_COUNTRY.new(country_id)))
+        await self._step('search_prompt', callback_update(user_id, callbacks.SEARCH_SERVICE.new(country_id)))
+        await self._step('search', message_update(user_id, self.random.choice(SEARCH_QUERIES)))
+
+        waiter = self._sms_waiters[user_id] = asyncio.get_running_loop().create_future()
+        bought_at = time.perf_counter()
+        await self._step('purchase', callback_update(user_id, callbacks.BUY_SERVICE.new('tg', country_id)))
+        self.purchases += 1
+        try:
+            delivered_at = await asyncio.wait_for(waiter, timeout=self.args.sms_timeout)
+            self.sms_latencies.append(delivered_at - bought_at)
+        except asyncio.TimeoutError:
+            self._sms_waiters.pop(user_id, None)
+            self.sms_missing += 1
+
+    async def run(self) -> float:
+        semaphore = asyncio.Semaphore(self.args.concurrency)
+
+        async def limited(user_id):
+            async with semaphore:
+                await self.virtual_user(user_id)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(limited(10_000 + i) for i in range(self.args.users)))
+        return time.perf_counter() - started
+
+
+async def run(args) -> dict:
+    logging.basicConfig(level=logging.WARNING)
+    if args.poll_interval:
+        scheduler_module.POLL_SCHEDULE = ((None, args.poll_interval),)
+    if not args.telegram_limits:
+        sender.set_rate_limits(global_rate=1e9, chat_rate=1e9, global_burst=1e9, chat_burst=1e9)
+
+    fake_sms = FakeSmsActivate(latency=args.sms_latency, jitter=args.sms_jitter, error_rate=args.error_rate,
+                               sms_delay=tuple(args.sms_delay), sms_distribution=args.sms_distribution,
+                               no_sms_rate=args.no_sms_rate, extra_countries=args.extra_countries, seed=args.seed)
+    fake_telegram = FakeTelegramAPI(latency=args.telegram_latency, keep_log=False, seed=args.seed)
+    sms_runner, sms_url = await start_fake_sms_activate(fake_sms)
+    telegram_runner, telegram_url = await start_fake_telegram(fake_telegram)
+    workdir = tempfile.mkdtemp(prefix='uni-sms-bench-')
+    bench = BenchBot(sms_url, telegram_url, os.path.join(workdir, 'bench.db'))
+    try:
+        await bench.start()
+        load = LoadTest(args, bench, fake_telegram, list(fake_sms.countries))
+        duration = await load.run()
+        steps = sum(len(v) for v in load.step_latencies.values())
+        return {
+            'config': vars(args),
+            'users': args.users,
+            'duration_s': round(duration, 3),
+            'steps_per_second': round(steps / duration, 1),
+            'errors': load.errors,
+            'purchases': load.purchases,
+            'sms_delivered': len(load.sms_latencies),
+            'sms_missing': load.sms_missing,
+            'steps': {name: percentiles(values) for name, values in load.step_latencies.items()},
+            'sms_delivery': percentiles(load.sms_latencies),
+            'upstream_calls': {'sms_activate': dict(fake_sms.calls), 'telegram': dict(fake_telegram.calls)},
+            'catalog': bench.catalog.get_stats(),
+            'sender': sender.get_stats(),
+            'peak_rss_mb': peak_rss_mb(),
+        }
+    finally:
+        await bench.stop()
+        await sms_runner.cleanup()
+        await telegram_runner.cleanup()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def compare(report: dict, baseline: dict, max_regression: float) -> list:
+    """Returns (metric, baseline, current, change, regressed) rows for the comparable metrics."""
+    pairs = [(key, baseline.get(key), report.get(key)) for key in ('steps_per_second', 'sms_delivered')]
+    for step, stats in report['steps'].items():
+        for key in ('p50_ms', 'p95_ms'):
+            pairs.append((f"{step}.{key}", baseline.get('steps', {}).get(step, {}).get(key), stats.get(key)))
+    pairs.append(('peak_rss_mb', baseline.get('peak_rss_mb'), report.get('peak_rss_mb')))
+
+    rows = []
+    for metric, old, new in pairs:
+        if not old or new is None:
+            continue
+        change = (new - old) / old
+        worse = -change if metric in HIGHER_IS_BETTER else change
+        rows.append((metric, old, new, change, worse > max_regression))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=50, help="virtual users active at the same time")
+    parser.add_argument('--think', type=float, default=0.0, help="max random pause between steps, in seconds")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--sms-latency', type=float, default=0.02)
+    parser.add_argument('--sms-jitter', type=float, default=0.01)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--sms-delay', type=float, nargs=2, default=(1, 5), metavar=('MIN', 'MAX'))
+    parser.add_argument('--sms-distribution', choices=('uniform', 'exponential'), default='uniform')
+    parser.add_argument('--no-sms-rate', type=float, default=0.0)
+    parser.add_argument('--sms-timeout', type=float, default=30.0)
+    parser.add_argument('--extra-countries', type=int, default=0)
+    parser.add_argument('--telegram-latency', type=float, default=0.01)
+    parser.add_argument('--telegram-limits', action='store_true',
+                        help="keep the sender's Telegram rate limits (off by default to measure the bot itself)")
+    parser.add_argument('--poll-interval', type=float, default=1.0,
+                        help="activation polling interval in seconds; 0 keeps the production schedule")
+    parser.add_argument('--output', help="write the JSON report to this file")
+    parser.add_argument('--baseline', help="compare against a previous JSON report")
+    parser.add_argument('--max-regression', type=float, default=0.2,
+                        help="fail if a compared metric is worse than the baseline by more than this share")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressed = False
+        print(f"\n{'metric':32} {'baseline':>10} {'current':>10} {'change':>8}")
+        for metric, old, new, change, worse in compare(report, baseline, args.max_regression):
+            regressed |= worse
+            print(f"{metric:32} {old:>10} {new:>10} {change:>+8.1%}{'  REGRESSION' if worse else ''}")
+        if regressed:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
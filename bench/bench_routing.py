@@ -0,0 +1,111 @@
+"""
+Compares purchase routing policies on simulated providers, in virtual time.
+
+Three fake providers differ per route: each is the fastest somewhere, one runs
+out of numbers on a popular route and one is unreliable. Every policy sees the
+same stream of purchases; a finished activation is reported back to the router
+when its SMS arrives (or when the wait times out), as the scheduler does.
+
+    python -m bench.bench_routing --purchases 5000 --rate 1
+"""
+import argparse
+import asyncio
+import heapq
+import os
+import random
+
+os.environ.setdefault('SMS_ACTIVATE_API_KEY', 'bench')
+
+from bench.fake_providers import FakeProvider, RouteProfile
+from bot.router import ProviderRouter
+from bot.scheduler import ACTIVATION_TIMEOUT
+
+ROUTES = [(0, 'tg'), (0, 'wa'), (6, 'tg'), (187, 'go')]
+
+
+class VirtualClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class FixedOrderRouter(ProviderRouter):
+    """Always tries the providers in the configured order (the single-provider setup, plus failover)."""
+    def rank(self, country, service: str) -> list:
+        return list(self.providers)
+
+
+class RandomRouter(ProviderRouter):
+    def rank(self, country, service: str) -> list:
+        names = list(self.providers)
+        self.random.shuffle(names)
+        return names
+
+
+def make_providers(clock, seed: int) -> list:
+    return [
+        FakeProvider('alpha', RouteProfile(success_rate=0.9, delay=(20, 120)), {
+            (0, 'tg'): RouteProfile(stock=0.3, success_rate=0.95, delay=(5, 20)),
+        }, seed=seed, clock=clock),
+        FakeProvider('beta', RouteProfile(success_rate=0.85, delay=(30, 90)), {
+            (0, 'wa'): RouteProfile(success_rate=0.95, delay=(5, 15)),
+            (6, 'tg'): RouteProfile(success_rate=0.95, delay=(10, 30)),
+        }, seed=seed + 1, clock=clock),
+        FakeProvider('gamma', RouteProfile(success_rate=0.5, delay=(60, 300)), {
+            (187, 'go'): RouteProfile(success_rate=0.98, delay=(5, 10)),
+        }, error_rate=0.05, seed=seed + 2, clock=clock),
+    ]
+
+
+async def simulate(router_class, args) -> dict:
+    clock = VirtualClock()
+    providers = make_providers(clock, args.seed)
+    router = router_class(providers, clock=clock, seed=args.seed)
+    rnd = random.Random(args.seed)
+
+    finishing = []
+    waits, delivered, no_number = [], 0, 0
+    for i in range(args.purchases):
+        clock.now += rnd.expovariate(args.rate)
+        while finishing and finishing[0][0] <= clock.now:
+            _, _, provider, country, service, time_to_sms = heapq.heappop(finishing)
+            router.record_result(provider, country, service, time_to_sms)
+
+        country, service = rnd.choice(ROUTES)
+        response = await router.get_number(service, country)
+        if 'activation_id' not in response:
+            no_number += 1
+            continue
+        time_to_sms = router.provider(response['provider']).time_to_sms(response['activation_id'])
+        if time_to_sms is not None and time_to_sms > ACTIVATION_TIMEOUT:
+            time_to_sms = None
+        if time_to_sms is not None:
+            delivered += 1
+        waits.append(time_to_sms if time_to_sms is not None else ACTIVATION_TIMEOUT)
+        heapq.heappush(finishing, (clock.now + waits[-1], i, response['provider'], country, service, time_to_sms))
+
+    waits.sort()
+    return {
+        'delivered': f"{delivered / args.purchases:.1%}",
+        'no_number': no_number,
+        'mean_wait_s': round(sum(waits) / len(waits), 1) if waits else None,
+        'p95_wait_s': round(waits[min(len(waits) - 1, int(len(waits) * 0.95))], 1) if waits else None,
+        # Total time users spent waiting per code received, counting failed activations
+        'wait_per_code_s': round(sum(waits) / delivered, 1) if delivered else None,
+        'get_number_calls': sum(p.calls.get('get_number', 0) for p in providers),
+    }
+
+
+async def main(args):
+    for name, router_class in (('router', ProviderRouter), ('fixed', FixedOrderRouter), ('random', RandomRouter)):
+        print(f"{name:8} {await simulate(router_class, args)}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--purchases', type=int, default=5000)
+    parser.add_argument('--rate', type=float, default=1.0, help="purchases per (virtual) second")
+    parser.add_argument('--seed', type=int, default=1)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,73 @@
+"""
+Micro-benchmark: indexed catalog search vs. the old linear list comprehension,
+on a synthetic catalog of ~190 countries and ~700 services.
+
+    python -m bench.bench_search
+"""
+import os
+import random
+import time
+
+os.environ.setdefault('SMS_ACTIVATE_API_KEY', 'bench')
+
+from bench.fake_sms_activate import COUNTRIES
+from bot.catalog import SERVICE_NAME_MAP
+from bot.search_index import SearchIndex, SERVICE_ALIASES
+
+QUERIES = ["germ", "герм", "россия", "usa", "telega", "vatsap", "whatsapp", "инста", "stea", "zzz"]
+
+
+def synthetic_catalog(seed=1):
+    rnd = random.Random(seed)
+    syllables = ["ka", "ro", "mi", "ta", "lo", "ne", "su", "vi", "ra", "do", "li", "ma", "to", "ge", "an"]
+
+    def word():
+        return ''.join(rnd.choice(syllables) for _ in range(rnd.randint(2, 4))).capitalize()
+
+    countries = [{'id': cid, 'rus': rus, 'eng': eng} for cid, (rus, eng) in COUNTRIES.items()]
+    while len(countries) < 190:
+        name = word()
+        countries.append({'id': 1000 + len(countries), 'rus': name, 'eng': name + "ia"})
+
+    names = dict(SERVICE_NAME_MAP)
+    while len(names) < 700:
+        names[f"s{len(names)}"] = word() + " " + word()
+    return countries, names
+
+
+def timed(func, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        result = func()
+    return (time.perf_counter() - started) / repeat * 1e6, result
+
+
+def main(repeat=200):
+    countries, names = synthetic_catalog()
+
+    started = time.perf_counter()
+    country_index = SearchIndex()
+    for c in countries:
+        country_index.add(c['id'], [c['rus'], c['eng']])
+    service_index = SearchIndex()
+    for code, name in names.items():
+        service_index.add(code, [code, name] + SERVICE_ALIASES.get(code, []))
+    print(f"index build: {(time.perf_counter() - started) * 1000:.1f} ms")
+
+    print(f"{'query':10} {'linear us':>10} {'hits':>5} {'index us':>10} {'hits':>5}")
+    for query in QUERIES:
+        def linear():
+            found = [c for c in countries if query.lower() in c['rus'].lower()]
+            found += [sc for sc in names if query.lower() in names.get(sc, sc).lower()]
+            return found
+
+        def indexed():
+            return country_index.search(query, 18) + service_index.search(query, 12)
+
+        linear_us, linear_hits = timed(linear, repeat)
+        index_us, index_hits = timed(indexed, repeat)
+        print(f"{query:10} {linear_us:10.1f} {len(linear_hits):5} {index_us:10.1f} {len(index_hits):5}")
+
+
+if __name__ == '__main__':
+    main()
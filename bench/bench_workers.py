@@ -0,0 +1,162 @@
+"""
+Update throughput of the multi-process mode (bot/workers.py), fully offline.
+
+For each worker count, starts a WorkerPool whose workers each run the bot
+against their own fake SMS-Activate and fake Telegram servers and a shared
+temporary database, feeds the same pre-generated updates (/start, menus,
+country pages) through the pool and measures processed updates per second,
+from the first update submitted until the last worker has drained its queue.
+Also checks that every user's updates were handled in the order they were sent.
+
+    python -m bench.bench_workers --workers 1 2 4 --updates 5000 --users 500
+
+Throughput can only grow with workers up to the number of CPU cores; the
+report includes os.cpu_count() for that reason. Run it from the project root
+so the menu images are found.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import random
+import shutil
+import tempfile
+import time
+from functools import partial
+
+os.environ.setdefault('SMS_ACTIVATE_API_KEY', 'bench')
+os.environ.setdefault('BOT_TOKEN', '123456:bench')
+os.environ.setdefault('ADMIN_ID', '1')
+
+from aiogram import types
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from bench.bench_e2e import BenchBot
+from bench.fake_sms_activate import FakeSmsActivate, start_fake_server as start_fake_sms_activate
+from bench.fake_telegram_api import FakeTelegramAPI, start_fake_server as start_fake_telegram
+from bench.fake_telegram_sender import random_update
+from bot.db import Database
+from bot.sender import sender
+from bot.workers import WorkerPool, UpdateConsumer
+
+
+class OrderCheck(BaseMiddleware):
+    """Counts updates handled before an earlier update of the same user."""
+    def __init__(self):
+        super().__init__()
+        self.last = {}
+        self.out_of_order = 0
+
+    def _check(self, user_id: int):
+        update_id = types.Update.get_current().update_id
+        if update_id < self.last.get(user_id, 0):
+            self.out_of_order += 1
+        self.last[user_id] = update_id
+
+    async def on_pre_process_message(self, message: types.Message, data: dict):
+        self._check(message.from_user.id)
+
+    async def on_pre_process_callback_query(self, callback_query: types.CallbackQuery, data: dict):
+        self._check(callback_query.from_user.id)
+
+
+def bench_worker(db_path: str, ready, results, index: int, count: int, updates):
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.run(run_worker(db_path, ready, results, index, updates))
+
+
+async def run_worker(db_path: str, ready, results, index: int, updates):
+    sender.set_rate_limits(global_rate=1e9, chat_rate=1e9, global_burst=1e9, chat_burst=1e9)
+    # Every worker has its own fakes so they do not become the shared bottleneck
+    sms_runner, sms_url = await start_fake_sms_activate(FakeSmsActivate(seed=index))
+    telegram_runner, telegram_url = await start_fake_telegram(FakeTelegramAPI(keep_log=False, seed=index))
+    bench = BenchBot(sms_url, telegram_url, db_path)
+    order = OrderCheck()
+    bench.dp.middleware.setup(order)
+    try:
+        await bench.start()
+        await bench.catalog.get_countries()
+        ready.put(index)
+        consumer = UpdateConsumer(bench.dp, updates)
+        await consumer.run()
+        results.put(dict(consumer.stats, worker=index, out_of_order=order.out_of_order))
+    finally:
+        await bench.stop()
+        await sms_runner.cleanup()
+        await telegram_runner.cleanup()
+
+
+async def run_pool(args, workers: int, updates: list) -> dict:
+    workdir = tempfile.mkdtemp(prefix='uni-sms-bench-')
+    db_path = os.path.join(workdir, 'bench.db')
+    # Create the schema once, before several processes open the file
+    await Database(db_path).close()
+
+    context = multiprocessing.get_context('spawn')
+    ready, results = context.Queue(), context.Queue()
+    pool = WorkerPool(partial(bench_worker, db_path, ready, results), workers, args.queue_size)
+    pool.start()
+    try:
+        for _ in range(workers):
+            await asyncio.get_running_loop().run_in_executor(None, ready.get)
+
+        started = time.perf_counter()
+        for update in updates:
+            while not pool.submit(update):
+                await asyncio.sleep(0.001)
+        await pool.stop(timeout=600)
+        duration = time.perf_counter() - started
+
+        stats = []
+        for _ in range(workers):
+            try:
+                stats.append(results.get(timeout=10))
+            except queue.Empty:
+                break
+        processed = sum(s['processed'] for s in stats)
+        return {
+            'duration_s': round(duration, 3),
+            'updates_per_second': round(processed / duration, 1),
+            'processed': processed,
+            'failed': sum(s['failed'] for s in stats),
+            'out_of_order': sum(s['out_of_order'] for s in stats),
+            'per_worker': sorted((s['processed'] for s in stats), reverse=True),
+            'pool': pool.get_stats(),
+        }
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+async def run(args) -> dict:
+    rnd = random.Random(args.seed)
+    updates = [random_update(rnd, args.users) for _ in range(args.updates)]
+    runs = {}
+    for workers in args.workers:
+        runs[workers] = await run_pool(args, workers, updates)
+    base = runs[args.workers[0]]['updates_per_second']
+    for workers, report in runs.items():
+        report['speedup'] = round(report['updates_per_second'] / base, 2) if base else None
+    return {'config': vars(args), 'cpu_count': os.cpu_count(), 'runs': runs}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--updates', type=int, default=5000)
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--queue-size', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help="write the JSON report to this file")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+"""
+In-process fake activation providers with configurable per-route behaviour,
+for testing and benchmarking the provider router (see bench_routing.py).
+
+Each (country, service) route has a RouteProfile: how often numbers are in
+stock, how often the SMS arrives at all and how long it takes. Time comes from
+the `clock` callable, so a simulation can run on virtual time.
+"""
+import asyncio
+import itertools
+import random
+import time
+from bot.api import Provider
+
+
+class RouteProfile:
+    """
+    :param stock: Probability that get_number finds a number.
+    :param success_rate: Probability that the SMS arrives.
+    :param delay: (min, max) seconds until the SMS arrives, uniformly distributed.
+    """
+    __slots__ = ('stock', 'success_rate', 'delay')
+
+    def __init__(self, stock: float = 1.0, success_rate: float = 0.9, delay=(10, 60)):
+        self.stock = stock
+        self.success_rate = success_rate
+        self.delay = delay
+
+
+class FakeProvider(Provider):
+    """
+    A Provider whose numbers receive their SMS (or never do) according to the
+    route's profile. Activation IDs start at a random offset so several fakes
+    don't share them by accident.
+
+    :param routes: {(country, service): RouteProfile}; other routes use `default`.
+    :param latency: Seconds every call takes (real time, not the clock).
+    :param error_rate: Share of get_number calls that fail like a timeout.
+    """
+    def __init__(self, name: str, default: RouteProfile = None, routes: dict = None, latency: float = 0.0,
+                 error_rate: float = 0.0, seed=None, clock=time.monotonic):
+        self.name = name
+        self.default = default or RouteProfile()
+        self.routes = {(str(country), service): profile for (country, service), profile in (routes or {}).items()}
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.clock = clock
+        self.ids = itertools.count(self.random.randint(1, 10 ** 8))
+        self.activations = {}
+        self.calls = {}
+
+    def profile(self, country, service: str) -> RouteProfile:
+        return self.routes.get((str(country), service), self.default)
+
+    async def _call(self, method: str):
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def get_number(self, service: str, country: int):
+        await self._call('get_number')
+        if self.random.random() < self.error_rate:
+            return {'error': 'TIMEOUT'}
+        profile = self.profile(country, service)
+        if self.random.random() >= profile.stock:
+            return {'error': 'NO_NUMBERS'}
+
+        activation_id = next(self.ids)
+        now = self.clock()
+        sms_at = now + self.random.uniform(*profile.delay) if self.random.random() < profile.success_rate else None
+        self.activations[activation_id] = {'created_at': now, 'sms_at': sms_at, 'status': 'STATUS_WAIT_CODE',
+                                           'code': str(self.random.randint(100000, 999999))}
+        return {'activation_id': activation_id, 'phone': 70000000000 + activation_id % 10 ** 9}
+
+    def time_to_sms(self, activation_id: int):
+        """Seconds from purchase to SMS for the activation, or None if it never gets one."""
+        activation = self.activations[activation_id]
+        return None if activation['sms_at'] is None else activation['sms_at'] - activation['created_at']
+
+    def _current_status(self, activation) -> str:
+        if activation['status'] == 'STATUS_WAIT_CODE' and activation['sms_at'] is not None \
+                and self.clock() >= activation['sms_at']:
+            return f"STATUS_OK:{activation['code']}"
+        return activation['status']
+
+    async def get_status(self, activation_id: int):
+        await self._call('get_status')
+        activation = self.activations.get(activation_id)
+        if activation is None:
+            return {'error': 'NO_ACTIVATION'}
+        return self._current_status(activation)
+
+    async def set_status(self, activation_id: int, status: int):
+        await self._call('set_status')
+        activation = self.activations.get(activation_id)
+        if activation is None:
+            return {'error': 'NO_ACTIVATION'}
+        if int(status) == 8:
+            activation['status'] = 'STATUS_CANCEL'
+            return 'ACCESS_CANCEL'
+        if int(status) == 6:
+            activation['status'] = 'STATUS_FINISH'
+            return 'ACCESS_ACTIVATION'
+        return 'ACCESS_READY'
+
+    async def get_active_activations(self):
+        await self._call('get_active_activations')
+        active = []
+        for activation_id, activation in self.activations.items():
+            if activation['status'] != 'STATUS_WAIT_CODE':
+                continue
+            status = self._current_status(activation)
+            active.append({'activationId': activation_id, 'activationStatus': '4',
+                           'smsCode': [status.split(':')[1]] if status.startswith('STATUS_OK') else None})
+        if not active:
+            return {'error': 'NO_ACTIVATIONS'}
+        return {'status': 'success', 'activeActivations': active}
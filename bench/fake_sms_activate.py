@@ -0,0 +1,285 @@
+"""
+A local fake of the SMS-Activate handler API for offline testing and benchmarks.
+
+Run it standalone:
+    python -m bench.fake_sms_activate --port 8081 --latency 0.05
+
+and point the bot at it with SMS_ACTIVATE_API_URL=http://127.0.0.1:8081/stubs/handler_api.php
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import time
+from datetime import datetime, timedelta
+from aiohttp import web
+
+COUNTRIES = {
+    0: ("Россия", "Russia"), 1: ("Украина", "Ukraine"), 2: ("Казахстан", "Kazakhstan"),
+    6: ("Индонезия", "Indonesia"), 12: ("США", "USA"), 16: ("Великобритания", "United Kingdom"),
+    22: ("Индия", "India"), 43: ("Германия", "Germany"), 78: ("Франция", "France"),
+    187: ("США (виртуальные)", "USA (virtual)"),
+}
+SERVICES = ['tg', 'wa', 'vi', 'ig', 'fb', 'go', 'vk', 'ok', 'mm', 'ya', 'ds', 'am', 'tw', 'st', 'ub', 'nf', 'tk', 'ot']
+# Rental period when a rent call gives none (in hours), as upstream.
+DEFAULT_RENT_TIME = 4
+
+
+class FakeSmsActivate:
+    """
+    Keeps fake activations and rentals in memory and answers like the real API.
+    A rental receives one SMS after the same delay as an activation.
+
+    :param latency: Base response latency in seconds.
+    :param jitter: Random extra latency added to every response, in seconds.
+    :param error_rate: Share of getNumber calls that answer NO_NUMBERS.
+    :param sms_delay: (min, max) seconds after purchase before the SMS "arrives".
+    :param sms_distribution: How the delay is drawn within sms_delay: 'uniform', or
+        'exponential' (most SMS arrive early, a few take up to the max).
+    :param no_sms_rate: Share of activations that never receive an SMS.
+    :param extra_countries: Number of synthetic countries to add to the catalog.
+    """
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, sms_delay=(5, 30), extra_countries=0, seed=None,
+                 sms_distribution='uniform', no_sms_rate=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.sms_delay = sms_delay
+        self.sms_distribution = sms_distribution
+        self.no_sms_rate = no_sms_rate
+        self.random = random.Random(seed)
+        self.countries = dict(COUNTRIES)
+        for i in range(extra_countries):
+            self.countries[1000 + i] = (f"Страна {i}", f"Country {i}")
+        self.prices = {
+            cid: {code: {'cost': round(self.random.uniform(5, 60), 2), 'count': self.random.randint(0, 5000)}
+                  for code in SERVICES}
+            for cid in self.countries
+        }
+        self.activations = {}
+        self.rentals = {}
+        self.ids = itertools.count(100000)
+        self.balance = 1000.0
+        self.calls = {}
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get('/stubs/handler_api.php', self.handle)
+        return app
+
+    async def handle(self, request: web.Request) -> web.Response:
+        params = request.query
+        action = params.get('action', '')
+        self.calls[action] = self.calls.get(action, 0) + 1
+        delay = self.latency + (self.random.uniform(0, self.jitter) if self.jitter else 0)
+        if delay:
+            await asyncio.sleep(delay)
+        if params.get('api_key') is None:
+            return web.Response(text='NO_KEY')
+        handler = getattr(self, f"action_{action}", None)
+        if handler is None:
+            return web.Response(text='BAD_ACTION')
+        result = handler(params)
+        if not isinstance(result, str):
+            result = json.dumps(result, ensure_ascii=False)
+        return web.Response(text=result)
+
+    def action_getBalance(self, params):
+        return f"ACCESS_BALANCE:{self.balance:.2f}"
+
+    def action_getCountries(self, params):
+        return {str(cid): {'id': cid, 'rus': rus, 'eng': eng, 'chn': eng}
+                for cid, (rus, eng) in self.countries.items()}
+
+    def action_getPrices(self, params):
+        country = params.get('country')
+        service = params.get('service')
+        countries = [int(country)] if country is not None else list(self.prices)
+        result = {}
+        for cid in countries:
+            prices = self.prices.get(cid, {})
+            if service:
+                prices = {service: prices[service]} if service in prices else {}
+            result[str(cid)] = prices
+        return result
+
+    def action_getNumber(self, params):
+        if self.random.random() < self.error_rate:
+            return 'NO_NUMBERS'
+        activation_id = next(self.ids)
+        phone = f"7{self.random.randint(10 ** 9, 10 ** 10 - 1)}"
+        self.activations[activation_id] = {
+            'phone': phone,
+            'service': params.get('service'),
+            'country': params.get('country'),
+            'status': 'STATUS_WAIT_CODE',
+            'sms_at': time.monotonic() + self._sms_delay(),
+            'code': str(self.random.randint(10000, 99999)),
+        }
+        return f"ACCESS_NUMBER:{activation_id}:{phone}"
+
+    def _sms_delay(self) -> float:
+        if self.random.random() < self.no_sms_rate:
+            return float('inf')
+        low, high = self.sms_delay
+        if self.sms_distribution == 'exponential':
+            # Mean at a quarter of the range, capped at its maximum
+            return min(high, low + self.random.expovariate(4 / (high - low or 1)))
+        return self.random.uniform(low, high)
+
+    def _current_status(self, activation):
+        if activation['status'] == 'STATUS_WAIT_CODE' and time.monotonic() >= activation['sms_at']:
+            return f"STATUS_OK:{activation['code']}"
+        return activation['status']
+
+    def action_getStatus(self, params):
+        activation = self.activations.get(int(params.get('id', 0)))
+        if activation is None:
+            return 'NO_ACTIVATION'
+        return self._current_status(activation)
+
+    def action_setStatus(self, params):
+        activation = self.activations.get(int(params.get('id', 0)))
+        if activation is None:
+            return 'NO_ACTIVATION'
+        status = params.get('status')
+        if status == '8':
+            activation['status'] = 'STATUS_CANCEL'
+            return 'ACCESS_CANCEL'
+        if status == '6':
+            activation['status'] = 'STATUS_FINISH'
+            return 'ACCESS_ACTIVATION'
+        return 'ACCESS_READY'
+
+    def action_getActiveActivations(self, params):
+        active = []
+        for activation_id, activation in self.activations.items():
+            status = self._current_status(activation)
+            if status in ('STATUS_CANCEL', 'STATUS_FINISH'):
+                continue
+            code = status.split(':', 1)[1] if status.startswith('STATUS_OK') else None
+            active.append({
+                'activationId': str(activation_id),
+                'serviceCode': activation['service'],
+                'countryCode': activation['country'],
+                'phoneNumber': activation['phone'],
+                'activationStatus': '2' if code else '4',
+                'smsCode': [code] if code else None,
+                'smsText': None,
+            })
+        if not active:
+            return {'status': 'error', 'error': 'NO_ACTIVATIONS'}
+        return {'status': 'success', 'activeActivations': active}
+
+    def _rent_cost(self, country: int, service: str, hours: int) -> float:
+        return round(self.prices[country][service]['cost'] * (2 + hours / DEFAULT_RENT_TIME), 2)
+
+    @staticmethod
+    def _rent_time(params, key: str = 'time') -> int:
+        # continueRentNumber takes the period as rent_time, the other rent calls as time
+        return int(params.get(key) or DEFAULT_RENT_TIME)
+
+    def _rent_phone(self, rent_id: int, rental) -> dict:
+        end = datetime.utcfromtimestamp(rental['ends_at'])
+        return {'id': rent_id, 'endDate': end.strftime('%Y-%m-%dT%H:%M:%S'), 'number': rental['phone']}
+
+    def _rental_status(self, rental) -> str:
+        if rental['status'] == 'active' and time.time() >= rental['ends_at']:
+            rental['status'] = 'finished'
+        return rental['status']
+
+    def action_getRentServicesAndCountries(self, params):
+        hours = self._rent_time(params)
+        country = int(params.get('country') or 0)
+        services = {code: {'cost': self._rent_cost(country, code, hours), 'quant': offer['count']}
+                    for code, offer in self.prices.get(country, {}).items() if offer['count']}
+        return {'countries': {str(i): cid for i, cid in enumerate(self.countries)},
+                'operators': {'0': 'any'}, 'services': services}
+
+    def action_getRentNumber(self, params):
+        service, country = params.get('service'), int(params.get('country') or 0)
+        if self.random.random() < self.error_rate or not self.prices.get(country, {}).get(service, {}).get('count'):
+            return {'status': 'error', 'message': 'NO_NUMBERS'}
+        rent_id = next(self.ids)
+        rental = self.rentals[rent_id] = {
+            'phone': f"7{self.random.randint(10 ** 9, 10 ** 10 - 1)}",
+            'service': service,
+            'country': country,
+            'status': 'active',
+            'ends_at': time.time() + self._rent_time(params) * 3600,
+            'sms_at': time.monotonic() + self._sms_delay(),
+            'code': str(self.random.randint(10000, 99999)),
+            'started_at': datetime.utcnow(),
+        }
+        return {'status': 'success', 'phone': self._rent_phone(rent_id, rental)}
+
+    def action_getRentStatus(self, params):
+        rental = self.rentals.get(int(params.get('id', 0)))
+        if rental is None:
+            return {'status': 'error', 'message': 'NO_ID_RENT'}
+        status = self._rental_status(rental)
+        if status != 'active':
+            return {'status': 'error', 'message': 'STATUS_FINISH' if status == 'finished' else 'STATUS_CANCEL'}
+        if time.monotonic() < rental['sms_at']:
+            return {'status': 'error', 'message': 'STATUS_WAIT_CODE'}
+        sent = rental['started_at'] + timedelta(seconds=1)
+        values = {'0': {'phoneFrom': rental['service'], 'text': f"Your code: {rental['code']}",
+                        'service': rental['service'], 'date': sent.strftime('%Y-%m-%d %H:%M:%S')}}
+        return {'status': 'success', 'quantity': str(len(values)), 'values': values}
+
+    def action_continueRentNumber(self, params):
+        rent_id = int(params.get('id', 0))
+        rental = self.rentals.get(rent_id)
+        if rental is None:
+            return {'status': 'error', 'message': 'NO_ID_RENT'}
+        if self._rental_status(rental) != 'active':
+            return {'status': 'error', 'message': 'STATUS_FINISH'}
+        rental['ends_at'] += self._rent_time(params, 'rent_time') * 3600
+        return {'status': 'success', 'phone': self._rent_phone(rent_id, rental)}
+
+    def action_setRentStatus(self, params):
+        rental = self.rentals.get(int(params.get('id', 0)))
+        if rental is None:
+            return {'status': 'error', 'message': 'NO_ID_RENT'}
+        status = self._rental_status(rental)
+        if status != 'active':
+            return {'status': 'error', 'message': 'STATUS_FINISH' if status == 'finished' else 'STATUS_CANCEL'}
+        if params.get('status') == '2':
+            # Refunds only while no SMS has come
+            if time.monotonic() >= rental['sms_at']:
+                return {'status': 'error', 'message': 'CANT_CANCEL'}
+            rental['status'] = 'cancelled'
+        else:
+            rental['status'] = 'finished'
+        return {'status': 'success'}
+
+async def start_fake_server(fake: FakeSmsActivate, host='127.0.0.1', port=0):
+    """Starts the fake server and returns (runner, handler_url)."""
+    runner = web.AppRunner(fake.app())
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://{host}:{port}/stubs/handler_api.php"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake SMS-Activate API server")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--sms-delay', type=float, nargs=2, default=(5, 30), metavar=('MIN', 'MAX'))
+    parser.add_argument('--sms-distribution', choices=('uniform', 'exponential'), default='uniform')
+    parser.add_argument('--no-sms-rate', type=float, default=0.0)
+    args = parser.parse_args()
+    fake = FakeSmsActivate(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                           sms_delay=tuple(args.sms_delay), sms_distribution=args.sms_distribution,
+                           no_sms_rate=args.no_sms_rate)
+    web.run_app(fake.app(), host=args.host, port=args.port)
+
+
+if __name__ == '__main__':
+    main()
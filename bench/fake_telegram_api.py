@@ -0,0 +1,128 @@
+"""
+A local fake of the Telegram Bot API that records every call the bot makes.
+
+Point a Bot at it with:
+    Bot(token, server=TelegramAPIServer.from_base(url))
+
+Run it standalone:
+    python -m bench.fake_telegram_api --port 8082 --latency 0.03
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import time
+from aiohttp import web
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': "Uni SMS", 'username': "uni_sms_bot"}
+
+
+class FakeTelegramAPI:
+    """
+    Answers Bot API methods with plausible results and keeps a log of them.
+
+    :param latency: Base response latency in seconds.
+    :param jitter: Random extra latency added to every response, in seconds.
+    :param flood_rate: Share of calls answered with a 429 "Too Many Requests".
+    :param keep_log: Keep (method, chat_id, text, time) of every call in `log`.
+    """
+    def __init__(self, latency=0.0, jitter=0.0, flood_rate=0.0, keep_log=True, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.flood_rate = flood_rate
+        self.keep_log = keep_log
+        self.random = random.Random(seed)
+        self.message_ids = itertools.count(1000)
+        self.file_ids = itertools.count(1)
+        self.calls = {}
+        self.log = []
+        self._listeners = []
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=20 * 1024 * 1024)
+        app.router.add_post('/bot{token}/{method}', self.handle)
+        return app
+
+    def add_listener(self, callback):
+        """Registers callback(method, params) to be called for every recorded call."""
+        self._listeners.append(callback)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info['method']
+        self.calls[method] = self.calls.get(method, 0) + 1
+        params = dict(await request.post())
+        delay = self.latency + (self.random.uniform(0, self.jitter) if self.jitter else 0)
+        if delay:
+            await asyncio.sleep(delay)
+
+        if self.flood_rate and self.random.random() < self.flood_rate:
+            return web.json_response({'ok': False, 'error_code': 429,
+                                      'description': "Too Many Requests: retry after 1",
+                                      'parameters': {'retry_after': 1}})
+
+        if self.keep_log:
+            self.log.append((method, params.get('chat_id'), params.get('text') or params.get('caption'), time.monotonic()))
+        for callback in self._listeners:
+            callback(method, params)
+
+        handler = getattr(self, f"method_{method.lower()}", None)
+        result = handler(params) if handler else True
+        return web.json_response({'ok': True, 'result': result})
+
+    def _message(self, params, **extra) -> dict:
+        chat_id = int(params.get('chat_id') or 0)
+        message_id = int(params['message_id']) if params.get('message_id') else next(self.message_ids)
+        message = {'message_id': message_id, 'date': int(time.time()), 'from': BOT_USER,
+                   'chat': {'id': chat_id, 'type': 'private'}}
+        message.update(extra)
+        return message
+
+    def _photo(self, photo) -> list:
+        file_id = photo if isinstance(photo, str) else f"fake-photo-{next(self.file_ids)}"
+        return [{'file_id': file_id, 'file_unique_id': file_id, 'width': 1280, 'height': 720}]
+
+    def method_getme(self, params):
+        return BOT_USER
+
+    def method_sendmessage(self, params):
+        return self._message(params, text=params.get('text', ''))
+
+    def method_sendphoto(self, params):
+        return self._message(params, photo=self._photo(params.get('photo')), caption=params.get('caption'))
+
+    def method_editmessagetext(self, params):
+        return self._message(params, text=params.get('text', ''))
+
+    def method_editmessagecaption(self, params):
+        return self._message(params, caption=params.get('caption'))
+
+    def method_editmessagemedia(self, params):
+        media = json.loads(params.get('media', '{}'))
+        return self._message(params, photo=self._photo(media.get('media')), caption=media.get('caption'))
+
+
+async def start_fake_server(fake: FakeTelegramAPI, host='127.0.0.1', port=0):
+    """Starts the fake server and returns (runner, base_url) for TelegramAPIServer.from_base."""
+    runner = web.AppRunner(fake.app())
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://{host}:{port}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake Telegram Bot API server")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8082)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--flood-rate', type=float, default=0.0)
+    args = parser.parse_args()
+    fake = FakeTelegramAPI(latency=args.latency, jitter=args.jitter, flood_rate=args.flood_rate, keep_log=False)
+    web.run_app(fake.app(), host=args.host, port=args.port)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+"""
+A fake Telegram that POSTs synthetic updates to the bot's webhook, for
+load-testing the ingestion path.
+
+    python -m bench.fake_telegram_sender --url http://127.0.0.1:8080/webhook \\
+        --secret s3cret --updates 5000 --concurrency 100
+"""
+import argparse
+import asyncio
+import itertools
+import random
+import statistics
+import time
+import aiohttp
+from bot import callbacks
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+_update_ids = itertools.count(1)
+_message_ids = itertools.count(1)
+
+
+def _user(user_id: int) -> dict:
+    return {'id': user_id, 'is_bot': False, 'first_name': f"User{user_id}", 'username': f"user{user_id}"}
+
+
+def message_update(user_id: int, text: str) -> dict:
+    message = {
+        'message_id': next(_message_ids),
+        'from': _user(user_id),
+        'chat': {'id': user_id, 'type': 'private', 'first_name': f"User{user_id}"},
+        'date': int(time.time()),
+        'text': text,
+    }
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return {'update_id': next(_update_ids), 'message': message}
+
+
+def callback_update(user_id: int, data: str, message_id: int = 1) -> dict:
+    return {
+        'update_id': next(_update_ids),
+        'callback_query': {
+            'id': str(next(_update_ids)),
+            'from': _user(user_id),
+            'chat_instance': str(user_id),
+            'data': data,
+            'message': {
+                'message_id': message_id,
+                'chat': {'id': user_id, 'type': 'private'},
+                'date': int(time.time()),
+                'caption': "Главное меню:",
+            },
+        },
+    }
+
+
+def random_update(rnd: random.Random, users: int) -> dict:
+    user_id = 10_000 + rnd.randrange(users)
+    kind = rnd.random()
+    if kind < 0.3:
+        return message_update(user_id, "/start")
+    if kind < 0.6:
+        return callback_update(user_id, callbacks.BUY_MENU.new())
+    if kind < 0.8:
+        return callback_update(user_id, callbacks.BUY_COUNTRY_PAGE.new(rnd.randint(0, 5)))
+    return callback_update(user_id, callbacks.ACCOUNT_MENU.new())
+
+
+async def send_updates(url: str, secret: str, total: int, concurrency: int, users: int, seed: int = 1) -> dict:
+    """Sends `total` updates with `concurrency` connections; returns ack latency stats."""
+    rnd = random.Random(seed)
+    headers = {SECRET_HEADER: secret} if secret else {}
+    latencies = []
+    statuses = {}
+    remaining = iter(range(total))
+
+    async with aiohttp.ClientSession(headers=headers) as session:
+        async def sender():
+            for _ in remaining:
+                started = time.perf_counter()
+                async with session.post(url, json=random_update(rnd, users)) as response:
+                    await response.read()
+                    statuses[response.status] = statuses.get(response.status, 0) + 1
+                latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(sender() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'updates': total,
+        'seconds': round(elapsed, 3),
+        'updates_per_second': round(total / elapsed, 1),
+        'ack_p50_ms': round(statistics.median(latencies) * 1000, 2),
+        'ack_p99_ms': round(latencies[max(int(len(latencies) * 0.99) - 1, 0)] * 1000, 2),
+        'statuses': statuses,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Send synthetic Telegram updates to a webhook")
+    parser.add_argument('--url', default='http://127.0.0.1:8080/webhook')
+    parser.add_argument('--secret')
+    parser.add_argument('--updates', type=int, default=5000)
+    parser.add_argument('--concurrency', type=int, default=100)
+    parser.add_argument('--users', type=int, default=1000)
+    args = parser.parse_args()
+    print(asyncio.run(send_updates(args.url, args.secret, args.updates, args.concurrency, args.users)))
+
+
+if __name__ == '__main__':
+    main()
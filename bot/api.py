@@ -1,9 +1,42 @@
 import asyncio
+import json
 import logging
-from smsactivate.api import SMSActivateAPI
-from config import SMS_ACTIVATE_API_KEY
+import aiohttp
+from config import SMS_ACTIVATE_API_KEY, SMS_ACTIVATE_API_URL, SMS_ACTIVATE_MAX_CONCURRENCY, SMS_ACTIVATE_TIMEOUT
 
-class SmsActivateWrapper:
+# Name of the SMS-Activate provider in purchases, jobs and routing statistics.
+DEFAULT_PROVIDER = 'sms_activate'
+
+
+class Provider:
+    """
+    An upstream source of activation numbers. Results use the SMS-Activate shapes:
+    get_number returns {'activation_id': ..., 'phone': ...}, get_status a 'STATUS_...'
+    string and get_active_activations {'activeActivations': [...]}; errors are
+    returned as {'error': ...} rather than raised.
+    """
+    name = DEFAULT_PROVIDER
+
+    async def get_prices(self, country: int, service: str = None):
+        raise NotImplementedError
+
+    async def get_number(self, service: str, country: int):
+        raise NotImplementedError
+
+    async def get_status(self, activation_id: int):
+        raise NotImplementedError
+
+    async def set_status(self, activation_id: int, status: int):
+        raise NotImplementedError
+
+    async def get_active_activations(self):
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class SmsActivateWrapper(Provider):
     """
     An async wrapper for the official synchronous smsactivate library.
     It runs the library's methods in a separate thread to avoid
@@ -12,6 +45,8 @@ class SmsActivateWrapper:
     def __init__(self, api_key: str = SMS_ACTIVATE_API_KEY):
         if not api_key or api_key == "YOUR_SMS_ACTIVATE_API_KEY":
             raise ValueError("SMS_ACTIVATE_API_KEY is not set or is invalid.")
+        # Imported here: the library pulls in requests, which nothing else needs at startup
+        from smsactivate.api import SMSActivateAPI
         self.sa = SMSActivateAPI(api_key)
 
     async def _run_sync(self, func, *args, **kwargs):
@@ -45,9 +80,12 @@ class SmsActivateWrapper:
     async def set_status(self, activation_id: int, status: int):
         return await self._run_sync(self.sa.setStatus, id=activation_id, status=status)
 
+    async def get_active_activations(self):
+        return await self._run_sync(self.sa.getActiveActivations)
+
     # Rent methods
-    async def get_rent_services_and_countries(self):
-        return await self._run_sync(self.sa.getRentServicesAndCountries)
+    async def get_rent_services_and_countries(self, country: int = None, rent_time: int = None):
+        return await self._run_sync(self.sa.getRentServicesAndCountries, time=rent_time, country=country)
 
     async def get_rent_number(self, service: str, country: int, rent_time: int):
         return await self._run_sync(self.sa.getRentNumber, service=service, country=country, time=rent_time)
@@ -57,3 +95,155 @@ class SmsActivateWrapper:
 
     async def set_rent_status(self, rent_id: int, status: int):
         return await self._run_sync(self.sa.setRentStatus, id=rent_id, status=status)
+
+    async def continue_rent_number(self, rent_id: int, rent_time: int):
+        return await self._run_sync(self.sa.continueRentNumber, id=rent_id, time=rent_time)
+
+
+# Error codes the provider returns as plain text instead of a result.
+SMS_ACTIVATE_ERRORS = {
+    'NO_NUMBERS', 'NO_BALANCE', 'BAD_ACTION', 'BAD_SERVICE', 'BAD_KEY', 'ERROR_SQL', 'SQL_ERROR',
+    'NO_ACTIVATION', 'BAD_STATUS', 'STATUS_CANCEL', 'BANNED', 'NO_CONNECTION', 'ACCOUNT_INACTIVE',
+    'NO_ID_RENT', 'INVALID_PHONE', 'STATUS_FINISH', 'INCORECT_STATUS', 'CANT_CANCEL', 'ALREADY_FINISH',
+    'ALREADY_CANCEL', 'WRONG_OPERATOR', 'NO_YULA_MAIL', 'WHATSAPP_NOT_AVAILABLE', 'NO_KEY',
+    'OPERATORS_NOT_FOUND',
+}
+
+# Actions whose successful response is a JSON document.
+JSON_ACTIONS = {
+    'getPrices', 'getCountries', 'getActiveActivations', 'getRentServicesAndCountries',
+    'getRentNumber', 'getRentStatus', 'setRentStatus', 'continueRentNumber',
+}
+
+# Per-action timeouts (in seconds); the full price list is much larger than other responses.
+ACTION_TIMEOUTS = {
+    'getPrices': 30,
+    'getRentServicesAndCountries': 30,
+}
+
+
+def _parse_balance(text: str) -> dict:
+    # ACCESS_BALANCE:123.45
+    return {'balance': float(text.split(':', 1)[1])}
+
+
+def _parse_number(text: str) -> dict:
+    # ACCESS_NUMBER:$id:$phone
+    _, activation_id, phone = text.split(':', 2)
+    return {'activation_id': int(activation_id), 'phone': int(phone)}
+
+
+RESPONSE_PARSERS = {
+    'getBalance': _parse_balance,
+    'getNumber': _parse_number,
+}
+
+
+def parse_response(action: str, text: str):
+    """
+    Converts a raw provider response into the same shapes the smsactivate
+    library returns, so the client can be used as a drop-in replacement.
+    """
+    text = text.strip()
+    if text in SMS_ACTIVATE_ERRORS:
+        return {'error': text}
+    if not text:
+        return {'error': 'EMPTY_RESPONSE'}
+    try:
+        if action in JSON_ACTIONS:
+            result = json.loads(text)
+            if isinstance(result, dict) and result.get('status') == 'error':
+                return {'error': result.get('error') or result.get('message')}
+            return result
+        parser = RESPONSE_PARSERS.get(action)
+        return parser(text) if parser else text
+    except (ValueError, IndexError) as e:
+        logging.error(f"Unexpected SMSActivate response for {action}: {text[:200]}")
+        return {'error': f"Bad response: {e}"}
+
+
+class SmsActivateClient(Provider):
+    """
+    A native async SMS-Activate client with the same methods as SmsActivateWrapper.
+    Requests run directly on the event loop over a pooled keep-alive HTTP session,
+    with a per-call timeout and a cap on the number of requests in flight.
+    Other providers that speak the SMS-Activate protocol are used through this
+    client too, under their own name and api_url.
+    """
+    def __init__(self, api_key: str = SMS_ACTIVATE_API_KEY, api_url: str = SMS_ACTIVATE_API_URL,
+                 max_concurrency: int = SMS_ACTIVATE_MAX_CONCURRENCY, timeout: float = SMS_ACTIVATE_TIMEOUT,
+                 name: str = DEFAULT_PROVIDER):
+        if not api_key or api_key == "YOUR_SMS_ACTIVATE_API_KEY":
+            raise ValueError("SMS_ACTIVATE_API_KEY is not set or is invalid.")
+        self.name = name
+        self.api_key = api_key
+        self.api_url = api_url
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._session = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.max_concurrency, keepalive_timeout=60, ttl_dns_cache=300)
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+    async def _request(self, action: str, timeout: float = None, **params):
+        """Performs one API call. Errors are returned as {'error': ...} like the wrapper does."""
+        payload = {'api_key': self.api_key, 'action': action}
+        payload.update({k: str(v) for k, v in params.items() if v is not None})
+        client_timeout = aiohttp.ClientTimeout(total=timeout or ACTION_TIMEOUTS.get(action, self.timeout))
+        try:
+            async with self._semaphore:
+                async with self._get_session().get(self.api_url, params=payload, timeout=client_timeout) as response:
+                    text = await response.text()
+        except asyncio.TimeoutError:
+            logging.error(f"SMSActivate request {action} timed out")
+            return {'error': 'TIMEOUT'}
+        except aiohttp.ClientError as e:
+            logging.error(f"Error calling SMSActivate action {action}: {e}")
+            return {'error': str(e)}
+        return parse_response(action, text)
+
+    # Main methods
+    async def get_balance(self):
+        return await self._request('getBalance')
+
+    async def get_countries(self):
+        return await self._request('getCountries')
+
+    async def get_prices(self, country: int, service: str = None):
+        return await self._request('getPrices', country=country, service=service)
+
+    async def get_number(self, service: str, country: int):
+        return await self._request('getNumber', service=service, country=country)
+
+    async def get_status(self, activation_id: int):
+        return await self._request('getStatus', id=activation_id)
+
+    async def set_status(self, activation_id: int, status: int):
+        return await self._request('setStatus', id=activation_id, status=status)
+
+    async def get_active_activations(self):
+        return await self._request('getActiveActivations')
+
+    # Rent methods
+    async def get_rent_services_and_countries(self, country: int = None, rent_time: int = None):
+        return await self._request('getRentServicesAndCountries', country=country, time=rent_time)
+
+    async def get_rent_number(self, service: str, country: int, rent_time: int):
+        return await self._request('getRentNumber', service=service, country=country, time=rent_time)
+
+    async def get_rent_status(self, rent_id: int):
+        return await self._request('getRentStatus', id=rent_id)
+
+    async def set_rent_status(self, rent_id: int, status: int):
+        return await self._request('setRentStatus', id=rent_id, status=status)
+
+    async def continue_rent_number(self, rent_id: int, rent_time: int):
+        return await self._request('continueRentNumber', id=rent_id, rent_time=rent_time)
@@ -0,0 +1,156 @@
+import asyncio
+import logging
+import time
+from aiogram import Bot
+from aiogram.utils.exceptions import BotBlocked, BotKicked, ChatNotFound, UserDeactivated
+from bot.db import Database
+from bot.sender import sender, PRIORITY_BULK, PRIORITY_NORMAL
+
+# Users read from the database per chunk; progress is checkpointed after every chunk.
+BROADCAST_CHUNK_SIZE = 200
+# How often the progress message to the admin is updated (in seconds).
+PROGRESS_INTERVAL = 5
+
+# Errors meaning the user will never receive messages from the bot again.
+UNREACHABLE_ERRORS = (BotBlocked, BotKicked, ChatNotFound, UserDeactivated)
+
+
+class BroadcastProgress:
+    __slots__ = ('broadcast_id', 'total', 'sent', 'failed', 'blocked', 'started_at', 'sent_at_start')
+
+    def __init__(self, broadcast_id: int, total: int, sent: int = 0, failed: int = 0, blocked: int = 0):
+        self.broadcast_id = broadcast_id
+        self.total = total
+        self.sent = sent
+        self.failed = failed
+        self.blocked = blocked
+        self.started_at = time.monotonic()
+        self.sent_at_start = sent
+
+    @property
+    def done(self) -> int:
+        return self.sent + self.failed + self.blocked
+
+    @property
+    def rate(self) -> float:
+        """Messages per second delivered by this run (a resumed broadcast starts counting anew)."""
+        elapsed = time.monotonic() - self.started_at
+        return (self.sent - self.sent_at_start) / elapsed if elapsed > 0 else 0.0
+
+
+class Broadcaster:
+    """
+    Sends a text to every user who hasn't blocked the bot.
+
+    Users are read in keyset-paginated chunks (WHERE id > last id), and each chunk
+    is sent concurrently through the outgoing queue, which keeps us within
+    Telegram's limits and behind interactive traffic. After every chunk the last
+    handled user ID and the counters are saved, so a broadcast interrupted by a
+    restart resumes from its checkpoint (at most one chunk is sent twice).
+    Users who blocked the bot are marked and skipped by later broadcasts.
+    """
+    def __init__(self, bot: Bot, db: Database, admin_id: int):
+        self.bot = bot
+        self.db = db
+        self.admin_id = admin_id
+        self._tasks = {}
+
+    async def start_broadcast(self, text: str) -> int:
+        broadcast_id = await self.db.create_broadcast(text)
+        total = await self.db.count_broadcast_recipients()
+        self._spawn(broadcast_id, text, 0, BroadcastProgress(broadcast_id, total))
+        return broadcast_id
+
+    async def resume(self):
+        """Continues every broadcast the previous process left unfinished."""
+        for broadcast_id, text, last_user_id, sent, failed, blocked in await self.db.get_running_broadcasts():
+            remaining = await self.db.count_broadcast_recipients(last_user_id)
+            progress = BroadcastProgress(broadcast_id, sent + failed + blocked + remaining, sent, failed, blocked)
+            logging.info(f"Продолжаю рассылку #{broadcast_id} с пользователя {last_user_id}")
+            self._spawn(broadcast_id, text, last_user_id, progress)
+
+    async def cancel(self, broadcast_id: int) -> bool:
+        task = self._tasks.get(broadcast_id)
+        if task is None:
+            return False
+        await self.db.set_broadcast_status(broadcast_id, 'cancelled')
+        task.cancel()
+        return True
+
+    def running(self) -> list:
+        return list(self._tasks)
+
+    async def stop(self):
+        """Stops the running broadcasts; they stay 'running' in the database and resume on the next start."""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    # --- Sending ---
+
+    def _spawn(self, broadcast_id: int, text: str, last_user_id: int, progress: BroadcastProgress):
+        task = asyncio.create_task(self._run(broadcast_id, text, last_user_id, progress))
+        self._tasks[broadcast_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(broadcast_id, None))
+
+    async def _run(self, broadcast_id: int, text: str, last_user_id: int, progress: BroadcastProgress):
+        status_message = await self._report(None, progress, "запущена")
+        last_report = time.monotonic()
+        try:
+            while True:
+                recipients = await self.db.get_broadcast_recipients(last_user_id, BROADCAST_CHUNK_SIZE)
+                if not recipients:
+                    break
+
+                results = await asyncio.gather(*(self._send(telegram_id, text) for _, telegram_id in recipients))
+                blocked_ids = [telegram_id for (_, telegram_id), result in zip(recipients, results) if result == 'blocked']
+                progress.sent += results.count('sent')
+                progress.failed += results.count('failed')
+                progress.blocked += len(blocked_ids)
+                last_user_id = recipients[-1][0]
+                await self.db.save_broadcast_progress(broadcast_id, last_user_id, progress.sent, progress.failed,
+                                                      progress.blocked, blocked_ids)
+
+                if time.monotonic() - last_report >= PROGRESS_INTERVAL:
+                    status_message = await self._report(status_message, progress, "идет")
+                    last_report = time.monotonic()
+        except asyncio.CancelledError:
+            if await self.db.get_broadcast_status(broadcast_id) == 'cancelled':
+                await self._report(status_message, progress, "отменена")
+            raise
+        except Exception as e:
+            logging.error(f"Ошибка рассылки #{broadcast_id}: {e}")
+            await self._report(status_message, progress, f"прервана из-за ошибки: {e}")
+            return
+
+        await self.db.save_broadcast_progress(broadcast_id, last_user_id, progress.sent, progress.failed,
+                                              progress.blocked, [], status='finished')
+        await self._report(status_message, progress, "завершена")
+
+    async def _send(self, telegram_id: int, text: str) -> str:
+        try:
+            await sender.send_message(self.bot, telegram_id, text, PRIORITY_BULK)
+            return 'sent'
+        except UNREACHABLE_ERRORS:
+            return 'blocked'
+        except Exception as e:
+            logging.warning(f"Рассылка: не удалось отправить сообщение {telegram_id}: {e}")
+            return 'failed'
+
+    async def _report(self, status_message, progress: BroadcastProgress, state: str):
+        """Sends or updates the progress message in the admin's chat; returns the message."""
+        percent = progress.done / progress.total if progress.total else 1.0
+        text = (
+            f"📣 Рассылка #{progress.broadcast_id} {state}\n\n"
+            f"Обработано: {progress.done} из {progress.total} ({percent:.0%})\n"
+            f"Доставлено: {progress.sent}, заблокировали бота: {progress.blocked}, ошибки: {progress.failed}\n"
+            f"Скорость: {progress.rate:.1f} сообщ./с"
+        )
+        try:
+            if status_message is None:
+                return await sender.send_message(self.bot, self.admin_id, text, PRIORITY_NORMAL)
+            await sender.edit_text(status_message, text, PRIORITY_NORMAL)
+        except Exception as e:
+            logging.error(f"Не удалось отправить отчет о рассылке #{progress.broadcast_id}: {e}")
+        return status_message
@@ -0,0 +1,136 @@
+# Callback data of every inline button, and the router that dispatches it.
+# Each button's data is a short action tag followed by its fields, e.g.
+# "bs:tg:187" for buying Telegram in country 187. Actions are declared once
+# here, so a tag cannot be reused and every field is validated both ways.
+
+import logging
+from aiogram import Dispatcher, types
+
+# Telegram rejects buttons whose callback data is longer than this (in bytes).
+MAX_CALLBACK_DATA = 64
+SEPARATOR = ':'
+
+
+class CallbackDataError(ValueError):
+    """Raised for callback data that does not match its action."""
+
+
+class Action:
+    """A kind of button: its tag in the callback data and the typed fields that follow it."""
+    __slots__ = ('name', 'tag', 'fields')
+
+    def __init__(self, name: str, tag: str, **fields):
+        self.name = name
+        self.tag = tag
+        # {field name: int or str}, in the order they are packed
+        self.fields = fields
+
+    def new(self, *values) -> str:
+        """Packs the field values into callback data."""
+        if len(values) != len(self.fields):
+            raise CallbackDataError(f"{self.name}: ожидалось полей {len(self.fields)}, получено {len(values)}")
+        parts = [self.tag]
+        for (field, kind), value in zip(self.fields.items(), values):
+            if kind is int and isinstance(value, int) and not isinstance(value, bool):
+                parts.append(str(value))
+            elif kind is str and isinstance(value, str) and value and SEPARATOR not in value:
+                parts.append(value)
+            else:
+                raise CallbackDataError(f"{self.name}: недопустимое значение поля {field}: {value!r}")
+        data = SEPARATOR.join(parts)
+        if len(data.encode()) > MAX_CALLBACK_DATA:
+            raise CallbackDataError(f"{self.name}: данные длиннее {MAX_CALLBACK_DATA} байт: {data}")
+        return data
+
+    def parse(self, payload: str) -> tuple:
+        """Returns the field values from the part of the callback data after the tag."""
+        parts = payload.split(SEPARATOR) if self.fields else []
+        if len(parts) != len(self.fields) or (not self.fields and payload):
+            raise CallbackDataError(f"{self.name}: неверный формат данных: {payload!r}")
+        try:
+            return tuple(kind(part) for kind, part in zip(self.fields.values(), parts))
+        except ValueError:
+            raise CallbackDataError(f"{self.name}: неверный формат данных: {payload!r}")
+
+
+MAIN_MENU = Action('main_menu', 'mm')
+ACCOUNT_MENU = Action('account_menu', 'am')
+CHECK_BALANCE = Action('check_balance', 'bal')
+TOP_UP_BALANCE = Action('top_up_balance', 'top')
+HISTORY_MENU = Action('history_menu', 'hm')
+# A history page after the cursor (created_at as digits, rank, id) of the last row shown
+HISTORY_PAGE = Action('history_page', 'hp', page=int, created=str, rank=int, row_id=int)
+
+BUY_MENU = Action('buy_menu', 'bm')
+BUY_COUNTRY_PAGE = Action('buy_country_page', 'bcp', page=int)
+BUY_COUNTRY = Action('buy_country', 'bc', country_id=int)
+BUY_SERVICE_PAGE = Action('buy_service_page', 'bsp', country_id=int, page=int)
+BUY_SERVICE = Action('buy_service', 'bs', service=str, country_id=int)
+BUY_BULK_PAGE = Action('buy_bulk_page', 'bbp', country_id=int, page=int)
+BUY_BULK = Action('buy_bulk', 'bb', service=str, country_id=int)
+BUY_MANY = Action('buy_many', 'bn', service=str, country_id=int, quantity=int)
+SEARCH_COUNTRY = Action('search_country', 'sc')
+SEARCH_SERVICE = Action('search_service', 'ss', country_id=int)
+
+RENT_MENU = Action('rent_menu', 'rm')
+RENT_COUNTRY_PAGE = Action('rent_country_page', 'rcp', page=int)
+RENT_COUNTRY = Action('rent_country', 'rc', country_id=int)
+RENT_TIME = Action('rent_time', 'rt', country_id=int, hours=int)
+RENT_SERVICE_PAGE = Action('rent_service_page', 'rsp', country_id=int, hours=int, page=int)
+RENT_SERVICE = Action('rent_service', 'rs', service=str, country_id=int, hours=int)
+RENT_LIST = Action('rent_list', 'rl')
+RENT_VIEW = Action('rent_view', 'rv', rent_id=int)
+RENT_EXTEND = Action('rent_extend', 're', rent_id=int)
+RENT_EXTEND_TIME = Action('rent_extend_time', 'ret', rent_id=int, hours=int)
+RENT_CLOSE = Action('rent_close', 'rx', rent_id=int)
+
+_declared = [action for action in globals().values() if isinstance(action, Action)]
+ACTIONS = {action.tag: action for action in _declared}
+if len(ACTIONS) != len(_declared):
+    raise ValueError("Два действия с одинаковым тегом в bot/callbacks.py")
+
+
+def action_name(data: str) -> str:
+    """The name of the action a button's callback data belongs to, or 'unknown'."""
+    action = ACTIONS.get((data or '').partition(SEPARATOR)[0])
+    return action.name if action is not None else 'unknown'
+
+
+class CallbackRouter:
+    """
+    Dispatches callback queries with one dict lookup on the action tag instead
+    of trying a filter per button, and hands the decoded fields to the handler
+    as positional arguments: handler(callback_query, *values).
+    """
+    def __init__(self):
+        self._handlers = {}
+
+    def add(self, action: Action, handler):
+        if ACTIONS.get(action.tag) is not action:
+            raise ValueError(f"Действие {action.name} не объявлено в bot/callbacks.py")
+        if action.tag in self._handlers:
+            raise ValueError(f"Обработчик для {action.name} уже зарегистрирован")
+        self._handlers[action.tag] = handler
+
+    async def dispatch(self, callback_query: types.CallbackQuery):
+        tag, _, payload = (callback_query.data or '').partition(SEPARATOR)
+        handler = self._handlers.get(tag)
+        try:
+            if handler is None:
+                raise CallbackDataError(f"неизвестное действие: {callback_query.data!r}")
+            values = ACTIONS[tag].parse(payload)
+        except CallbackDataError as e:
+            # Buttons of messages sent before an update may carry data this version does not know
+            logging.warning(f"Необработанная кнопка от пользователя {callback_query.from_user.id}: {e}")
+            await callback_query.answer("Эта кнопка устарела. Откройте меню заново: /start", show_alert=True)
+            return
+        return await handler(callback_query, *values)
+
+
+def get_callback_router(dp: Dispatcher) -> CallbackRouter:
+    """Returns the dispatcher's callback router, registering it as the callback query handler on first use."""
+    router = dp.get('callback_router')
+    if router is None:
+        router = dp['callback_router'] = CallbackRouter()
+        dp.register_callback_query_handler(router.dispatch)
+    return router
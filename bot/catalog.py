@@ -0,0 +1,324 @@
+import asyncio
+import logging
+import sys
+import time
+from bot.api import SmsActivateWrapper
+from bot.db import Database
+
+# How long cached data counts as fresh (in seconds).
+COUNTRIES_TTL = 6 * 60 * 60
+PRICES_TTL = 5 * 60
+# How long past its TTL an entry may still be served while it is refreshed in the background.
+STALE_TTL = 60 * 60
+# How often the background task refreshes every country's prices with one bulk call.
+BULK_REFRESH_INTERVAL = 4 * 60
+# How often a follower (see start) checks the database for a newer catalog.
+FOLLOW_INTERVAL = 30
+
+SERVICE_NAME_MAP = {
+    'tg': "Telegram", 'wa': "WhatsApp", 'vi': "Viber", 'ig': "Instagram",
+    'fb': "Facebook", 'go': "Google/YouTube", 'vk': "ВКонтакте",
+    'ok': "Одноклассники", 'mm': "Mail.ru", 'ya': "Яндекс",
+    'ds': "Discord", 'am': "Amazon", 'tw': "Twitter", 'st': "Steam",
+    'ub': "Uber", 'nf': "Netflix", 'tk': "TikTok", 'ot': "Любой другой"
+}
+
+
+class CacheEntry:
+    __slots__ = ('value', 'fetched_at')
+
+    def __init__(self, value, age: float = 0.0):
+        self.value = value
+        self.fetched_at = time.monotonic() - age
+
+    @property
+    def age(self) -> float:
+        return time.monotonic() - self.fetched_at
+
+
+class Country:
+    __slots__ = ('id', 'rus', 'eng')
+
+    def __init__(self, id: int, rus: str, eng: str):
+        self.id = id
+        self.rus = rus
+        self.eng = eng
+
+    def __eq__(self, other):
+        return isinstance(other, Country) and (self.id, self.rus, self.eng) == (other.id, other.rus, other.eng)
+
+
+class Price:
+    """A service's price in RUB and the number of numbers in stock."""
+    __slots__ = ('cost', 'count')
+
+    def __init__(self, cost: float, count: int):
+        self.cost = cost
+        self.count = count
+
+    def __eq__(self, other):
+        return isinstance(other, Price) and (self.cost, self.count) == (other.cost, other.count)
+
+
+class Catalog:
+    """
+    Caches the country list and per-country service prices.
+
+    Every entry has a TTL. Concurrent misses for the same key share one upstream
+    request, and entries slightly past their TTL are served immediately while a
+    background refresh runs. A background task also refreshes all prices with a
+    single bulk getPrices call. `version` increases whenever cached data changes,
+    so derived data (keyboards, search indexes) can tell when it is outdated.
+
+    Entries are kept as slotted Country and Price records with interned service
+    codes rather than the provider's nested dicts. With a database, every refresh
+    writes only the rows that changed, and load() fills the cache from those
+    tables at startup, so a restart does not begin with an empty catalog.
+    """
+    def __init__(self, api: SmsActivateWrapper, db: Database = None):
+        self.api = api
+        self.db = db
+        self.version = 0
+        self.stats = {'hits': 0, 'stale_hits': 0, 'misses': 0, 'refreshes': 0, 'errors': 0}
+        self._countries = None
+        self._prices = {}
+        self._inflight = {}
+        self._listeners = []
+        self._task = None
+
+    # --- Public API ---
+
+    async def load(self, fresh: bool = False):
+        """
+        Fills the cache from the database. Loaded entries count as just expired: they
+        are served at once and refreshed in the background on first use, and
+        get_fresh_price fetches the price again before anyone is charged.
+        With fresh=True they count as just fetched (another process has just
+        written them).
+        """
+        if self.db is None:
+            return
+        countries, prices = await self.db.get_catalog()
+        if countries:
+            records = [Country(country_id, rus, eng) for country_id, rus, eng in countries]
+            self._countries = CacheEntry(sorted(records, key=lambda c: c.rus), age=0 if fresh else COUNTRIES_TTL)
+        by_country = {}
+        for country_id, service, cost, count in prices:
+            by_country.setdefault(country_id, {})[sys.intern(service)] = Price(cost, count)
+        for country_id, country_prices in by_country.items():
+            self._prices[country_id] = CacheEntry(country_prices, age=0 if fresh else PRICES_TTL)
+        if countries or prices:
+            logging.info(f"Каталог загружен из базы: {len(countries)} стран, {len(prices)} цен")
+            self._changed()
+
+    async def warm_up(self):
+        """
+        Fills the cache before the first request: from the database, or from the
+        provider if nothing is stored yet.
+        """
+        await self.load()
+        if self._countries is None:
+            await self.get_countries()
+        if not self._prices:
+            await self.refresh_all_prices()
+
+    async def get_countries(self) -> list:
+        """Returns all countries (Country records) sorted by their Russian name."""
+        return await self._get('countries', self._countries, COUNTRIES_TTL, self._load_countries)
+
+    async def get_prices(self, country_id: int) -> dict:
+        """Returns {service_code: Price} for a country."""
+        return await self._get(('prices', country_id), self._prices.get(country_id), PRICES_TTL,
+                               lambda: self._load_prices(country_id))
+
+    async def get_fresh_price(self, country_id: int, service_code: str):
+        """
+        Returns the Price of one service, never older than PRICES_TTL.
+        Used when charging users, so a stale entry is refreshed before it is used.
+        """
+        entry = self._prices.get(country_id)
+        if entry is None or entry.age >= PRICES_TTL:
+            await self._single_flight(('prices', country_id), lambda: self._load_prices(country_id))
+            entry = self._prices.get(country_id)
+        else:
+            self.stats['hits'] += 1
+        return entry.value.get(service_code) if entry else None
+
+    def cached_countries(self) -> list:
+        """Returns the cached country list without touching the network."""
+        return self._countries.value if self._countries else []
+
+    def cached_service_codes(self) -> set:
+        """Returns every service code seen in any cached country."""
+        codes = set()
+        for entry in self._prices.values():
+            codes.update(entry.value)
+        return codes
+
+    def add_listener(self, callback):
+        """Registers callback(version) to be called whenever the catalog changes."""
+        self._listeners.append(callback)
+
+    def get_stats(self) -> dict:
+        lookups = self.stats['hits'] + self.stats['stale_hits'] + self.stats['misses']
+        hit_rate = (self.stats['hits'] + self.stats['stale_hits']) / lookups if lookups else 0.0
+        return dict(self.stats, version=self.version, countries_cached=len(self._prices), hit_rate=hit_rate)
+
+    def start(self, follow: bool = False):
+        """
+        Starts refreshing the catalog in the background. A follower does not
+        call the provider itself: it reloads the catalog whenever another
+        process (the one started without follow) has stored a newer one.
+        """
+        if self._task is None:
+            self._task = asyncio.create_task(self._follow_loop() if follow else self._refresh_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    # --- Caching ---
+
+    async def _get(self, key, entry: CacheEntry, ttl: float, loader):
+        if entry is not None:
+            if entry.age < ttl:
+                self.stats['hits'] += 1
+                return entry.value
+            if entry.age < ttl + STALE_TTL:
+                self.stats['stale_hits'] += 1
+                self._refresh_in_background(key, loader)
+                return entry.value
+        self.stats['misses'] += 1
+        return await self._single_flight(key, loader)
+
+    async def _single_flight(self, key, loader):
+        """Runs loader() once per key, no matter how many callers are waiting for it."""
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(loader())
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(task)
+
+    def _refresh_in_background(self, key, loader):
+        if key in self._inflight:
+            return
+
+        async def refresh():
+            try:
+                await self._single_flight(key, loader)
+            except Exception as e:
+                logging.error(f"Фоновое обновление каталога ({key}) не удалось: {e}")
+
+        asyncio.create_task(refresh())
+
+    def _changed(self):
+        self.version += 1
+        for callback in self._listeners:
+            try:
+                callback(self.version)
+            except Exception as e:
+                logging.error(f"Ошибка в обработчике обновления каталога: {e}")
+
+    # --- Loaders ---
+
+    async def _load_countries(self) -> list:
+        countries_data = await self.api.get_countries()
+        if not isinstance(countries_data, dict) or 'error' in countries_data:
+            self.stats['errors'] += 1
+            raise Exception(f"Invalid country data: {countries_data}")
+
+        all_countries = sorted((Country(int(c['id']), c['rus'], c['eng']) for c in countries_data.values()),
+                               key=lambda c: c.rus)
+        self.stats['refreshes'] += 1
+        previous, self._countries = self._countries, CacheEntry(all_countries)
+        old = {c.id: c for c in previous.value} if previous else {}
+        changed = [(c.id, c.rus, c.eng) for c in all_countries if old.get(c.id) != c]
+        removed = set(old) - {c.id for c in all_countries}
+        if changed or removed:
+            self._changed()
+            if self.db is not None:
+                await self.db.save_catalog_countries(changed, removed)
+        return all_countries
+
+    async def _load_prices(self, country_id: int) -> dict:
+        prices_data = await self.api.get_prices(country=country_id)
+        if not isinstance(prices_data, dict) or str(country_id) not in prices_data:
+            self.stats['errors'] += 1
+            raise Exception(f"Invalid prices data: {prices_data}")
+
+        self.stats['refreshes'] += 1
+        await self._apply_price_delta(*self._store_prices(country_id, prices_data[str(country_id)]))
+        return self._prices[country_id].value
+
+    def _store_prices(self, country_id: int, raw_prices: dict):
+        """
+        Caches a country's prices, keeping the records of unchanged services.
+        Returns the (country_id, service, cost, count) rows that changed and the
+        (country_id, service) keys that disappeared.
+        """
+        previous = self._prices.get(country_id)
+        old = previous.value if previous else {}
+        prices, changed = {}, []
+        for code, details in raw_prices.items():
+            try:
+                cost, count = float(details['cost']), int(details['count'])
+            except (KeyError, TypeError, ValueError):
+                continue
+            price = old.get(code)
+            if price is None or price.cost != cost or price.count != count:
+                price = Price(cost, count)
+                changed.append((country_id, code, cost, count))
+            prices[sys.intern(code)] = price
+        removed = [(country_id, code) for code in old if code not in prices]
+        self._prices[country_id] = CacheEntry(prices)
+        return changed, removed
+
+    async def _apply_price_delta(self, changed: list, removed: list):
+        if not (changed or removed):
+            return
+        self._changed()
+        if self.db is not None:
+            await self.db.save_catalog_prices(changed, removed)
+
+    async def refresh_all_prices(self):
+        """Refreshes every country's prices with a single bulk request."""
+        prices_data = await self.api.get_prices(country=None)
+        if not isinstance(prices_data, dict) or 'error' in prices_data:
+            self.stats['errors'] += 1
+            raise Exception(f"Invalid prices data: {prices_data}")
+
+        changed, removed = [], []
+        for country_id, prices in prices_data.items():
+            if isinstance(prices, dict):
+                country_changed, country_removed = self._store_prices(int(country_id), prices)
+                changed += country_changed
+                removed += country_removed
+        self.stats['refreshes'] += 1
+        await self._apply_price_delta(changed, removed)
+
+    async def _refresh_loop(self):
+        while True:
+            try:
+                await self.refresh_all_prices()
+                logging.info(f"Каталог цен обновлен: {self.get_stats()}")
+            except Exception as e:
+                logging.error(f"Не удалось обновить каталог цен: {e}")
+            await asyncio.sleep(BULK_REFRESH_INTERVAL)
+
+    async def _follow_loop(self):
+        version = await self.db.get_catalog_version()
+        while True:
+            await asyncio.sleep(FOLLOW_INTERVAL)
+            try:
+                current = await self.db.get_catalog_version()
+                if current != version:
+                    version = current
+                    await self.load(fresh=True)
+            except Exception as e:
+                logging.error(f"Не удалось перечитать каталог из базы: {e}")
@@ -1,17 +1,59 @@
-import sqlite3
+import asyncio
+import json
 import logging
+import queue
+import sqlite3
+import threading
+from concurrent.futures import Future, InvalidStateError, ThreadPoolExecutor
+
+# Number of reader connections (one per reader thread).
+READER_POOL_SIZE = 4
+# Upper bound on how many queued writes share a single commit.
+GROUP_COMMIT_MAX_BATCH = 256
+# Size of each connection's prepared statement cache.
+STATEMENT_CACHE_SIZE = 256
+
 
 class Database:
-    def __init__(self, db_file="uni_sms.db"):
-        self.conn = sqlite3.connect(db_file)
-        self.cursor = self.conn.cursor()
+    """
+    Async facade over the SQLite database.
+
+    Writes are queued to a dedicated writer thread that owns the only write
+    connection. It drains everything queued since its last commit and applies
+    it in one transaction (each write in its own savepoint), so a burst of
+    writes shares one commit. Reads run on a small pool of reader connections.
+    WAL journal mode lets readers work while the writer commits, and nothing
+    here ever blocks the event loop.
+    """
+    def __init__(self, db_file="uni_sms.db", readers: int = READER_POOL_SIZE):
+        self.db_file = db_file
+        self.readers = readers
+        self._local = threading.local()
+        self._reader_conns = []
+        self._readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="db-reader")
+        self._writes = queue.SimpleQueue()
+
+        self.conn = self._connect()
         self.setup_database()
+        self._writer = threading.Thread(target=self._writer_loop, name="db-writer", daemon=True)
+        self._writer.start()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_file, check_same_thread=False, isolation_level=None,
+                               cached_statements=STATEMENT_CACHE_SIZE)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        return conn
 
     def setup_database(self):
         """Creates the necessary tables if they don't exist."""
         try:
+            cursor = self.conn.cursor()
+            cursor.execute("BEGIN")
+
             # Users table
-            self.cursor.execute("""
+            cursor.execute("""
                 CREATE TABLE IF NOT EXISTS users (
                     id INTEGER PRIMARY KEY,
                     telegram_id INTEGER UNIQUE NOT NULL,
@@ -19,12 +61,14 @@ class Database:
                     first_name TEXT,
                     referred_by INTEGER,
                     balance INTEGER DEFAULT 0, -- Storing balance in cents/kopecks
+                    held INTEGER DEFAULT 0, -- Funds reserved by open holds, not part of balance
+                    blocked_at TIMESTAMP, -- Set when the user has blocked the bot; broadcasts skip them
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                 )
             """)
 
             # Transactions table
-            self.cursor.execute("""
+            cursor.execute("""
                 CREATE TABLE IF NOT EXISTS transactions (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
                     user_id INTEGER NOT NULL,
@@ -37,7 +81,7 @@ class Database:
             """)
 
             # Purchase history
-            self.cursor.execute("""
+            cursor.execute("""
                 CREATE TABLE IF NOT EXISTS purchase_history (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
                     user_id INTEGER NOT NULL,
@@ -46,13 +90,19 @@ class Database:
                     country TEXT,
                     phone_number TEXT,
                     status TEXT,
+                    cost INTEGER, -- Price charged for the number, in kopecks
+                    hold_id INTEGER, -- The hold paying for the number until it completes
+                    chat_id INTEGER, -- Where the SMS code is delivered
+                    provider TEXT DEFAULT 'sms_activate', -- Upstream the number was bought from; tzid is its ID there
+                    message_id INTEGER, -- Status message of a bulk order, updated as its codes arrive
+                    sms_code TEXT,
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                     FOREIGN KEY (user_id) REFERENCES users (id)
                 )
             """)
 
             # Rental history
-            self.cursor.execute("""
+            cursor.execute("""
                 CREATE TABLE IF NOT EXISTS rental_history (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
                     user_id INTEGER NOT NULL,
@@ -60,119 +110,1207 @@ class Database:
                     service TEXT,
                     country TEXT,
                     phone_number TEXT,
-                    expires_at TIMESTAMP,
+                    expires_at TIMESTAMP, -- UTC
+                    cost INTEGER, -- Total paid for the rental including extensions, in kopecks
+                    chat_id INTEGER, -- Where incoming SMS are forwarded
+                    status TEXT DEFAULT 'active', -- 'active', 'finished', 'cancelled', 'expired'
+                    sms_seen INTEGER DEFAULT 0, -- SMS already forwarded to the user
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                     FOREIGN KEY (user_id) REFERENCES users (id)
                 )
             """)
-            self.conn.commit()
+
+            # Balance holds: funds reserved for a purchase until it is captured or released
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS holds (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER NOT NULL,
+                    amount INTEGER NOT NULL, -- Amount reserved (or charged, once captured)
+                    status TEXT NOT NULL DEFAULT 'held', -- 'held', 'captured', 'released'
+                    details TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    settled_at TIMESTAMP,
+                    FOREIGN KEY (user_id) REFERENCES users (id)
+                )
+            """)
+
+            # Telegram file_ids of uploaded images, keyed by bot and file content
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS media_cache (
+                    bot_id INTEGER NOT NULL,
+                    content_hash TEXT NOT NULL, -- SHA-256 of the file
+                    file_id TEXT NOT NULL,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (bot_id, content_hash)
+                )
+            """)
+
+            # Admin broadcasts; last_user_id is the checkpoint a restarted broadcast resumes from
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS broadcasts (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    text TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'running', -- 'running', 'finished', 'cancelled'
+                    last_user_id INTEGER NOT NULL DEFAULT 0, -- users.id of the last recipient handled
+                    sent INTEGER NOT NULL DEFAULT 0,
+                    failed INTEGER NOT NULL DEFAULT 0,
+                    blocked INTEGER NOT NULL DEFAULT 0,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    finished_at TIMESTAMP
+                )
+            """)
+
+            # Rollups for /report, kept up to date by the same transactions that write the ledger
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'revenue_daily'")
+            rollups_exist = cursor.fetchone() is not None
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS revenue_daily (
+                    day TEXT NOT NULL, -- UTC date, YYYY-MM-DD
+                    type TEXT NOT NULL, -- Transaction type
+                    amount INTEGER NOT NULL DEFAULT 0,
+                    count INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (day, type)
+                )
+            """)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS purchases_daily (
+                    day TEXT NOT NULL, -- UTC date the number was bought
+                    service TEXT NOT NULL,
+                    country TEXT NOT NULL,
+                    purchases INTEGER NOT NULL DEFAULT 0,
+                    completed INTEGER NOT NULL DEFAULT 0, -- Purchases that received an SMS
+                    revenue INTEGER NOT NULL DEFAULT 0, -- Cost of the completed purchases
+                    PRIMARY KEY (day, service, country)
+                )
+            """)
+
+            # The provider's catalog, so a restarted bot has it before the first refresh.
+            # Refreshes write only the rows that changed.
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS catalog_countries (
+                    id INTEGER PRIMARY KEY, -- Provider's country ID
+                    rus TEXT NOT NULL,
+                    eng TEXT NOT NULL
+                )
+            """)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS catalog_prices (
+                    country_id INTEGER NOT NULL,
+                    service TEXT NOT NULL,
+                    cost REAL NOT NULL, -- RUB, as the provider quotes it
+                    count INTEGER NOT NULL, -- Numbers in stock
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (country_id, service)
+                ) WITHOUT ROWID
+            """)
+
+            # Per-user conversation state (e.g. "searching_country"), shared between processes
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS user_states (
+                    user_id INTEGER PRIMARY KEY, -- Telegram ID
+                    data TEXT NOT NULL, -- JSON: {'state': ..., 'context': {...}}
+                    expires_at REAL NOT NULL -- Unix time
+                )
+            """)
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_user_states_expires_at ON user_states (expires_at)")
+
+            # Outbox of side effects (provider calls, notifications), written in the same
+            # transaction as the state change they follow from and run by bot/outbox.py
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    kind TEXT NOT NULL, -- 'set_status', 'notify'
+                    idempotency_key TEXT UNIQUE NOT NULL, -- A job is enqueued at most once per key
+                    payload TEXT NOT NULL, -- JSON arguments
+                    status TEXT NOT NULL DEFAULT 'pending', -- 'pending', 'done', 'failed'
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_run_at REAL NOT NULL, -- Unix time; pushed forward while a worker holds the job
+                    last_error TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    finished_at TIMESTAMP
+                )
+            """)
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_jobs_due ON jobs (next_run_at) WHERE status = 'pending'")
+
+            # Purchases are looked up by activation ID when they finish
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_purchase_history_tzid ON purchase_history (tzid)")
+            # History pages read a user's newest rows first, straight from these indexes
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_purchase_history_user_created ON purchase_history (user_id, created_at)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_rental_history_user_created ON rental_history (user_id, created_at)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_transactions_user_created ON transactions (user_id, created_at)")
+
+            # Columns added after the first release
+            self._ensure_column(cursor, "users", "held", "INTEGER DEFAULT 0")
+            self._ensure_column(cursor, "users", "blocked_at", "TIMESTAMP")
+            self._ensure_column(cursor, "purchase_history", "cost", "INTEGER")
+            self._ensure_column(cursor, "purchase_history", "hold_id", "INTEGER")
+            self._ensure_column(cursor, "purchase_history", "chat_id", "INTEGER")
+            self._ensure_column(cursor, "purchase_history", "provider", "TEXT DEFAULT 'sms_activate'")
+            self._ensure_column(cursor, "purchase_history", "message_id", "INTEGER")
+            self._ensure_column(cursor, "purchase_history", "sms_code", "TEXT")
+            # Active purchases are reloaded into the scheduler on startup
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_purchase_history_active ON purchase_history (hold_id) "
+                           "WHERE status = 'active'")
+            # A bulk order's purchases share one hold
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_purchase_history_hold ON purchase_history (hold_id)")
+            self._ensure_column(cursor, "rental_history", "cost", "INTEGER")
+            self._ensure_column(cursor, "rental_history", "chat_id", "INTEGER")
+            self._ensure_column(cursor, "rental_history", "status", "TEXT DEFAULT 'active'")
+            self._ensure_column(cursor, "rental_history", "sms_seen", "INTEGER DEFAULT 0")
+            # Active rentals are reloaded into the rental scheduler on startup and listed per user
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_rental_history_active ON rental_history (user_id, expires_at) "
+                           "WHERE status = 'active'")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_rental_history_tzid ON rental_history (tzid)")
+            if not rollups_exist:
+                _rebuild_rollups(cursor)
+            cursor.execute("COMMIT")
         except sqlite3.Error as e:
             logging.error(f"Database setup error: {e}")
+            if self.conn.in_transaction:
+                self.conn.execute("ROLLBACK")
             raise
 
-    def add_user(self, telegram_id: int, username: str, first_name: str, referred_by: int = None):
+    @staticmethod
+    def _ensure_column(cursor, table: str, column: str, definition: str):
+        """Adds a column to an existing table if an older schema lacks it."""
+        cursor.execute(f"PRAGMA table_info({table})")
+        if column not in {row[1] for row in cursor.fetchall()}:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+    # --- Execution helpers ---
+
+    def _writer_loop(self):
+        """Applies queued writes in groups, one commit per group."""
+        while True:
+            job = self._writes.get()
+            if job is None:
+                break
+            batch = [job]
+            stop = False
+            while len(batch) < GROUP_COMMIT_MAX_BATCH:
+                try:
+                    job = self._writes.get_nowait()
+                except queue.Empty:
+                    break
+                if job is None:
+                    stop = True
+                    break
+                batch.append(job)
+
+            try:
+                self._apply_batch(batch)
+            except Exception as e:
+                # The writer must outlive any job, or every later write would hang
+                logging.exception(f"Writer failed on a batch of {len(batch)} writes: {e}")
+                for _, _, future in batch:
+                    _settle(future, None, e)
+            if stop:
+                break
+        self.conn.close()
+
+    def _apply_batch(self, batch):
+        results = []
+        try:
+            self.conn.execute("BEGIN IMMEDIATE")
+            for func, args, future in batch:
+                self.conn.execute("SAVEPOINT job")
+                try:
+                    result = func(self.conn.cursor(), *args)
+                except Exception as e:
+                    self.conn.execute("ROLLBACK TO job")
+                    self.conn.execute("RELEASE job")
+                    results.append((future, None, e))
+                else:
+                    self.conn.execute("RELEASE job")
+                    results.append((future, result, None))
+            self.conn.execute("COMMIT")
+        except Exception as e:
+            logging.error(f"Group commit of {len(batch)} writes failed: {e}")
+            if self.conn.in_transaction:
+                self.conn.execute("ROLLBACK")
+            results = [(future, None, e) for _, _, future in batch]
+
+        for future, result, error in results:
+            _settle(future, result, error)
+
+    def _reader(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+            self._reader_conns.append(conn)
+        return conn
+
+    def _run_read(self, func, args):
+        return func(self._reader().cursor(), *args)
+
+    async def _write(self, func, *args):
+        """Runs func(cursor, *args) on the writer thread and waits for its commit."""
+        future = Future()
+        self._writes.put((func, args, future))
+        return await asyncio.wrap_future(future)
+
+    async def _read(self, func, *args):
+        """Runs func(cursor, *args) on a reader connection."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._readers, self._run_read, func, args)
+
+    async def warm_up(self):
+        """
+        Opens every reader connection ahead of the first query and makes sure the
+        query planner has index statistics: ANALYZE on a database that has none,
+        PRAGMA optimize otherwise.
+        """
+        # Each read waits for the others, so every reader thread gets one
+        barrier = threading.Barrier(self.readers)
+        await asyncio.gather(*(self._read(lambda cursor: barrier.wait(timeout=5)) for _ in range(self.readers)))
+        await self._write(_update_statistics)
+
+    async def close(self):
+        """Flushes pending writes and closes every connection."""
+        self._writes.put(None)
+        await asyncio.to_thread(self._writer.join)
+        self._readers.shutdown(wait=True)
+        for conn in self._reader_conns:
+            conn.close()
+
+    # --- Queries ---
+
+    async def add_user(self, telegram_id: int, username: str, first_name: str, referred_by: int = None):
         """Adds a new user to the database."""
         try:
-            self.cursor.execute("INSERT OR IGNORE INTO users (telegram_id, username, first_name, referred_by) VALUES (?, ?, ?, ?)",
-                                (telegram_id, username, first_name, referred_by))
-            self.conn.commit()
+            await self._write(_add_user, telegram_id, username, first_name, referred_by)
         except sqlite3.Error as e:
             logging.error(f"Error adding user: {e}")
 
-    def get_user_id(self, telegram_id: int) -> int:
+    async def get_user_id(self, telegram_id: int) -> int:
         """Gets the database ID for a user."""
-        self.cursor.execute("SELECT id FROM users WHERE telegram_id = ?", (telegram_id,))
-        result = self.cursor.fetchone()
-        return result[0] if result else None
-
-    def log_purchase(self, user_telegram_id: int, tzid: int, service: str, country: str, phone_number: str):
-        """Logs a new number purchase."""
-        user_id = self.get_user_id(user_telegram_id)
-        if user_id:
-            try:
-                self.cursor.execute(
-                    "INSERT INTO purchase_history (user_id, tzid, service, country, phone_number, status) VALUES (?, ?, ?, ?, ?, ?)",
-                    (user_id, tzid, service, country, phone_number, 'active')
-                )
-                self.conn.commit()
-            except sqlite3.Error as e:
-                logging.error(f"Error logging purchase: {e}")
-
-    def log_rental(self, user_telegram_id: int, tzid: int, service: str, country: str, phone_number: str, expires_at):
-        """Logs a new number rental."""
-        user_id = self.get_user_id(user_telegram_id)
-        if user_id:
-            try:
-                self.cursor.execute(
-                    "INSERT INTO rental_history (user_id, tzid, service, country, phone_number, expires_at) VALUES (?, ?, ?, ?, ?, ?)",
-                    (user_id, tzid, service, country, phone_number, expires_at)
-                )
-                self.conn.commit()
-            except sqlite3.Error as e:
-                logging.error(f"Error logging rental: {e}")
-
-    def get_purchase_history(self, user_telegram_id: int):
-        """Retrieves purchase history for a user."""
-        user_id = self.get_user_id(user_telegram_id)
-        if user_id:
-            self.cursor.execute("SELECT service, phone_number, created_at FROM purchase_history WHERE user_id = ? ORDER BY created_at DESC", (user_id,))
-            return self.cursor.fetchall()
-        return []
+        return await self._read(_get_user_id, telegram_id)
 
-    def get_rental_history(self, user_telegram_id: int):
-        """Retrieves rental history for a user."""
-        user_id = self.get_user_id(user_telegram_id)
-        if user_id:
-            self.cursor.execute("SELECT service, phone_number, expires_at FROM rental_history WHERE user_id = ? ORDER BY created_at DESC", (user_id,))
-            return self.cursor.fetchall()
-        return []
+    async def log_purchase(self, user_telegram_id: int, tzid: int, service: str, country: str, phone_number: str,
+                           cost: int = None, hold_id: int = None, chat_id: int = None,
+                           provider: str = 'sms_activate') -> bool:
+        """
+        Logs a new number purchase. hold_id and chat_id let a restarted bot resume
+        waiting for the SMS. Returns False if the purchase could not be logged.
+        """
+        try:
+            await self._write(_log_purchase, user_telegram_id, tzid, service, country, phone_number, cost,
+                              hold_id, chat_id, provider)
+            return True
+        except sqlite3.Error as e:
+            logging.error(f"Error logging purchase: {e}")
+            return False
 
-    def get_user_balance(self, user_telegram_id: int) -> int:
+    async def log_purchases(self, user_telegram_id: int, numbers, service: str, country: str, cost: int,
+                            hold_id: int, chat_id: int, message_id: int) -> bool:
+        """
+        Logs the numbers of a bulk order, given as (tzid, provider, phone_number), in one
+        insert. They share the hold and the status message. Returns False on failure.
+        """
+        try:
+            await self._write(_log_purchases, user_telegram_id, list(numbers), service, country, cost,
+                              hold_id, chat_id, message_id)
+            return True
+        except sqlite3.Error as e:
+            logging.error(f"Error logging bulk purchase: {e}")
+            return False
+
+    async def get_order_purchases(self, hold_id: int):
+        """Returns (phone_number, status, sms_code, cost) of every purchase paid by a hold, in purchase order."""
+        return await self._read(_get_order_purchases, hold_id)
+
+    async def log_rental(self, user_telegram_id: int, tzid: int, service: str, country: str, phone_number: str,
+                         expires_at: float, cost: int = None, chat_id: int = None, hold_id: int = None) -> bool:
+        """
+        Logs a new number rental; expires_at is Unix time. chat_id lets a restarted bot
+        keep forwarding its SMS. The hold paying for the rental is captured in the same
+        transaction. Returns False if the rental could not be logged.
+        """
+        try:
+            await self._write(_log_rental, user_telegram_id, tzid, service, country, phone_number, expires_at,
+                              cost, chat_id, hold_id)
+            return True
+        except sqlite3.Error as e:
+            logging.error(f"Error logging rental: {e}")
+            return False
+
+    async def get_active_rentals(self):
+        """Returns (tzid, chat_id, expires_at as Unix time, sms_seen, phone_number) of every active rental."""
+        return await self._read(_get_active_rentals)
+
+    async def get_user_rentals(self, user_telegram_id: int):
+        """Returns (tzid, service, phone_number, expires_at) of a user's active rentals, soonest to expire first."""
+        return await self._read(_get_user_rentals, user_telegram_id)
+
+    async def get_rental(self, user_telegram_id: int, tzid: int):
+        """
+        Returns (service, country, phone_number, expires_at, status, cost, age_seconds, sms_seen)
+        of one of the user's rentals, or None if it is not theirs.
+        """
+        return await self._read(_get_rental, user_telegram_id, tzid)
+
+    async def record_rental_sms(self, tzid: int, sms_seen: int, jobs, run_at: float):
+        """Stores how many SMS of a rental were forwarded, together with the jobs forwarding them."""
+        await self._write(_record_rental_sms, tzid, sms_seen, list(jobs), run_at)
+
+    async def extend_rental(self, tzid: int, expires_at: float, hold_id: int) -> bool:
+        """
+        Moves an active rental's expiry to expires_at (Unix time) and captures the hold
+        that paid for the extension, adding it to the rental's cost.
+        Returns False if the rental is not active or the hold is no longer open.
+        """
+        try:
+            return await self._write(_extend_rental, tzid, expires_at, hold_id)
+        except sqlite3.Error as e:
+            logging.error(f"Error extending rental {tzid}: {e}")
+            return False
+
+    async def finish_rental(self, tzid: int, status: str, jobs, run_at: float, refund: int = 0) -> bool:
+        """
+        Closes an active rental ('finished', 'cancelled', 'expired') in one transaction with
+        its follow-up jobs and, for a cancelled rental, the refund to the user.
+        Returns False if the rental was already closed. Database errors are raised.
+        """
+        return await self._write(_finish_rental, tzid, status, list(jobs), run_at, refund)
+
+    async def get_purchase_history(self, user_telegram_id: int, limit: int = None):
+        """Retrieves purchase history for a user, newest first."""
+        return await self._read(_get_purchase_history, user_telegram_id, limit)
+
+    async def get_rental_history(self, user_telegram_id: int, limit: int = None):
+        """Retrieves rental history for a user, newest first."""
+        return await self._read(_get_rental_history, user_telegram_id, limit)
+
+    async def get_history_page(self, user_telegram_id: int, limit: int, before=None):
+        """
+        Returns one page of a user's purchases, rentals and balance transactions, newest first,
+        as (rows, next_cursor). Each row is (kind, created_at, title, detail, extra, amount).
+        Pass next_cursor as `before` to get the following page; it is None on the last page.
+        Every page is a few LIMITed index range scans, so it costs the same however long the history is.
+        """
+        return await self._read(_get_history_page, user_telegram_id, limit, before)
+
+    async def get_user_balance(self, user_telegram_id: int) -> int:
         """Retrieves a user's balance in the smallest currency unit."""
-        user_id = self.get_user_id(user_telegram_id)
-        if user_id:
-            self.cursor.execute("SELECT balance FROM users WHERE id = ?", (user_id,))
-            result = self.cursor.fetchone()
-            return result[0] if result else 0
-        return 0
+        return await self._read(_get_user_balance, user_telegram_id)
 
-    def create_transaction(self, user_telegram_id: int, amount: int, type: str, details: str = None) -> bool:
+    async def create_transaction(self, user_telegram_id: int, amount: int, type: str, details: str = None) -> bool:
         """
         Creates a transaction and updates the user's balance.
         Amount should be positive for deposits and negative for withdrawals.
         Returns True on success, False on failure (e.g., insufficient funds).
         """
-        user_id = self.get_user_id(user_telegram_id)
-        if not user_id:
+        try:
+            success = await self._write(_create_transaction, user_telegram_id, amount, type, details)
+        except sqlite3.Error as e:
+            logging.error(f"Transaction failed for user {user_telegram_id}: {e}")
             return False
 
-        try:
-            current_balance = self.get_user_balance(user_telegram_id)
+        if not success:
+            logging.warning(f"Insufficient funds for user {user_telegram_id} to perform transaction.")
+            return False
+        logging.info(f"Transaction successful for user {user_telegram_id}.")
+        return True
 
-            # For withdrawals, check for sufficient funds
-            if amount < 0 and current_balance < abs(amount):
-                logging.warning(f"Insufficient funds for user {user_telegram_id} to perform transaction.")
-                return False
+    # --- Balance holds ---
 
-            # Update balance
-            new_balance = current_balance + amount
-            self.cursor.execute("UPDATE users SET balance = ? WHERE id = ?", (new_balance, user_id))
+    async def reserve_funds(self, user_telegram_id: int, amount: int, details: str = None):
+        """
+        Moves `amount` from the user's balance into a new hold.
+        Returns the hold ID, or None if the user lacks funds.
+        """
+        try:
+            return await self._write(_reserve_funds, user_telegram_id, amount, details)
+        except sqlite3.Error as e:
+            logging.error(f"Could not reserve funds for user {user_telegram_id}: {e}")
+            return None
 
-            # Create transaction record
-            self.cursor.execute(
-                "INSERT INTO transactions (user_id, type, amount, details) VALUES (?, ?, ?, ?)",
-                (user_id, type, amount, details)
-            )
+    async def capture_hold(self, hold_id: int, amount: int = None) -> bool:
+        """
+        Charges `amount` (the whole hold by default) as a single purchase transaction
+        and returns whatever is left of the hold to the balance.
+        Returns False if the hold is already settled.
+        """
+        try:
+            return await self._write(_capture_hold, hold_id, amount)
+        except sqlite3.Error as e:
+            logging.error(f"Could not capture hold {hold_id}: {e}")
+            return False
 
-            self.conn.commit()
-            logging.info(f"Transaction successful for user {user_telegram_id}. New balance: {new_balance}")
-            return True
+    async def release_hold(self, hold_id: int, amount: int = None) -> bool:
+        """
+        Returns `amount` (the whole hold by default) to the user's balance.
+        A partial release keeps the rest of the hold open.
+        Returns False if the hold is already settled.
+        """
+        try:
+            return await self._write(_release_hold, hold_id, amount)
         except sqlite3.Error as e:
-            logging.error(f"Transaction failed for user {user_telegram_id}: {e}")
-            self.conn.rollback()
+            logging.error(f"Could not release hold {hold_id}: {e}")
             return False
 
-    def __del__(self):
-        """Closes the database connection on object deletion."""
-        if self.conn:
-            self.conn.close()
+    async def get_balance_details(self, user_telegram_id: int):
+        """Returns (available, held) for a user, in the smallest currency unit."""
+        return await self._read(_get_balance_details, user_telegram_id)
+
+    async def set_purchase_status(self, tzid: int, status: str, provider: str = 'sms_activate'):
+        """Updates the status of a logged purchase ('completed', 'cancelled', 'expired')."""
+        try:
+            await self._write(_set_purchase_status, tzid, status, provider)
+        except sqlite3.Error as e:
+            logging.error(f"Error updating purchase {tzid}: {e}")
+
+    async def finish_activation(self, provider: str, tzid: int, hold_id: int, status: str, jobs, run_at: float,
+                                sms_code: str = None) -> bool:
+        """
+        Finishes a purchase in one transaction: records the status (and code) and
+        enqueues the follow-up jobs. Once no purchase paid by the hold is active, the
+        hold is settled: the completed purchases are charged as one transaction and
+        the rest is returned. Returns False if the purchase was already finished.
+        Database errors are raised, so the caller can keep the activation and retry.
+        """
+        return await self._write(_finish_activation, provider, tzid, hold_id, status, list(jobs), run_at, sms_code)
+
+    async def get_known_activations(self, provider: str, tzids) -> set:
+        """
+        Returns which of a provider's activation IDs have a purchase record. Runs on
+        the writer, so purchases still queued for saving in this process count too.
+        """
+        return await self._write(_get_known_activations, provider, list(tzids))
+
+    async def get_active_purchases(self):
+        """
+        Returns (tzid, chat_id, hold_id, age_seconds, provider, service, country, message_id)
+        of every purchase still waiting for an SMS.
+        """
+        return await self._read(_get_active_purchases)
+
+    async def release_orphan_holds(self, min_age: int) -> int:
+        """
+        Releases the open holds older than min_age seconds that no active purchase owns,
+        i.e. those left behind by a process that stopped in the middle of a purchase.
+        Returns the number of holds released.
+        """
+        try:
+            return await self._write(_release_orphan_holds, min_age)
+        except sqlite3.Error as e:
+            logging.error(f"Could not release orphaned holds: {e}")
+            return 0
+
+    # --- Outbox ---
+
+    async def enqueue_jobs(self, jobs, run_at: float):
+        """Enqueues (kind, idempotency_key, payload) jobs; keys that were already enqueued are skipped."""
+        await self._write(_enqueue_jobs, list(jobs), run_at)
+
+    async def claim_jobs(self, now: float, limit: int, lease_until: float):
+        """
+        Returns up to `limit` due jobs as (id, kind, payload, attempts) and pushes their
+        next_run_at to lease_until, so a job whose worker dies is retried after the lease.
+        """
+        return await self._write(_claim_jobs, now, limit, lease_until)
+
+    async def settle_jobs(self, done_ids, retries, failures):
+        """
+        Records the outcome of a batch of jobs: done_ids finished, retries are
+        (id, next_run_at, error) and failures are (id, error) that won't be retried.
+        """
+        try:
+            await self._write(_settle_jobs, list(done_ids), list(retries), list(failures))
+        except sqlite3.Error as e:
+            logging.error(f"Error saving job results: {e}")
+
+    async def next_job_time(self):
+        """Returns when the earliest pending job is due (Unix time), or None."""
+        return await self._read(_next_job_time)
+
+    async def purge_jobs(self, days: int):
+        """Deletes jobs that finished more than `days` days ago."""
+        try:
+            await self._write(_purge_jobs, days)
+        except sqlite3.Error as e:
+            logging.error(f"Error purging finished jobs: {e}")
+
+    # --- Catalog ---
+
+    async def get_catalog(self):
+        """Returns the stored catalog as ([(id, rus, eng)], [(country_id, service, cost, count)])."""
+        return await self._read(_get_catalog)
+
+    async def get_catalog_version(self):
+        """Returns a value that changes whenever the stored catalog does."""
+        return await self._read(_get_catalog_version)
+
+    async def save_catalog_countries(self, countries, removed_ids):
+        """Upserts (id, rus, eng) countries and deletes the removed ones."""
+        try:
+            await self._write(_save_catalog_countries, list(countries), list(removed_ids))
+        except sqlite3.Error as e:
+            logging.error(f"Error saving catalog countries: {e}")
+
+    async def save_catalog_prices(self, prices, removed):
+        """Upserts (country_id, service, cost, count) prices and deletes the removed (country_id, service) ones."""
+        try:
+            await self._write(_save_catalog_prices, list(prices), list(removed))
+        except sqlite3.Error as e:
+            logging.error(f"Error saving catalog prices: {e}")
+
+    # --- Media ---
+
+    async def get_media_file_id(self, bot_id: int, content_hash: str):
+        """Returns the stored Telegram file_id for a file, or None."""
+        return await self._read(_get_media_file_id, bot_id, content_hash)
+
+    async def save_media_file_id(self, bot_id: int, content_hash: str, file_id: str):
+        """Remembers the Telegram file_id of an uploaded file."""
+        try:
+            await self._write(_save_media_file_id, bot_id, content_hash, file_id)
+        except sqlite3.Error as e:
+            logging.error(f"Error saving media file_id: {e}")
+
+    # --- User states ---
+
+    async def get_user_state(self, user_telegram_id: int, now: float):
+        """Returns the user's unexpired state dict, or None."""
+        return await self._read(_get_user_state, user_telegram_id, now)
+
+    async def set_user_state(self, user_telegram_id: int, data: dict, expires_at: float):
+        try:
+            await self._write(_set_user_state, user_telegram_id, json.dumps(data), expires_at)
+        except sqlite3.Error as e:
+            logging.error(f"Error saving state for user {user_telegram_id}: {e}")
+
+    async def delete_user_state(self, user_telegram_id: int):
+        try:
+            await self._write(_delete_user_state, user_telegram_id)
+        except sqlite3.Error as e:
+            logging.error(f"Error clearing state for user {user_telegram_id}: {e}")
+
+    async def purge_user_states(self, now: float):
+        """Deletes every expired state."""
+        try:
+            await self._write(_purge_user_states, now)
+        except sqlite3.Error as e:
+            logging.error(f"Error purging expired states: {e}")
+
+    # --- Broadcasts ---
+
+    async def create_broadcast(self, text: str) -> int:
+        """Creates a running broadcast and returns its ID."""
+        return await self._write(_create_broadcast, text)
+
+    async def get_running_broadcasts(self):
+        """Returns (id, text, last_user_id, sent, failed, blocked) of every unfinished broadcast."""
+        return await self._read(_get_running_broadcasts)
+
+    async def get_broadcast_status(self, broadcast_id: int):
+        return await self._read(_get_broadcast_status, broadcast_id)
+
+    async def get_broadcast_recipients(self, after_user_id: int, limit: int):
+        """
+        Returns the next (id, telegram_id) rows after after_user_id, in id order.
+        Keyset pagination: each chunk is an index range scan, however far the broadcast has got.
+        """
+        return await self._read(_get_broadcast_recipients, after_user_id, limit)
+
+    async def count_broadcast_recipients(self, after_user_id: int = 0) -> int:
+        return await self._read(_count_broadcast_recipients, after_user_id)
+
+    async def save_broadcast_progress(self, broadcast_id: int, last_user_id: int, sent: int, failed: int,
+                                      blocked: int, blocked_ids, status: str = 'running'):
+        """
+        Checkpoints a broadcast's counters and marks the users in blocked_ids as having
+        blocked the bot, in one transaction.
+        """
+        try:
+            await self._write(_save_broadcast_progress, broadcast_id, last_user_id, sent, failed, blocked,
+                              list(blocked_ids), status)
+        except sqlite3.Error as e:
+            logging.error(f"Error saving progress of broadcast {broadcast_id}: {e}")
+
+    async def set_broadcast_status(self, broadcast_id: int, status: str):
+        try:
+            await self._write(_set_broadcast_status, broadcast_id, status)
+        except sqlite3.Error as e:
+            logging.error(f"Error updating broadcast {broadcast_id}: {e}")
+
+    # --- Reports ---
+
+    async def get_revenue_report(self, since_day: str):
+        """Returns (type, amount, count) totals of the ledger from since_day (YYYY-MM-DD, UTC) on."""
+        return await self._read(_get_revenue_report, since_day)
+
+    async def get_daily_revenue(self, since_day: str):
+        """Returns (day, deposits, purchase_revenue, purchases) per day from since_day on."""
+        return await self._read(_get_daily_revenue, since_day)
+
+    async def get_purchase_breakdown(self, since_day: str, group_by: str, limit: int = 10):
+        """
+        Returns (key, purchases, completed, revenue) rows grouped by 'service' or 'country',
+        highest revenue first.
+        """
+        return await self._read(_get_purchase_breakdown, since_day, group_by, limit)
+
+
+# --- Statements ---
+# Each function receives a cursor and runs inside the caller's transaction.
+
+def _get_user_id(cursor, telegram_id):
+    cursor.execute("SELECT id FROM users WHERE telegram_id = ?", (telegram_id,))
+    result = cursor.fetchone()
+    return result[0] if result else None
+
+
+def _add_user(cursor, telegram_id, username, first_name, referred_by):
+    cursor.execute("INSERT OR IGNORE INTO users (telegram_id, username, first_name, referred_by) VALUES (?, ?, ?, ?)",
+                   (telegram_id, username, first_name, referred_by))
+    # A user who sends /start again has unblocked the bot
+    if cursor.rowcount == 0:
+        cursor.execute("UPDATE users SET blocked_at = NULL WHERE telegram_id = ? AND blocked_at IS NOT NULL",
+                       (telegram_id,))
+
+
+def _rollup_key(service, country) -> tuple:
+    """The (service, country) of a purchase's purchases_daily row; the rollup has no NULLs."""
+    return service or '', country or ''
+
+
+def _log_purchase(cursor, user_telegram_id, tzid, service, country, phone_number, cost, hold_id, chat_id, provider):
+    user_id = _get_user_id(cursor, user_telegram_id)
+    if not user_id:
+        raise sqlite3.IntegrityError(f"Unknown user {user_telegram_id}")
+    cursor.execute(
+        "INSERT INTO purchase_history (user_id, tzid, service, country, phone_number, status, cost, hold_id, chat_id, provider) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (user_id, tzid, service, country, phone_number, 'active', cost, hold_id, chat_id, provider)
+    )
+    cursor.execute(
+        "INSERT INTO purchases_daily (day, service, country, purchases) VALUES (date('now'), ?, ?, 1) "
+        "ON CONFLICT (day, service, country) DO UPDATE SET purchases = purchases + 1",
+        _rollup_key(service, country)
+    )
+
+
+def _log_purchases(cursor, user_telegram_id, numbers, service, country, cost, hold_id, chat_id, message_id):
+    user_id = _get_user_id(cursor, user_telegram_id)
+    if not user_id:
+        raise sqlite3.IntegrityError(f"Unknown user {user_telegram_id}")
+    cursor.executemany(
+        "INSERT INTO purchase_history (user_id, tzid, service, country, phone_number, status, cost, hold_id, chat_id, "
+        "provider, message_id) VALUES (?, ?, ?, ?, ?, 'active', ?, ?, ?, ?, ?)",
+        [(user_id, tzid, service, country, phone_number, cost, hold_id, chat_id, provider, message_id)
+         for tzid, provider, phone_number in numbers]
+    )
+    cursor.execute(
+        "INSERT INTO purchases_daily (day, service, country, purchases) VALUES (date('now'), ?, ?, ?) "
+        "ON CONFLICT (day, service, country) DO UPDATE SET purchases = purchases + excluded.purchases",
+        _rollup_key(service, country) + (len(numbers),)
+    )
+
+
+def _get_order_purchases(cursor, hold_id):
+    cursor.execute("SELECT phone_number, status, sms_code, cost FROM purchase_history WHERE hold_id = ? ORDER BY id",
+                   (hold_id,))
+    return cursor.fetchall()
+
+
+def _log_rental(cursor, user_telegram_id, tzid, service, country, phone_number, expires_at, cost, chat_id, hold_id):
+    user_id = _get_user_id(cursor, user_telegram_id)
+    if not user_id:
+        raise sqlite3.IntegrityError(f"Unknown user {user_telegram_id}")
+    cursor.execute(
+        "INSERT INTO rental_history (user_id, tzid, service, country, phone_number, expires_at, cost, chat_id, status) "
+        "VALUES (?, ?, ?, ?, ?, datetime(?, 'unixepoch'), ?, ?, 'active')",
+        (user_id, tzid, service, country, phone_number, expires_at, cost, chat_id)
+    )
+    if hold_id is not None:
+        _capture_hold(cursor, hold_id, None)
+
+
+def _get_active_rentals(cursor):
+    cursor.execute("SELECT tzid, chat_id, CAST(strftime('%s', expires_at) AS REAL), sms_seen, phone_number "
+                   "FROM rental_history WHERE status = 'active' AND chat_id IS NOT NULL")
+    return cursor.fetchall()
+
+
+def _get_user_rentals(cursor, user_telegram_id):
+    user_id = _get_user_id(cursor, user_telegram_id)
+    if not user_id:
+        return []
+    cursor.execute("SELECT tzid, service, phone_number, expires_at FROM rental_history "
+                   "WHERE user_id = ? AND status = 'active' ORDER BY expires_at", (user_id,))
+    return cursor.fetchall()
+
+
+def _get_rental(cursor, user_telegram_id, tzid):
+    cursor.execute(
+        "SELECT r.service, r.country, r.phone_number, r.expires_at, r.status, r.cost, "
+        "(julianday('now') - julianday(r.created_at)) * 86400, r.sms_seen "
+        "FROM rental_history r JOIN users u ON u.id = r.user_id WHERE u.telegram_id = ? AND r.tzid = ?",
+        (user_telegram_id, tzid)
+    )
+    return cursor.fetchone()
+
+
+def _record_rental_sms(cursor, tzid, sms_seen, jobs, run_at):
+    cursor.execute("UPDATE rental_history SET sms_seen = ? WHERE tzid = ? AND sms_seen < ?", (sms_seen, tzid, sms_seen))
+    if cursor.rowcount:
+        _enqueue_jobs(cursor, jobs, run_at)
+
+
+def _extend_rental(cursor, tzid, expires_at, hold_id):
+    hold = _open_hold(cursor, hold_id)
+    if hold is None:
+        # Released or swept meanwhile: nothing would pay for the extension
+        return False
+    cursor.execute("UPDATE rental_history SET expires_at = datetime(?, 'unixepoch'), cost = COALESCE(cost, 0) + ? "
+                   "WHERE tzid = ? AND status = 'active'", (expires_at, hold[1], tzid))
+    if cursor.rowcount == 0:
+        return False
+    _capture_hold(cursor, hold_id, None)
+    return True
+
+
+def _finish_rental(cursor, tzid, status, jobs, run_at, refund):
+    cursor.execute("UPDATE rental_history SET status = ? WHERE tzid = ? AND status = 'active'", (status, tzid))
+    if cursor.rowcount == 0:
+        return False
+    if refund:
+        cursor.execute("SELECT u.telegram_id, r.phone_number FROM rental_history r JOIN users u ON u.id = r.user_id "
+                       "WHERE r.tzid = ?", (tzid,))
+        user_telegram_id, phone_number = cursor.fetchone()
+        _create_transaction(cursor, user_telegram_id, refund, 'refund', f"Отмена аренды {phone_number}")
+    _enqueue_jobs(cursor, jobs, run_at)
+    return True
+
+
+def _get_purchase_history(cursor, user_telegram_id, limit):
+    user_id = _get_user_id(cursor, user_telegram_id)
+    if user_id:
+        cursor.execute("SELECT service, phone_number, created_at FROM purchase_history WHERE user_id = ? "
+                       "ORDER BY created_at DESC LIMIT ?", (user_id, -1 if limit is None else limit))
+        return cursor.fetchall()
+    return []
+
+
+def _get_rental_history(cursor, user_telegram_id, limit):
+    user_id = _get_user_id(cursor, user_telegram_id)
+    if user_id:
+        cursor.execute("SELECT service, phone_number, expires_at FROM rental_history WHERE user_id = ? "
+                       "ORDER BY created_at DESC LIMIT ?", (user_id, -1 if limit is None else limit))
+        return cursor.fetchall()
+    return []
+
+
+# The sources merged into the history, with the rank that orders rows sharing a timestamp.
+# Each query selects (kind, id, created_at, title, detail, extra, amount).
+_HISTORY_SOURCES = (
+    (3, "SELECT 'purchase', id, created_at, service, phone_number, status, NULL FROM purchase_history"),
+    (2, "SELECT 'rental', id, created_at, service, phone_number, expires_at, NULL FROM rental_history"),
+    (1, "SELECT 'transaction', id, created_at, type, details, NULL, amount FROM transactions"),
+)
+
+
+def _get_history_page(cursor, user_telegram_id, limit, before):
+    """
+    Keyset pagination over the merged history, ordered by (created_at, rank, id) descending.
+    `before` is that key of the last row already shown. Each source reads at most
+    limit + 1 rows past it from its (user_id, created_at) index; one extra row tells
+    whether another page exists.
+    """
+    user_id = _get_user_id(cursor, user_telegram_id)
+    if not user_id:
+        return [], None
+
+    candidates = []
+    for rank, select in _HISTORY_SOURCES:
+        where, params = "user_id = ?", [user_id]
+        if before is not None:
+            created_at, before_rank, before_id = before
+            if rank > before_rank:
+                where += " AND created_at < ?"
+                params.append(created_at)
+            elif rank == before_rank:
+                where += " AND (created_at < ? OR (created_at = ? AND id < ?))"
+                params += [created_at, created_at, before_id]
+            else:
+                where += " AND created_at <= ?"
+                params.append(created_at)
+        cursor.execute(f"{select} WHERE {where} ORDER BY created_at DESC, id DESC LIMIT ?", (*params, limit + 1))
+        candidates.extend(((row[2], rank, row[1]), row) for row in cursor.fetchall())
+
+    candidates.sort(key=lambda candidate: candidate[0], reverse=True)
+    page = candidates[:limit]
+    next_cursor = page[-1][0] if len(candidates) > limit else None
+    rows = [(kind, created_at, title, detail, extra, amount)
+            for _, (kind, _id, created_at, title, detail, extra, amount) in page]
+    return rows, next_cursor
+
+
+def _get_user_balance(cursor, user_telegram_id):
+    cursor.execute("SELECT balance FROM users WHERE telegram_id = ?", (user_telegram_id,))
+    result = cursor.fetchone()
+    return result[0] if result else 0
+
+
+def _create_transaction(cursor, user_telegram_id, amount, type, details):
+    """Returns False if the user is missing or lacks funds."""
+    # The balance check is part of the UPDATE, so concurrent withdrawals can't overdraw
+    cursor.execute("UPDATE users SET balance = balance + ? WHERE telegram_id = ? AND balance + ? >= 0",
+                   (amount, user_telegram_id, amount))
+    if cursor.rowcount == 0:
+        return False
+
+    # Create transaction record
+    cursor.execute(
+        "INSERT INTO transactions (user_id, type, amount, details) SELECT id, ?, ?, ? FROM users WHERE telegram_id = ?",
+        (type, amount, details, user_telegram_id)
+    )
+    _add_to_revenue(cursor, type, amount)
+    return True
+
+
+def _add_to_revenue(cursor, type, amount):
+    cursor.execute(
+        "INSERT INTO revenue_daily (day, type, amount, count) VALUES (date('now'), ?, ?, 1) "
+        "ON CONFLICT (day, type) DO UPDATE SET amount = amount + excluded.amount, count = count + 1",
+        (type, amount)
+    )
+
+
+def _reserve_funds(cursor, user_telegram_id, amount, details):
+    cursor.execute("UPDATE users SET balance = balance - ?, held = held + ? WHERE telegram_id = ? AND balance >= ?",
+                   (amount, amount, user_telegram_id, amount))
+    if cursor.rowcount == 0:
+        return None
+    cursor.execute("INSERT INTO holds (user_id, amount, details) SELECT id, ?, ? FROM users WHERE telegram_id = ?",
+                   (amount, details, user_telegram_id))
+    return cursor.lastrowid
+
+
+def _open_hold(cursor, hold_id):
+    cursor.execute("SELECT user_id, amount, details FROM holds WHERE id = ? AND status = 'held'", (hold_id,))
+    return cursor.fetchone()
+
+
+def _capture_hold(cursor, hold_id, amount):
+    hold = _open_hold(cursor, hold_id)
+    if hold is None:
+        return False
+    user_id, held, details = hold
+    charged = held if amount is None else min(amount, held)
+
+    cursor.execute("UPDATE holds SET status = 'captured', amount = ?, settled_at = CURRENT_TIMESTAMP WHERE id = ?",
+                   (charged, hold_id))
+    cursor.execute("UPDATE users SET held = held - ?, balance = balance + ? WHERE id = ?",
+                   (held, held - charged, user_id))
+    if charged:
+        cursor.execute("INSERT INTO transactions (user_id, type, amount, details) VALUES (?, ?, ?, ?)",
+                       (user_id, 'purchase', -charged, details))
+        _add_to_revenue(cursor, 'purchase', -charged)
+    return True
+
+
+def _release_hold(cursor, hold_id, amount):
+    hold = _open_hold(cursor, hold_id)
+    if hold is None:
+        return False
+    user_id, held, _ = hold
+    released = held if amount is None else min(amount, held)
+
+    if released == held:
+        cursor.execute("UPDATE holds SET status = 'released', amount = 0, settled_at = CURRENT_TIMESTAMP WHERE id = ?",
+                       (hold_id,))
+    else:
+        cursor.execute("UPDATE holds SET amount = amount - ? WHERE id = ?", (released, hold_id))
+    cursor.execute("UPDATE users SET held = held - ?, balance = balance + ? WHERE id = ?",
+                   (released, released, user_id))
+    return True
+
+
+def _get_balance_details(cursor, user_telegram_id):
+    cursor.execute("SELECT balance, held FROM users WHERE telegram_id = ?", (user_telegram_id,))
+    result = cursor.fetchone()
+    return (result[0], result[1] or 0) if result else (0, 0)
+
+
+def _set_purchase_status(cursor, tzid, status, provider):
+    cursor.execute("SELECT service, country, cost, date(created_at), status FROM purchase_history "
+                   "WHERE tzid = ? AND provider = ?", (tzid, provider))
+    purchase = cursor.fetchone()
+    cursor.execute("UPDATE purchase_history SET status = ? WHERE tzid = ? AND provider = ?", (status, tzid, provider))
+    if purchase and status == 'completed' and purchase[4] != 'completed':
+        service, country, cost, day, _ = purchase
+        cursor.execute(
+            "UPDATE purchases_daily SET completed = completed + 1, revenue = revenue + ? "
+            "WHERE day = ? AND service = ? AND country = ?",
+            (cost or 0, day) + _rollup_key(service, country)
+        )
+
+
+def _finish_activation(cursor, provider, tzid, hold_id, status, jobs, run_at, sms_code):
+    cursor.execute("SELECT status FROM purchase_history WHERE tzid = ? AND provider = ?", (tzid, provider))
+    purchase = cursor.fetchone()
+    if purchase is not None and purchase[0] != 'active':
+        return False
+    _set_purchase_status(cursor, tzid, status, provider)
+    if sms_code is not None:
+        cursor.execute("UPDATE purchase_history SET sms_code = ? WHERE tzid = ? AND provider = ?", (sms_code, tzid, provider))
+    if purchase is None:
+        # Not logged: the hold paid for this activation alone
+        if status == 'completed':
+            _capture_hold(cursor, hold_id, None)
+        else:
+            _release_hold(cursor, hold_id, None)
+    else:
+        _settle_purchase_hold(cursor, hold_id)
+    _enqueue_jobs(cursor, jobs, run_at)
+    return True
+
+
+def _settle_purchase_hold(cursor, hold_id):
+    """Charges the completed purchases of a hold once none of them is active, and returns the rest."""
+    cursor.execute("SELECT COUNT(*) FROM purchase_history WHERE hold_id = ? AND status = 'active'", (hold_id,))
+    if cursor.fetchone()[0]:
+        return
+    cursor.execute("SELECT COUNT(*), SUM(cost) FROM purchase_history WHERE hold_id = ? AND status = 'completed'",
+                   (hold_id,))
+    completed, charged = cursor.fetchone()
+    if completed:
+        # Purchases logged without a cost were paid by the whole hold
+        _capture_hold(cursor, hold_id, charged)
+    else:
+        _release_hold(cursor, hold_id, None)
+
+
+def _get_known_activations(cursor, provider, tzids):
+    known = set()
+    # Stay under SQLite's limit on bound parameters
+    for i in range(0, len(tzids), 500):
+        chunk = tzids[i:i + 500]
+        cursor.execute(
+            f"SELECT tzid FROM purchase_history WHERE provider = ? AND tzid IN ({', '.join('?' * len(chunk))})",
+            [provider] + chunk
+        )
+        known.update(row[0] for row in cursor.fetchall())
+    return known
+
+
+def _get_active_purchases(cursor):
+    cursor.execute(
+        "SELECT tzid, chat_id, hold_id, (julianday('now') - julianday(created_at)) * 86400, provider, service, country, "
+        "message_id FROM purchase_history WHERE status = 'active' AND hold_id IS NOT NULL"
+    )
+    return cursor.fetchall()
+
+
+def _release_orphan_holds(cursor, min_age):
+    cursor.execute(
+        "SELECT id FROM holds WHERE status = 'held' AND created_at < datetime('now', ?) "
+        "AND id NOT IN (SELECT hold_id FROM purchase_history WHERE status = 'active' AND hold_id IS NOT NULL)",
+        (f"-{int(min_age)} seconds",)
+    )
+    hold_ids = [row[0] for row in cursor.fetchall()]
+    for hold_id in hold_ids:
+        _release_hold(cursor, hold_id, None)
+    return len(hold_ids)
+
+
+def _enqueue_jobs(cursor, jobs, run_at):
+    cursor.executemany(
+        "INSERT OR IGNORE INTO jobs (kind, idempotency_key, payload, next_run_at) VALUES (?, ?, ?, ?)",
+        [(kind, key, json.dumps(payload), run_at) for kind, key, payload in jobs]
+    )
+
+
+def _claim_jobs(cursor, now, limit, lease_until):
+    cursor.execute("SELECT id, kind, payload, attempts FROM jobs WHERE status = 'pending' AND next_run_at <= ? "
+                   "ORDER BY next_run_at LIMIT ?", (now, limit))
+    rows = cursor.fetchall()
+    cursor.executemany("UPDATE jobs SET next_run_at = ?, attempts = attempts + 1 WHERE id = ?",
+                       [(lease_until, row[0]) for row in rows])
+    return [(job_id, kind, json.loads(payload), attempts + 1) for job_id, kind, payload, attempts in rows]
+
+
+def _settle_jobs(cursor, done_ids, retries, failures):
+    cursor.executemany("UPDATE jobs SET status = 'done', last_error = NULL, finished_at = CURRENT_TIMESTAMP WHERE id = ?",
+                       [(job_id,) for job_id in done_ids])
+    cursor.executemany("UPDATE jobs SET next_run_at = ?, last_error = ? WHERE id = ?",
+                       [(next_run_at, error, job_id) for job_id, next_run_at, error in retries])
+    cursor.executemany("UPDATE jobs SET status = 'failed', last_error = ?, finished_at = CURRENT_TIMESTAMP WHERE id = ?",
+                       [(error, job_id) for job_id, error in failures])
+
+
+def _next_job_time(cursor):
+    cursor.execute("SELECT MIN(next_run_at) FROM jobs WHERE status = 'pending'")
+    return cursor.fetchone()[0]
+
+
+def _purge_jobs(cursor, days):
+    cursor.execute("DELETE FROM jobs WHERE status = 'done' AND finished_at < datetime('now', ?)", (f"-{int(days)} days",))
+
+
+def _settle(future: Future, result, error):
+    """Completes a write's future, unless its caller has given up on it."""
+    try:
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+    except InvalidStateError:
+        pass
+
+
+def _update_statistics(cursor):
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'")
+    cursor.execute("ANALYZE" if cursor.fetchone() is None else "PRAGMA optimize")
+
+
+def _get_catalog(cursor):
+    cursor.execute("SELECT id, rus, eng FROM catalog_countries")
+    countries = cursor.fetchall()
+    cursor.execute("SELECT country_id, service, cost, count FROM catalog_prices")
+    return countries, cursor.fetchall()
+
+
+def _get_catalog_version(cursor):
+    cursor.execute(
+        "SELECT (SELECT count(*) FROM catalog_countries), count(*), max(updated_at), total(cost) "
+        "FROM catalog_prices"
+    )
+    return cursor.fetchone()
+
+
+def _save_catalog_countries(cursor, countries, removed_ids):
+    cursor.executemany(
+        "INSERT INTO catalog_countries (id, rus, eng) VALUES (?, ?, ?) "
+        "ON CONFLICT (id) DO UPDATE SET rus = excluded.rus, eng = excluded.eng",
+        countries
+    )
+    cursor.executemany("DELETE FROM catalog_countries WHERE id = ?", [(country_id,) for country_id in removed_ids])
+
+
+def _save_catalog_prices(cursor, prices, removed):
+    cursor.executemany(
+        "INSERT INTO catalog_prices (country_id, service, cost, count) VALUES (?, ?, ?, ?) "
+        "ON CONFLICT (country_id, service) DO UPDATE SET cost = excluded.cost, count = excluded.count, "
+        "updated_at = CURRENT_TIMESTAMP",
+        prices
+    )
+    cursor.executemany("DELETE FROM catalog_prices WHERE country_id = ? AND service = ?", removed)
+
+
+def _get_media_file_id(cursor, bot_id, content_hash):
+    cursor.execute("SELECT file_id FROM media_cache WHERE bot_id = ? AND content_hash = ?", (bot_id, content_hash))
+    result = cursor.fetchone()
+    return result[0] if result else None
+
+
+def _save_media_file_id(cursor, bot_id, content_hash, file_id):
+    cursor.execute("INSERT OR REPLACE INTO media_cache (bot_id, content_hash, file_id) VALUES (?, ?, ?)",
+                   (bot_id, content_hash, file_id))
+
+
+def _get_user_state(cursor, user_telegram_id, now):
+    cursor.execute("SELECT data FROM user_states WHERE user_id = ? AND expires_at > ?", (user_telegram_id, now))
+    result = cursor.fetchone()
+    return json.loads(result[0]) if result else None
+
+
+def _set_user_state(cursor, user_telegram_id, data, expires_at):
+    cursor.execute("INSERT OR REPLACE INTO user_states (user_id, data, expires_at) VALUES (?, ?, ?)",
+                   (user_telegram_id, data, expires_at))
+
+
+def _delete_user_state(cursor, user_telegram_id):
+    cursor.execute("DELETE FROM user_states WHERE user_id = ?", (user_telegram_id,))
+
+
+def _purge_user_states(cursor, now):
+    cursor.execute("DELETE FROM user_states WHERE expires_at <= ?", (now,))
+
+
+def _create_broadcast(cursor, text):
+    cursor.execute("INSERT INTO broadcasts (text) VALUES (?)", (text,))
+    return cursor.lastrowid
+
+
+def _get_running_broadcasts(cursor):
+    cursor.execute("SELECT id, text, last_user_id, sent, failed, blocked FROM broadcasts WHERE status = 'running' ORDER BY id")
+    return cursor.fetchall()
+
+
+def _get_broadcast_status(cursor, broadcast_id):
+    cursor.execute("SELECT status FROM broadcasts WHERE id = ?", (broadcast_id,))
+    result = cursor.fetchone()
+    return result[0] if result else None
+
+
+def _get_broadcast_recipients(cursor, after_user_id, limit):
+    cursor.execute("SELECT id, telegram_id FROM users WHERE id > ? AND blocked_at IS NULL ORDER BY id LIMIT ?",
+                   (after_user_id, limit))
+    return cursor.fetchall()
+
+
+def _count_broadcast_recipients(cursor, after_user_id):
+    cursor.execute("SELECT COUNT(*) FROM users WHERE id > ? AND blocked_at IS NULL", (after_user_id,))
+    return cursor.fetchone()[0]
+
+
+def _save_broadcast_progress(cursor, broadcast_id, last_user_id, sent, failed, blocked, blocked_ids, status):
+    if blocked_ids:
+        cursor.executemany("UPDATE users SET blocked_at = CURRENT_TIMESTAMP WHERE telegram_id = ?",
+                           [(telegram_id,) for telegram_id in blocked_ids])
+    # A cancelled broadcast stays cancelled even if a chunk was still in flight
+    cursor.execute(
+        "UPDATE broadcasts SET last_user_id = ?, sent = ?, failed = ?, blocked = ?, status = ?, "
+        "finished_at = CASE WHEN ? = 'running' THEN NULL ELSE CURRENT_TIMESTAMP END "
+        "WHERE id = ? AND status = 'running'",
+        (last_user_id, sent, failed, blocked, status, status, broadcast_id)
+    )
+
+
+def _set_broadcast_status(cursor, broadcast_id, status):
+    cursor.execute("UPDATE broadcasts SET status = ?, finished_at = CURRENT_TIMESTAMP WHERE id = ? AND status = 'running'",
+                   (status, broadcast_id))
+
+
+def _rebuild_rollups(cursor):
+    """Fills the report rollups from the full ledger; used once, when they are first created."""
+    cursor.execute("DELETE FROM revenue_daily")
+    cursor.execute("INSERT INTO revenue_daily (day, type, amount, count) "
+                   "SELECT date(created_at), type, SUM(amount), COUNT(*) FROM transactions GROUP BY 1, 2")
+    cursor.execute("DELETE FROM purchases_daily")
+    cursor.execute(
+        "INSERT INTO purchases_daily (day, service, country, purchases, completed, revenue) "
+        "SELECT date(created_at), COALESCE(service, ''), COALESCE(country, ''), COUNT(*), "
+        "SUM(status = 'completed'), SUM(CASE WHEN status = 'completed' THEN COALESCE(cost, 0) ELSE 0 END) "
+        "FROM purchase_history GROUP BY 1, 2, 3"
+    )
+
+
+def _get_revenue_report(cursor, since_day):
+    cursor.execute("SELECT type, SUM(amount), SUM(count) FROM revenue_daily WHERE day >= ? GROUP BY type ORDER BY type",
+                   (since_day,))
+    return cursor.fetchall()
+
+
+def _get_daily_revenue(cursor, since_day):
+    cursor.execute(
+        "SELECT day, SUM(CASE WHEN type = 'deposit' THEN amount ELSE 0 END), "
+        "-SUM(CASE WHEN type = 'purchase' THEN amount ELSE 0 END), "
+        "SUM(CASE WHEN type = 'purchase' THEN count ELSE 0 END) "
+        "FROM revenue_daily WHERE day >= ? GROUP BY day ORDER BY day",
+        (since_day,)
+    )
+    return cursor.fetchall()
+
+
+def _get_purchase_breakdown(cursor, since_day, group_by, limit):
+    column = {'service': 'service', 'country': 'country'}[group_by]
+    cursor.execute(
+        f"SELECT {column}, SUM(purchases), SUM(completed), SUM(revenue) FROM purchases_daily "
+        f"WHERE day >= ? GROUP BY {column} ORDER BY SUM(revenue) DESC, SUM(purchases) DESC LIMIT ?",
+        (since_day, limit)
+    )
+    return cursor.fetchall()
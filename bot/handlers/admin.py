@@ -1,10 +1,17 @@
 import logging
+from datetime import datetime, timedelta, timezone
 from aiogram import Dispatcher, types
+from aiogram.dispatcher.filters import BoundFilter
+from bot.broadcast import Broadcaster
+from bot.catalog import Catalog, SERVICE_NAME_MAP
 from bot.db import Database
+from bot import metrics
+from bot.router import ProviderRouter
+from bot.sender import sender
 from config import ADMIN_ID
 
 # We need to define a filter for the admin
-class AdminFilter(types.BoundFilter):
+class AdminFilter(BoundFilter):
     key = 'is_admin'
 
     def __init__(self, is_admin: bool):
@@ -28,10 +35,10 @@ async def credit_handler(message: types.Message, db: Database):
         amount_kopecks = int(amount_rub * 100)
 
         if amount_kopecks <= 0:
-            await message.answer("Сумма должна быть положительной.")
+            await sender.answer(message, "Сумма должна быть положительной.")
             return
 
-        success = db.create_transaction(
+        success = await db.create_transaction(
             user_telegram_id=user_id,
             amount=amount_kopecks,
             type='deposit',
@@ -39,23 +46,24 @@ async def credit_handler(message: types.Message, db: Database):
         )
 
         if success:
-            await message.answer(f"Баланс пользователя {user_id} успешно пополнен на {amount_rub:.2f} RUB.")
+            await sender.answer(message, f"Баланс пользователя {user_id} успешно пополнен на {amount_rub:.2f} RUB.")
             try:
                 # Using message.bot to send message to another user
-                await message.bot.send_message(
+                await sender.send_message(
+                    message.bot,
                     user_id,
                     f"Ваш баланс был пополнен на **{amount_rub:.2f} RUB**."
                 )
             except Exception as e:
-                await message.answer(f"Не удалось уведомить пользователя {user_id} (возможно, он заблокировал бота). Ошибка: {e}")
+                await sender.answer(message, f"Не удалось уведомить пользователя {user_id} (возможно, он заблокировал бота). Ошибка: {e}")
         else:
-            await message.answer(f"Не удалось пополнить баланс пользователя {user_id}. Проверьте логи.")
+            await sender.answer(message, f"Не удалось пополнить баланс пользователя {user_id}. Проверьте логи.")
 
     except (ValueError, IndexError):
-        await message.answer("Неверный формат. Используйте: `/credit <user_id> <сумма>`")
+        await sender.answer(message, "Неверный формат. Используйте: `/credit <user_id> <сумма>`")
     except Exception as e:
         logging.error(f"Ошибка в команде /credit: {e}")
-        await message.answer(f"Произошла ошибка: {e}")
+        await sender.answer(message, f"Произошла ошибка: {e}")
 
 async def check_balance_handler(message: types.Message, db: Database):
     """
@@ -68,18 +76,174 @@ async def check_balance_handler(message: types.Message, db: Database):
             raise ValueError("Invalid number of arguments")
 
         user_id = int(args[0])
-        balance_kopecks = db.get_user_balance(user_id)
-        balance_rub = balance_kopecks / 100.0
+        available_kopecks, held_kopecks = await db.get_balance_details(user_id)
 
-        await message.answer(f"Баланс пользователя `{user_id}`: **{balance_rub:.2f} RUB**.")
+        await sender.answer(
+            message,
+            f"Баланс пользователя `{user_id}`: **{available_kopecks / 100.0:.2f} RUB**, "
+            f"в резерве: **{held_kopecks / 100.0:.2f} RUB**."
+        )
 
     except (ValueError, IndexError):
-        await message.answer("Неверный формат. Используйте: `/user_balance <user_id>`")
+        await sender.answer(message, "Неверный формат. Используйте: `/user_balance <user_id>`")
     except Exception as e:
         logging.error(f"Ошибка в команде /user_balance: {e}")
-        await message.answer(f"Произошла ошибка: {e}")
+        await sender.answer(message, f"Произошла ошибка: {e}")
+
+async def cache_stats_handler(message: types.Message, catalog: Catalog):
+    """
+    Shows the price catalog cache counters.
+    Usage: /cache_stats
+    """
+    stats = catalog.get_stats()
+    await sender.answer(
+        message,
+        "**Каталог цен**\n\n"
+        f"Версия: {stats['version']}\n"
+        f"Стран в кэше: {stats['countries_cached']}\n"
+        f"Попадания: {stats['hits']}, устаревшие: {stats['stale_hits']}, промахи: {stats['misses']}\n"
+        f"Доля попаданий: {stats['hit_rate']:.1%}\n"
+        f"Обновления: {stats['refreshes']}, ошибки: {stats['errors']}"
+    )
+
+async def sender_stats_handler(message: types.Message):
+    """
+    Shows the outgoing message queue counters.
+    Usage: /sender_stats
+    """
+    stats = sender.get_stats()
+    lines = [
+        "**Очередь отправки**\n",
+        f"В очереди: {stats['queue_depth']}, чатов с лимитом: {stats['chats_tracked']}",
+        f"Отправлено: {stats['sent']}, ошибки: {stats['failed']}",
+        f"Повторы после flood control: {stats['retried']}, объединено правок: {stats['coalesced']}",
+    ]
+    for lane in ('high', 'normal', 'low', 'bulk'):
+        if f'{lane}_p50_ms' in stats:
+            lines.append(f"Задержка {lane}: p50 {stats[f'{lane}_p50_ms']} мс, p95 {stats[f'{lane}_p95_ms']} мс")
+    await sender.answer(message, "\n".join(lines))
+
+async def routes_handler(message: types.Message, router: ProviderRouter):
+    """
+    Shows the delivery statistics the purchases are routed by, busiest routes first.
+    Usage: /routes
+    """
+    rows = router.get_stats(20)
+    lines = [f"**Провайдеры:** {', '.join(router.providers)}\n"]
+    if not rows:
+        lines.append("Статистики доставки пока нет.")
+    for provider, country, service, count, success_rate, mean_time in rows:
+        lines.append(f"`{provider}` {SERVICE_NAME_MAP.get(service, service)}, страна {country}: "
+                     f"{success_rate:.0%} успешных, СМС за {mean_time:.0f} с ({count})")
+    await sender.answer(message, "\n".join(lines))
+
+def _format_latency_rows(title: str, histogram: metrics.Histogram, limit: int) -> list:
+    lines = [f"**{title}** (p50 / p95 / p99, мс):"]
+    rows = metrics.summary(histogram, limit)
+    if not rows:
+        lines.append("нет данных")
+    for label, count, p50, p95, p99 in rows:
+        lines.append(f"`{label}`: {p50 * 1000:.1f} / {p95 * 1000:.1f} / {p99 * 1000:.1f} ({count})")
+    return lines
+
+async def stats_handler(message: types.Message):
+    """
+    Summarizes handler, SMS-Activate and database latencies, slowest first.
+    Usage: /stats
+    """
+    lines = _format_latency_rows("Обработчики", metrics.HANDLER_LATENCY, 10) + [""]
+    lines += _format_latency_rows("SMS-Activate", metrics.API_LATENCY, 10) + [""]
+    lines += _format_latency_rows("База данных", metrics.DB_LATENCY, 10) + [""]
+    errors = {
+        "обработчиков": sum(s.value for s in metrics.HANDLER_ERRORS.series().values()),
+        "SMS-Activate": sum(s.value for s in metrics.API_ERRORS.series().values()),
+        "базы данных": sum(s.value for s in metrics.DB_ERRORS.series().values()),
+    }
+    lines.append("Ошибки: " + ", ".join(f"{name} {count}" for name, count in errors.items()))
+    for gauge in metrics.REGISTRY.metrics.values():
+        if isinstance(gauge, metrics.Gauge):
+            value = gauge.value()
+            if value is not None:
+                lines.append(f"`{gauge.name}`: {value:.3g}")
+    await sender.answer(message, "\n".join(lines))
+
+# /report periods: name -> (days covered, title)
+REPORT_PERIODS = {'day': (1, "сегодня"), 'week': (7, "за 7 дней"), 'month': (30, "за 30 дней")}
+TRANSACTION_TYPE_NAMES = {'deposit': "Пополнения", 'purchase': "Списания за номера", 'refund': "Возвраты"}
+
+async def report_handler(message: types.Message, db: Database, catalog: Catalog):
+    """
+    Shows sales figures from the daily rollups.
+    Usage: /report [day|week|month]
+    """
+    period = message.get_args().strip() or 'day'
+    if period not in REPORT_PERIODS:
+        await sender.answer(message, "Неверный формат. Используйте: `/report [day|week|month]`")
+        return
+    days, title = REPORT_PERIODS[period]
+    # Rollup days are UTC dates, like the ledger's timestamps
+    since_day = (datetime.now(timezone.utc).date() - timedelta(days=days - 1)).isoformat()
+
+    lines = [f"**Отчет {title}** (с {since_day}, UTC)\n"]
+    totals = await db.get_revenue_report(since_day)
+    if not totals:
+        lines.append("Операций не было.")
+    for type, amount, count in totals:
+        lines.append(f"{TRANSACTION_TYPE_NAMES.get(type, type)}: {abs(amount) / 100.0:.2f} RUB ({count})")
+
+    if days > 1:
+        lines.append("\n**По дням** (пополнения / выручка / покупки):")
+        for day, deposits, revenue, purchases in await db.get_daily_revenue(since_day):
+            lines.append(f"{day}: {deposits / 100.0:.2f} / {revenue / 100.0:.2f} / {purchases}")
+
+    country_names = {str(c.id): c.rus for c in catalog.cached_countries()}
+    for group_by, heading, name_of in (
+        ('service', "Сервисы", lambda key: SERVICE_NAME_MAP.get(key, key)),
+        ('country', "Страны", lambda key: country_names.get(key, key)),
+    ):
+        rows = await db.get_purchase_breakdown(since_day, group_by)
+        if rows:
+            lines.append(f"\n**{heading}** (выручка, выполнено / куплено):")
+            for key, purchases, completed, revenue in rows:
+                lines.append(f"{name_of(key)}: {revenue / 100.0:.2f} RUB, {completed} / {purchases}")
+    await sender.answer(message, "\n".join(lines))
+
+async def broadcast_handler(message: types.Message, broadcaster: Broadcaster):
+    """
+    Sends a message to every user of the bot.
+    Usage: /broadcast <текст>
+    """
+    text = message.get_args()
+    if not text:
+        await sender.answer(message, "Неверный формат. Используйте: `/broadcast <текст>`")
+        return
+    broadcast_id = await broadcaster.start_broadcast(text)
+    await sender.answer(message, f"Рассылка #{broadcast_id} поставлена в очередь. Отменить: `/broadcast_cancel {broadcast_id}`")
+
+async def broadcast_cancel_handler(message: types.Message, broadcaster: Broadcaster):
+    """
+    Cancels a running broadcast.
+    Usage: /broadcast_cancel <id>
+    """
+    try:
+        broadcast_id = int(message.get_args())
+    except ValueError:
+        await sender.answer(message, "Неверный формат. Используйте: `/broadcast_cancel <id>`")
+        return
+    if await broadcaster.cancel(broadcast_id):
+        await sender.answer(message, f"Рассылка #{broadcast_id} отменена.")
+    else:
+        await sender.answer(message, f"Рассылка #{broadcast_id} не выполняется.")
 
-def register_admin_handlers(dp: Dispatcher, db: Database):
+def register_admin_handlers(dp: Dispatcher, db: Database, catalog: Catalog, broadcaster: Broadcaster,
+                            router: ProviderRouter):
     dp.filters_factory.bind(AdminFilter)
-    dp.register_message_handler(credit_handler, commands=['credit'], is_admin=True, state="*")
-    dp.register_message_handler(check_balance_handler, commands=['user_balance'], is_admin=True, state="*")
+    dp.register_message_handler(lambda msg: credit_handler(msg, db), commands=['credit'], is_admin=True, state="*")
+    dp.register_message_handler(lambda msg: check_balance_handler(msg, db), commands=['user_balance'], is_admin=True, state="*")
+    dp.register_message_handler(lambda msg: cache_stats_handler(msg, catalog), commands=['cache_stats'], is_admin=True, state="*")
+    dp.register_message_handler(lambda msg: report_handler(msg, db, catalog), commands=['report'], is_admin=True, state="*")
+    dp.register_message_handler(stats_handler, commands=['stats'], is_admin=True, state="*")
+    dp.register_message_handler(sender_stats_handler, commands=['sender_stats'], is_admin=True, state="*")
+    dp.register_message_handler(lambda msg: routes_handler(msg, router), commands=['routes'], is_admin=True, state="*")
+    dp.register_message_handler(lambda msg: broadcast_handler(msg, broadcaster), commands=['broadcast'], is_admin=True, state="*")
+    dp.register_message_handler(lambda msg: broadcast_cancel_handler(msg, broadcaster), commands=['broadcast_cancel'], is_admin=True, state="*")
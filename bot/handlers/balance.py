@@ -1,13 +1,15 @@
 import logging
 from aiogram import Dispatcher, types
-from aiogram.dispatcher.filters import Text
+from aiogram.dispatcher.filters import BoundFilter
+from bot import callbacks
 from bot.api import SmsActivateWrapper
 from bot.db import Database
 from bot.keyboards.inline import account_menu_keyboard
+from bot.sender import sender
 from config import ADMIN_ID
 
 # Admin Filter
-class AdminFilter(types.BoundFilter):
+class AdminFilter(BoundFilter):
     key = 'is_admin'
     def __init__(self, is_admin: bool):
         self.is_admin = is_admin
@@ -19,9 +21,11 @@ class AdminFilter(types.BoundFilter):
 async def get_balance_text(user_id: int, db: Database):
     """Gets and formats the user's internal balance text."""
     try:
-        balance_kopecks = db.get_user_balance(user_id)
-        balance_rub = balance_kopecks / 100.0
-        return f"Ваш текущий баланс: **{balance_rub:.2f} RUB**"
+        available_kopecks, held_kopecks = await db.get_balance_details(user_id)
+        text = f"Ваш текущий баланс: **{available_kopecks / 100.0:.2f} RUB**"
+        if held_kopecks:
+            text += f"\nЗарезервировано под активные покупки: **{held_kopecks / 100.0:.2f} RUB**"
+        return text
     except Exception as e:
         logging.error(f"Ошибка получения внутреннего баланса для пользователя {user_id}: {e}")
         return "Произошла ошибка при получении вашего баланса."
@@ -29,7 +33,8 @@ async def get_balance_text(user_id: int, db: Database):
 async def balance_command_handler(message: types.Message, db: Database):
     """Handles the /balance command."""
     balance_text = await get_balance_text(message.from_user.id, db)
-    await message.answer(
+    await sender.answer(
+        message,
         "**Личный кабинет**\n\n" + balance_text,
         reply_markup=account_menu_keyboard()
     )
@@ -38,7 +43,8 @@ async def balance_callback_handler(callback_query: types.CallbackQuery, db: Data
     """Handles the 'Balance' button from the account menu."""
     await callback_query.answer("Загрузка баланса...", show_alert=False)
     balance_text = await get_balance_text(callback_query.from_user.id, db)
-    await callback_query.message.edit_text(
+    await sender.edit_text(
+        callback_query.message,
         f"**Личный кабинет**\n\n{balance_text}",
         reply_markup=account_menu_keyboard()
     )
@@ -47,16 +53,16 @@ async def balance_callback_handler(callback_query: types.CallbackQuery, db: Data
 
 async def service_balance_handler(message: types.Message, api: SmsActivateWrapper):
     """Handles the /service_balance command for the admin."""
-    await message.answer("Запрашиваю баланс сервиса...")
+    await sender.answer(message, "Запрашиваю баланс сервиса...")
     try:
         response = await api.get_balance()
         if isinstance(response, dict) and 'balance' in response:
             balance = response['balance']
-            await message.answer(f"Баланс на sms-activate.ru: **{balance}**")
+            await sender.answer(message, f"Баланс на sms-activate.ru: **{balance}**")
         else:
-            await message.answer(f"Не удалось получить баланс сервиса. Ответ: `{response}`")
+            await sender.answer(message, f"Не удалось получить баланс сервиса. Ответ: `{response}`")
     except Exception as e:
-        await message.answer(f"Ошибка при запросе баланса сервиса: {e}")
+        await sender.answer(message, f"Ошибка при запросе баланса сервиса: {e}")
 
 # --- Registration ---
 
@@ -67,10 +73,7 @@ def register_balance_handlers(dp: Dispatcher, db: Database, api: SmsActivateWrap
         lambda msg: balance_command_handler(msg, db),
         commands=['balance']
     )
-    dp.register_callback_query_handler(
-        lambda cb: balance_callback_handler(cb, db),
-        Text(equals="check_balance")
-    )
+    callbacks.get_callback_router(dp).add(callbacks.CHECK_BALANCE, lambda cb: balance_callback_handler(cb, db))
     dp.register_message_handler(
         lambda msg: service_balance_handler(msg, api),
         commands=['service_balance'],
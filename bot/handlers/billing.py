@@ -1,7 +1,8 @@
 import logging
 from aiogram import Dispatcher, types
-from aiogram.dispatcher.filters import Text
+from bot import callbacks
 from bot.keyboards.inline import account_menu_keyboard
+from bot.sender import sender
 
 async def top_up_balance_handler(callback_query: types.CallbackQuery):
     await callback_query.answer()
@@ -13,7 +14,7 @@ async def top_up_balance_handler(callback_query: types.CallbackQuery):
     )
 
     # In aiogram, we need to answer the callback query before editing
-    await callback_query.message.edit_text(text, reply_markup=account_menu_keyboard())
+    await sender.edit_text(callback_query.message, text, reply_markup=account_menu_keyboard())
 
 def register_billing_handlers(dp: Dispatcher):
-    dp.register_callback_query_handler(top_up_balance_handler, Text(equals="top_up_balance"))
+    callbacks.get_callback_router(dp).add(callbacks.TOP_UP_BALANCE, top_up_balance_handler)
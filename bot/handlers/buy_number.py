@@ -1,143 +1,272 @@
 import asyncio
 import logging
 from aiogram import Dispatcher, types
-from aiogram.dispatcher.filters import Text
-from bot.api import SmsActivateWrapper
+from bot import callbacks
+from bot.catalog import Catalog, SERVICE_NAME_MAP
 from bot.db import Database
-from bot.utils import create_paginated_keyboard
-from bot.states import set_user_state, clear_user_state
+from bot.orders import (acquire_numbers, render_order, BULK_QUANTITIES, BULK_MAX_QUANTITY,
+                        PROGRESS_INTERVAL)
+from bot.outbox import set_status_job, reconcile_jobs, RECONCILE_DELAY
+from bot.router import ProviderRouter
+from bot.scheduler import ActivationScheduler
+from bot.sender import sender, PRIORITY_HIGH
+from bot.utils import create_paginated_keyboard, KeyboardCache
+from bot.media import get_photo
+from bot.metrics import Gauge
 from config import IMAGE_COUNTRIES, IMAGE_SERVICES
 
-# Caches
-COUNTRY_LIST_CACHE = []
-SERVICE_PRICE_CACHE = {}
-SERVICE_NAME_MAP = {
-    'tg': "Telegram", 'wa': "WhatsApp", 'vi': "Viber", 'ig': "Instagram",
-    'fb': "Facebook", 'go': "Google/YouTube", 'vk': "ВКонтакте",
-    'ok': "Одноклассники", 'mm': "Mail.ru", 'ya': "Яндекс",
-    'ds': "Discord", 'am': "Amazon", 'tw': "Twitter", 'st': "Steam",
-    'ub': "Uber", 'nf': "Netflix", 'tk': "TikTok", 'ot': "Любой другой"
-}
+# Page sizes of the catalog screens
+COUNTRIES_PAGE_SIZE = 18
+SERVICES_PAGE_SIZE = 12
+
+# --- Keyboards ---
+
+def build_countries_keyboard(countries: list, page: int) -> types.InlineKeyboardMarkup:
+    buttons = [(c.rus, callbacks.BUY_COUNTRY.new(c.id)) for c in countries]
+    keyboard = create_paginated_keyboard(buttons, page, COUNTRIES_PAGE_SIZE, callbacks.BUY_COUNTRY_PAGE.new, columns=3)
+    keyboard.add(types.InlineKeyboardButton(text="🔎 Поиск", callback_data=callbacks.SEARCH_COUNTRY.new()))
+    keyboard.add(types.InlineKeyboardButton(text="⬅️ Назад в главное меню", callback_data=callbacks.MAIN_MENU.new()))
+    return keyboard
+
+def build_services_keyboard(country_id: int, country_prices: dict, page: int, bulk: bool = False) -> types.InlineKeyboardMarkup:
+    # In bulk mode a service opens the quantity picker instead of buying one number
+    buy, page_of = ((callbacks.BUY_BULK, callbacks.BUY_BULK_PAGE) if bulk
+                    else (callbacks.BUY_SERVICE, callbacks.BUY_SERVICE_PAGE))
+    buttons = []
+    for code, price in country_prices.items():
+        name = SERVICE_NAME_MAP.get(code, code)
+        buttons.append((f"{name} - {price.cost} RUB", buy.new(code, country_id)))
+
+    keyboard = create_paginated_keyboard(buttons, page, SERVICES_PAGE_SIZE, lambda p: page_of.new(country_id, p), columns=2)
+    if bulk:
+        keyboard.add(types.InlineKeyboardButton(text="☝️ Покупать по одному", callback_data=callbacks.BUY_COUNTRY.new(country_id)))
+    else:
+        keyboard.add(types.InlineKeyboardButton(text="📦 Купить несколько номеров",
+                                                callback_data=callbacks.BUY_BULK_PAGE.new(country_id, 0)))
+        keyboard.add(types.InlineKeyboardButton(text="🔎 Поиск", callback_data=callbacks.SEARCH_SERVICE.new(country_id)))
+    keyboard.add(types.InlineKeyboardButton(text="⬅️ Назад к странам", callback_data=callbacks.BUY_MENU.new()))
+    return keyboard
+
+def build_quantity_keyboard(service_code: str, country_id: int, cost: float) -> types.InlineKeyboardMarkup:
+    keyboard = types.InlineKeyboardMarkup(row_width=2)
+    keyboard.add(*[
+        types.InlineKeyboardButton(text=f"{n} шт. - {cost * n:.2f} RUB",
+                                   callback_data=callbacks.BUY_MANY.new(service_code, country_id, n))
+        for n in BULK_QUANTITIES
+    ])
+    keyboard.add(types.InlineKeyboardButton(text="⬅️ Назад к сервисам", callback_data=callbacks.BUY_BULK_PAGE.new(country_id, 0)))
+    return keyboard
 
 # --- Handlers ---
 
-async def show_countries(callback_query: types.CallbackQuery, api: SmsActivateWrapper, page: int = 0):
+async def show_countries(callback_query: types.CallbackQuery, catalog: Catalog, keyboards: KeyboardCache, page: int = 0):
     await callback_query.answer("Загрузка стран...")
     try:
-        if not COUNTRY_LIST_CACHE:
-            countries_data = await api.get_countries()
-            if isinstance(countries_data, dict):
-                all_countries = list(countries_data.values())
-                all_countries.sort(key=lambda c: c['rus'])
-                COUNTRY_LIST_CACHE.extend(all_countries)
-            else:
-                raise Exception(f"Invalid country data: {countries_data}")
-
-        buttons = [(f"{c['rus']}", f"buy_country:{c['id']}") for c in COUNTRY_LIST_CACHE]
-        keyboard = create_paginated_keyboard(buttons, page, 18, "buy_country_page", columns=3)
-        keyboard.add(types.InlineKeyboardButton(text="🔎 Поиск", callback_data="search_country"))
-        keyboard.add(types.InlineKeyboardButton(text="⬅️ Назад в главное меню", callback_data="main_menu"))
-
-        await callback_query.message.edit_media(
-            media=types.InputMediaPhoto(media=IMAGE_COUNTRIES, caption="Пожалуйста, выберите страну:"),
+        countries = await catalog.get_countries()
+        keyboard = keyboards.get_or_build(
+            ('countries', None, page, catalog.version),
+            lambda: build_countries_keyboard(countries, page)
+        )
+
+        await sender.edit_media(
+            callback_query.message,
+            media=types.InputMediaPhoto(media=get_photo(IMAGE_COUNTRIES), caption="Пожалуйста, выберите страну:"),
             reply_markup=keyboard
         )
     except Exception as e:
         logging.error(f"Ошибка при отображении стран: {e}")
-        await callback_query.message.edit_caption("Не удалось загрузить список стран.")
-
-async def show_countries_paginated(callback_query: types.CallbackQuery, api: SmsActivateWrapper):
-    page = int(callback_query.data.split(':')[-1])
-    await show_countries(callback_query, api, page=page)
+        await sender.edit_caption(callback_query.message, "Не удалось загрузить список стран.")
 
-async def show_services(callback_query: types.CallbackQuery, api: SmsActivateWrapper, page: int = 0):
-    country_id = int(callback_query.data.split(':')[-1])
+async def show_services(callback_query: types.CallbackQuery, catalog: Catalog, keyboards: KeyboardCache,
+                        country_id: int, page: int = 0, bulk: bool = False):
     await callback_query.answer("Загрузка сервисов...")
     try:
-        if country_id not in SERVICE_PRICE_CACHE:
-            prices_data = await api.get_prices(country=country_id)
-            if isinstance(prices_data, dict) and str(country_id) in prices_data:
-                SERVICE_PRICE_CACHE[country_id] = prices_data[str(country_id)]
-            else:
-                raise Exception(f"Invalid prices data: {prices_data}")
-
-        country_prices = SERVICE_PRICE_CACHE[country_id]
+        country_prices = await catalog.get_prices(country_id)
         if not country_prices:
-            await callback_query.message.edit_text("Для этой страны нет доступных сервисов.")
+            await sender.edit_text(callback_query.message, "Для этой страны нет доступных сервисов.")
             return
 
-        buttons = []
-        for code, details in country_prices.items():
-            name = SERVICE_NAME_MAP.get(code, code)
-            buttons.append((f"{name} - {details['cost']} RUB", f"buy_service:{code}:{country_id}"))
-
-        keyboard = create_paginated_keyboard(buttons, page, 12, f"buy_service_page:{country_id}", columns=2)
-        keyboard.add(types.InlineKeyboardButton(text="🔎 Поиск", callback_data=f"search_service:{country_id}"))
-        keyboard.add(types.InlineKeyboardButton(text="⬅️ Назад к странам", callback_data="buy_menu"))
+        keyboard = keyboards.get_or_build(
+            ('bulk_services' if bulk else 'services', country_id, page, catalog.version),
+            lambda: build_services_keyboard(country_id, country_prices, page, bulk)
+        )
 
-        await callback_query.message.edit_media(
-            media=types.InputMediaPhoto(media=IMAGE_SERVICES, caption="Пожалуйста, выберите сервис:"),
+        caption = "Выберите сервис, затем количество номеров:" if bulk else "Пожалуйста, выберите сервис:"
+        await sender.edit_media(
+            callback_query.message,
+            media=types.InputMediaPhoto(media=get_photo(IMAGE_SERVICES), caption=caption),
             reply_markup=keyboard
         )
     except Exception as e:
         logging.error(f"Ошибка при отображении сервисов: {e}")
-        await callback_query.message.edit_caption("Не удалось загрузить список сервисов.")
+        await sender.edit_caption(callback_query.message, "Не удалось загрузить список сервисов.")
+
+async def show_quantities(callback_query: types.CallbackQuery, catalog: Catalog, service_code: str, country_id: int):
+    await callback_query.answer()
+    price = (await catalog.get_prices(country_id)).get(service_code)
+    if price is None:
+        await sender.edit_caption(callback_query.message, "Этот сервис сейчас недоступен.")
+        return
+    await sender.edit_caption(
+        callback_query.message,
+        f"**{SERVICE_NAME_MAP.get(service_code, service_code)}**: {price.cost} RUB за номер.\n\n"
+        f"Сколько номеров купить? Деньги за номера, на которые не придет СМС, вернутся.",
+        reply_markup=build_quantity_keyboard(service_code, country_id, price.cost)
+    )
 
-async def purchase_number(callback_query: types.CallbackQuery, db: Database, api: SmsActivateWrapper):
-    _, service_code, country_id_str = callback_query.data.split(':')
-    country_id = int(country_id_str)
+async def purchase_number(callback_query: types.CallbackQuery, db: Database, router: ProviderRouter,
+                          catalog: Catalog, scheduler: ActivationScheduler, service_code: str, country_id: int):
     user_id = callback_query.from_user.id
 
-    await callback_query.message.edit_caption("⏳ Обработка покупки...")
+    await sender.edit_caption(callback_query.message, "⏳ Обработка покупки...", priority=PRIORITY_HIGH)
     try:
-        cost_rub = float(SERVICE_PRICE_CACHE[country_id][service_code]['cost'])
-        cost_kopecks = int(cost_rub * 100)
+        price = await catalog.get_fresh_price(country_id, service_code)
+        if price is None:
+            raise Exception(f"Сервис {service_code} недоступен для страны {country_id}")
+        cost_kopecks = int(price.cost * 100)
     except Exception as e:
         logging.error(f"Не удалось определить стоимость: {e}")
-        await callback_query.message.edit_caption("Ошибка при проверке цены.")
+        await sender.edit_caption(callback_query.message, "Ошибка при проверке цены.", priority=PRIORITY_HIGH)
         return
 
-    if not db.create_transaction(user_id, -cost_kopecks, 'purchase', f"Покупка {service_code}"):
-        await callback_query.message.edit_caption("❌ Покупка не удалась! Недостаточно средств.")
+    hold_id = await db.reserve_funds(user_id, cost_kopecks, f"Покупка {service_code}")
+    if hold_id is None:
+        await sender.edit_caption(callback_query.message, "❌ Покупка не удалась! Недостаточно средств.", priority=PRIORITY_HIGH)
         return
 
     try:
-        purchase_response = await api.get_number(service_code, country_id)
-        if isinstance(purchase_response, dict) and 'activation' in purchase_response:
-            act = purchase_response['activation']
-            db.log_purchase(user_id, int(act['id']), service_code, str(country_id), act['phone'])
-            await callback_query.message.edit_caption(f"✅ **Номер получен!**\n\n**Номер:** `{act['phone']}`\n\nОжидаю СМС...")
-            asyncio.create_task(poll_for_sms(callback_query.message, int(act['id']), api))
+        purchase_response = await router.get_number(service_code, country_id, price.cost)
+        if isinstance(purchase_response, dict) and purchase_response.get('uncertain'):
+            # The provider may have sold the number; cancel it once it shows up in its activations
+            await scheduler.outbox.enqueue(reconcile_jobs([purchase_response], service_code, country_id, str(hold_id)),
+                                           delay=RECONCILE_DELAY)
+        if isinstance(purchase_response, dict) and 'activation_id' in purchase_response:
+            activation_id = int(purchase_response['activation_id'])
+            phone = purchase_response['phone']
+            provider = purchase_response['provider']
+            chat_id = callback_query.message.chat.id
+            if not await db.log_purchase(user_id, activation_id, service_code, str(country_id), str(phone),
+                                         cost_kopecks, hold_id, chat_id, provider):
+                # Without the record a restart would lose the activation, so give the number back now
+                await scheduler.outbox.enqueue([set_status_job(provider, activation_id, 8)])
+                raise Exception(f"Покупка {activation_id} не сохранена")
+            await sender.edit_caption(callback_query.message, f"✅ **Номер получен!**\n\n**Номер:** `{phone}`\n\nОжидаю СМС...", priority=PRIORITY_HIGH)
+            scheduler.add(activation_id, chat_id, hold_id, provider, service_code, str(country_id))
         else:
-            db.create_transaction(user_id, cost_kopecks, 'refund', f"Возврат: {purchase_response}")
-            await callback_query.message.edit_caption(f"❌ **Ошибка покупки!**\nПричина: `{purchase_response}`. Средства возвращены.")
+            await db.release_hold(hold_id)
+            await sender.edit_caption(callback_query.message, f"❌ **Ошибка покупки!**\nПричина: `{purchase_response}`. Средства возвращены.", priority=PRIORITY_HIGH)
+    except Exception as e:
+        logging.error(f"Ошибка при покупке номера: {e}")
+        await db.release_hold(hold_id)
+        await sender.edit_caption(callback_query.message, "Произошла непредвиденная ошибка. Средства возвращены.", priority=PRIORITY_HIGH)
+
+async def purchase_many(callback_query: types.CallbackQuery, db: Database, router: ProviderRouter,
+                        catalog: Catalog, scheduler: ActivationScheduler, service_code: str, country_id: int,
+                        quantity: int):
+    """
+    Buys several numbers of one service at once: one hold for the total, numbers
+    acquired concurrently and saved as each one is bought, the failed ones refunded
+    right away and one status message that is updated as their codes arrive. The
+    hold is charged once, for the numbers that received an SMS, when the last one
+    finishes.
+    """
+    quantity = max(1, min(quantity, BULK_MAX_QUANTITY))
+    user_id = callback_query.from_user.id
+    chat_id = callback_query.message.chat.id
+
+    await sender.edit_caption(callback_query.message, f"⏳ Обработка заказа на {quantity} номеров...", priority=PRIORITY_HIGH)
+    try:
+        price = await catalog.get_fresh_price(country_id, service_code)
+        if price is None:
+            raise Exception(f"Сервис {service_code} недоступен для страны {country_id}")
+        cost_kopecks = int(price.cost * 100)
+    except Exception as e:
+        logging.error(f"Не удалось определить стоимость: {e}")
+        await sender.edit_caption(callback_query.message, "Ошибка при проверке цены.", priority=PRIORITY_HIGH)
+        return
+
+    hold_id = await db.reserve_funds(user_id, cost_kopecks * quantity, f"Покупка {service_code} x{quantity}")
+    if hold_id is None:
+        await sender.edit_caption(callback_query.message, "❌ Покупка не удалась! Недостаточно средств.", priority=PRIORITY_HIGH)
+        return
+
+    numbers, tracked = [], False
+
+    async def save(number) -> bool:
+        # Saved before the order goes on, so a restart resumes the number and a reconcile job sees it
+        activation_id, provider = int(number['activation_id']), number['provider']
+        if await db.log_purchases(user_id, [(activation_id, provider, str(number['phone']))], service_code,
+                                  str(country_id), cost_kopecks, hold_id, chat_id, status_message.message_id):
+            return True
+        # An unsaved number would never be tracked, so give it back now
+        await scheduler.outbox.enqueue([set_status_job(provider, activation_id, 8)])
+        return False
+
+    def track():
+        for n in numbers:
+            scheduler.add(int(n['activation_id']), chat_id, hold_id, n['provider'], service_code, str(country_id),
+                          status_message.message_id)
+
+    try:
+        status_message = await sender.answer(callback_query.message, f"⏳ Покупаю номера: 0 из {quantity}...", PRIORITY_HIGH)
+        acquisition = asyncio.create_task(acquire_numbers(router, service_code, country_id, quantity, numbers,
+                                                          price.cost, save))
+        shown = 0
+        while not acquisition.done():
+            await asyncio.wait([acquisition], timeout=PROGRESS_INTERVAL)
+            if not acquisition.done() and len(numbers) != shown:
+                shown = len(numbers)
+                try:
+                    await sender.edit_text(status_message, f"⏳ Покупаю номера: {shown} из {quantity}...", PRIORITY_HIGH)
+                except Exception as e:
+                    # Progress is cosmetic; the acquisition must run to the end either way
+                    logging.warning(f"Не удалось показать ход заказа: {e}")
+        last_error, uncertain = acquisition.result()
+        if uncertain:
+            await scheduler.outbox.enqueue(reconcile_jobs(uncertain, service_code, country_id, str(hold_id)),
+                                           delay=RECONCILE_DELAY)
+
+        if len(numbers) < quantity:
+            await db.release_hold(hold_id, cost_kopecks * (quantity - len(numbers)))
+        if not numbers:
+            await sender.edit_text(status_message, f"❌ **Не удалось купить номера.**\nПричина: `{last_error}`. Средства возвращены.", PRIORITY_HIGH)
+            await sender.edit_caption(callback_query.message, "Заказ не выполнен.", priority=PRIORITY_HIGH)
+            return
+
+        # Tracked only now: the hold settles once none of its purchases is active
+        track()
+        tracked = True
+        await sender.edit_text(status_message, render_order(service_code, await db.get_order_purchases(hold_id)), PRIORITY_HIGH)
+        summary = f"✅ Куплено номеров: {len(numbers)} из {quantity}."
+        if len(numbers) < quantity:
+            summary += f" За остальные возвращено {cost_kopecks * (quantity - len(numbers)) / 100:.2f} RUB."
+        await sender.edit_caption(callback_query.message, summary + "\nКоды появятся в сообщении с заказом.", priority=PRIORITY_HIGH)
     except Exception as e:
-        db.create_transaction(user_id, cost_kopecks, 'refund', f"Возврат из-за ошибки: {e}")
-        await callback_query.message.edit_caption("Произошла непредвиденная ошибка. Средства возвращены.")
-
-async def poll_for_sms(message: types.Message, activation_id: int, api: SmsActivateWrapper):
-    for _ in range(60): # Poll for 10 minutes (60 * 10 seconds)
-        await asyncio.sleep(10)
-        try:
-            status_res = await api.get_status(activation_id)
-            if "STATUS_OK" in status_res:
-                sms_code = status_res.split(':')[1]
-                await message.answer(f"✉️ **Получено СМС!**\n\nКод: `{sms_code}`")
-                await api.set_status(activation_id, 6)
-                return
-            elif "STATUS_CANCEL" in status_res:
-                await message.answer("❌ Активация была отменена.")
-                return
-        except Exception as e:
-            logging.error(f"Ошибка при проверке СМС (ID: {activation_id}): {e}")
-    await message.answer("Ожидание СМС завершено (10 минут).")
-    await api.set_status(activation_id, 8)
+        logging.error(f"Ошибка при оптовой покупке номеров: {e}")
+        if numbers:
+            # They are saved: once tracked, the hold settles when they finish and returns the rest
+            if not tracked:
+                track()
+            return
+        await db.release_hold(hold_id)
+        await sender.edit_caption(callback_query.message, "Произошла непредвиденная ошибка. Средства возвращены.", priority=PRIORITY_HIGH)
 
 # --- Registration ---
 
-def register_buy_handlers(dp: Dispatcher, db: Database, api: SmsActivateWrapper):
-    dp.register_callback_query_handler(lambda c: show_countries(c, api), Text(equals="buy_menu"))
-    dp.register_callback_query_handler(lambda c: show_countries_paginated(c, api), Text(startswith="buy_country_page:"))
-    dp.register_callback_query_handler(lambda c: show_services(c, api), Text(startswith="buy_country:"))
-    # Need handlers for service pagination and search triggers
-    dp.register_callback_query_handler(lambda c: purchase_number(c, db, api), Text(startswith="buy_service:"))
+def register_buy_handlers(dp: Dispatcher, db: Database, router: ProviderRouter, catalog: Catalog,
+                          scheduler: ActivationScheduler):
+    keyboards = KeyboardCache()
+    catalog.add_listener(keyboards.invalidate)
+    Gauge('keyboard_cache_hit_rate', "Share of catalog keyboards served from the cache.", lambda: keyboards.hit_rate)
+
+    callback_router = callbacks.get_callback_router(dp)
+    callback_router.add(callbacks.BUY_MENU, lambda c: show_countries(c, catalog, keyboards))
+    callback_router.add(callbacks.BUY_COUNTRY_PAGE, lambda c, page: show_countries(c, catalog, keyboards, page))
+    callback_router.add(callbacks.BUY_COUNTRY, lambda c, country_id: show_services(c, catalog, keyboards, country_id))
+    callback_router.add(callbacks.BUY_SERVICE_PAGE,
+                        lambda c, country_id, page: show_services(c, catalog, keyboards, country_id, page))
+    callback_router.add(callbacks.BUY_SERVICE, lambda c, *args: purchase_number(c, db, router, catalog, scheduler, *args))
+    callback_router.add(callbacks.BUY_BULK_PAGE,
+                        lambda c, country_id, page: show_services(c, catalog, keyboards, country_id, page, bulk=True))
+    callback_router.add(callbacks.BUY_BULK, lambda c, *args: show_quantities(c, catalog, *args))
+    callback_router.add(callbacks.BUY_MANY, lambda c, *args: purchase_many(c, db, router, catalog, scheduler, *args))
@@ -1,49 +1,84 @@
 import logging
 from aiogram import Dispatcher, types
-from aiogram.dispatcher.filters import Text
+from bot import callbacks
+from bot.catalog import SERVICE_NAME_MAP
 from bot.db import Database
-from bot.keyboards.inline import account_menu_keyboard
+from bot.sender import sender
 
-async def history_menu_handler(callback_query: types.CallbackQuery, db: Database):
+# Operations shown per history page
+HISTORY_PAGE_SIZE = 10
+
+TRANSACTION_TYPES = {'deposit': "Пополнение", 'purchase': "Оплата", 'refund': "Возврат"}
+PURCHASE_STATUSES = {'active': "ожидает СМС", 'completed': "выполнена", 'cancelled': "отменена", 'expired': "истекла"}
+
+# --- Cursor encoding ---
+# The page cursor travels in the callback data (at most 64 bytes), with
+# created_at packed as digits: see callbacks.HISTORY_PAGE
+
+def encode_cursor(page: int, cursor) -> str:
+    created_at, rank, row_id = cursor
+    digits = ''.join(ch for ch in str(created_at) if ch.isdigit())
+    return callbacks.HISTORY_PAGE.new(page, digits, rank, row_id)
+
+def decode_cursor(d: str, rank: int, row_id: int):
+    """Returns the cursor from the fields of a "next page" button."""
+    created_at = f"{d[0:4]}-{d[4:6]}-{d[6:8]} {d[8:10]}:{d[10:12]}:{d[12:14]}"
+    return created_at, rank, row_id
+
+# --- Rendering ---
+
+def format_history_row(row) -> str:
+    kind, created_at, title, detail, extra, amount = row
+    date = str(created_at)[:16]
+    if kind == 'purchase':
+        status = PURCHASE_STATUSES.get(extra, extra or "")
+        return f"🛒 {date} — {SERVICE_NAME_MAP.get(title, title)}, `{detail}` ({status})"
+    if kind == 'rental':
+        return f"📅 {date} — аренда {SERVICE_NAME_MAP.get(title, title)}, `{detail}` до {str(extra)[:16]}"
+    return f"💳 {date} — {TRANSACTION_TYPES.get(title, title)}: {amount / 100.0:+.2f} RUB"
+
+def build_history_keyboard(page: int, next_cursor) -> types.InlineKeyboardMarkup:
+    keyboard = types.InlineKeyboardMarkup()
+    nav_buttons = []
+    if page > 0:
+        nav_buttons.append(types.InlineKeyboardButton(text="⏮ В начало", callback_data=callbacks.HISTORY_MENU.new()))
+    if next_cursor is not None:
+        nav_buttons.append(types.InlineKeyboardButton(text="Дальше ➡️", callback_data=encode_cursor(page + 1, next_cursor)))
+    if nav_buttons:
+        keyboard.row(*nav_buttons)
+    keyboard.add(types.InlineKeyboardButton(text="⬅️ Назад в личный кабинет", callback_data=callbacks.ACCOUNT_MENU.new()))
+    return keyboard
+
+# --- Handlers ---
+
+async def show_history_page(callback_query: types.CallbackQuery, db: Database, page: int = 0, before=None):
     user_id = callback_query.from_user.id
     await callback_query.answer("Загружаю историю...")
 
     try:
-        purchase_history = db.get_purchase_history(user_id)
-        # For now, I will omit the rental history since the feature is disabled
-        # rental_history = db.get_rental_history(user_id)
-
-        history_text = "**История ваших операций**\n\n"
+        rows, next_cursor = await db.get_history_page(user_id, HISTORY_PAGE_SIZE, before)
 
-        if not purchase_history: # and not rental_history:
-            history_text += "У вас еще нет истории транзакций."
+        history_text = "**История ваших операций**"
+        if page:
+            history_text += f" (стр. {page + 1})"
+        history_text += "\n\n"
+        if not rows:
+            history_text += "У вас еще нет истории транзакций." if page == 0 else "Больше операций нет."
         else:
-            if purchase_history:
-                history_text += "**Последние 5 покупок:**\n"
-                for p in purchase_history[:5]:
-                    # Assuming p = (service, phone_number, created_at)
-                    history_text += f"- Сервис: {p[0]}, Номер: `{p[1]}` от {p[2]}\n"
-                history_text += "\n"
+            history_text += "\n".join(format_history_row(row) for row in rows)
 
-            # if rental_history:
-            #     history_text += "**Последние 5 аренд:**\n"
-            #     for r in rental_history[:5]:
-            #         history_text += f"- Сервис: {r[0]}, Номер: `{r[1]}` до {r[2]}\n"
-
-        keyboard = types.InlineKeyboardMarkup(inline_keyboard=[[
-            types.InlineKeyboardButton(text="⬅️ Назад в личный кабинет", callback_data="account_menu")
-        ]])
-
-        # In aiogram, we need to answer the callback query before editing
-        await callback_query.message.edit_text(history_text, reply_markup=keyboard)
+        await sender.edit_text(callback_query.message, history_text, reply_markup=build_history_keyboard(page, next_cursor))
 
     except Exception as e:
         logging.error(f"Ошибка при получении истории для пользователя {user_id}: {e}")
-        await callback_query.message.edit_text("Не удалось получить вашу историю. Попробуйте снова.")
+        await sender.edit_text(callback_query.message, "Не удалось получить вашу историю. Попробуйте снова.")
+
+async def history_page_handler(callback_query: types.CallbackQuery, db: Database, page: int, created: str,
+                               rank: int, row_id: int):
+    await show_history_page(callback_query, db, page, decode_cursor(created, rank, row_id))
 
 def register_history_handlers(dp: Dispatcher, db: Database):
     # We need to pass the db instance to the handler. We can do this with a lambda.
-    dp.register_callback_query_handler(
-        lambda c: history_menu_handler(c, db),
-        Text(equals="history_menu")
-    )
+    router = callbacks.get_callback_router(dp)
+    router.add(callbacks.HISTORY_MENU, lambda c: show_history_page(c, db))
+    router.add(callbacks.HISTORY_PAGE, lambda c, *cursor: history_page_handler(c, db, *cursor))
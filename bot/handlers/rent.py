@@ -0,0 +1,324 @@
+import logging
+import time
+from aiogram import Dispatcher, types
+from bot import callbacks
+from bot.api import SmsActivateClient
+from bot.catalog import Catalog, SERVICE_NAME_MAP
+from bot.db import Database
+from bot.rentals import (RentCatalog, RentalScheduler, rent_messages, rent_duration_label, RENT_DURATIONS,
+                         RENT_CANCEL_WINDOW)
+from bot.sender import sender, PRIORITY_HIGH
+from bot.utils import create_paginated_keyboard
+from bot.media import get_photo
+from config import IMAGE_COUNTRIES
+
+# Page sizes of the rental screens
+RENT_COUNTRIES_PAGE_SIZE = 18
+RENT_SERVICES_PAGE_SIZE = 12
+# SMS shown on a rental's screen, newest last
+RENT_SMS_SHOWN = 5
+
+# setRentStatus codes
+RENT_STATUS_FINISH = 1
+RENT_STATUS_CANCEL = 2
+
+# --- Keyboards ---
+
+def build_rent_countries_keyboard(countries: list, page: int) -> types.InlineKeyboardMarkup:
+    buttons = [(c.rus, callbacks.RENT_COUNTRY.new(c.id)) for c in countries]
+    keyboard = create_paginated_keyboard(buttons, page, RENT_COUNTRIES_PAGE_SIZE, callbacks.RENT_COUNTRY_PAGE.new, columns=3)
+    keyboard.add(types.InlineKeyboardButton(text="📋 Мои аренды", callback_data=callbacks.RENT_LIST.new()))
+    keyboard.add(types.InlineKeyboardButton(text="⬅️ Назад в главное меню", callback_data=callbacks.MAIN_MENU.new()))
+    return keyboard
+
+def build_rent_durations_keyboard(duration_callback, back: str) -> types.InlineKeyboardMarkup:
+    """duration_callback(hours) returns the callback data of a duration's button."""
+    keyboard = types.InlineKeyboardMarkup(row_width=2)
+    keyboard.add(*[
+        types.InlineKeyboardButton(text=rent_duration_label(hours), callback_data=duration_callback(hours))
+        for hours in RENT_DURATIONS
+    ])
+    keyboard.add(types.InlineKeyboardButton(text="⬅️ Назад", callback_data=back))
+    return keyboard
+
+def build_rent_services_keyboard(country_id: int, hours: int, services: dict, page: int) -> types.InlineKeyboardMarkup:
+    buttons = []
+    for code, details in services.items():
+        name = SERVICE_NAME_MAP.get(code, code)
+        buttons.append((f"{name} - {details['cost']} RUB", callbacks.RENT_SERVICE.new(code, country_id, hours)))
+
+    keyboard = create_paginated_keyboard(buttons, page, RENT_SERVICES_PAGE_SIZE,
+                                         lambda p: callbacks.RENT_SERVICE_PAGE.new(country_id, hours, p), columns=2)
+    keyboard.add(types.InlineKeyboardButton(text="⬅️ Назад к срокам", callback_data=callbacks.RENT_COUNTRY.new(country_id)))
+    return keyboard
+
+def build_rental_keyboard(rent_id: int, can_cancel: bool) -> types.InlineKeyboardMarkup:
+    keyboard = types.InlineKeyboardMarkup()
+    keyboard.row(
+        types.InlineKeyboardButton(text="🔄 Обновить", callback_data=callbacks.RENT_VIEW.new(rent_id)),
+        types.InlineKeyboardButton(text="➕ Продлить", callback_data=callbacks.RENT_EXTEND.new(rent_id)),
+    )
+    if can_cancel:
+        keyboard.add(types.InlineKeyboardButton(text="❌ Отменить (с возвратом)", callback_data=callbacks.RENT_CLOSE.new(rent_id)))
+    else:
+        keyboard.add(types.InlineKeyboardButton(text="✅ Завершить аренду", callback_data=callbacks.RENT_CLOSE.new(rent_id)))
+    keyboard.add(types.InlineKeyboardButton(text="⬅️ К моим арендам", callback_data=callbacks.RENT_LIST.new()))
+    return keyboard
+
+def can_cancel_rental(age: float, sms_seen: int) -> bool:
+    """SMS-Activate refunds a rental only shortly after it started and only if no SMS came."""
+    return age < RENT_CANCEL_WINDOW and not sms_seen
+
+# --- Choosing a rental ---
+
+async def show_rent_countries(callback_query: types.CallbackQuery, catalog: Catalog, rent_catalog: RentCatalog,
+                              page: int = 0):
+    await callback_query.answer("Загрузка стран...")
+    try:
+        offers = await rent_catalog.get_offers(None, RENT_DURATIONS[0])
+        rent_countries = {str(c) for c in (offers.get('countries') or {}).values()}
+        countries = [c for c in await catalog.get_countries() if str(c.id) in rent_countries]
+        await sender.edit_media(
+            callback_query.message,
+            media=types.InputMediaPhoto(media=get_photo(IMAGE_COUNTRIES), caption="Аренда номера. Выберите страну:"),
+            reply_markup=build_rent_countries_keyboard(countries, page)
+        )
+    except Exception as e:
+        logging.error(f"Ошибка при отображении стран аренды: {e}")
+        await sender.edit_caption(callback_query.message, "Не удалось загрузить список стран для аренды.")
+
+def build_rent_time_keyboard(country_id: int) -> types.InlineKeyboardMarkup:
+    return build_rent_durations_keyboard(lambda hours: callbacks.RENT_TIME.new(country_id, hours), callbacks.RENT_MENU.new())
+
+async def show_rent_durations(callback_query: types.CallbackQuery, country_id: int):
+    await callback_query.answer()
+    await sender.edit_caption(
+        callback_query.message, "На какой срок арендовать номер?",
+        reply_markup=build_rent_time_keyboard(country_id)
+    )
+
+async def show_rent_services(callback_query: types.CallbackQuery, rent_catalog: RentCatalog, country_id: int,
+                             hours: int, page: int = 0):
+    await callback_query.answer("Загрузка сервисов...")
+    try:
+        services = (await rent_catalog.get_offers(country_id, hours))['services']
+        if not services:
+            await sender.edit_caption(callback_query.message, "Для этой страны нет номеров в аренду.",
+                                      reply_markup=build_rent_time_keyboard(country_id))
+            return
+        await sender.edit_caption(
+            callback_query.message, f"Аренда на {rent_duration_label(hours)} Выберите сервис:",
+            reply_markup=build_rent_services_keyboard(country_id, hours, services, page)
+        )
+    except Exception as e:
+        logging.error(f"Ошибка при отображении сервисов аренды: {e}")
+        await sender.edit_caption(callback_query.message, "Не удалось загрузить список сервисов.")
+
+async def rent_number(callback_query: types.CallbackQuery, db: Database, api: SmsActivateClient,
+                      rent_catalog: RentCatalog, rentals: RentalScheduler, service_code: str, country_id: int,
+                      hours: int):
+    user_id = callback_query.from_user.id
+
+    await sender.edit_caption(callback_query.message, "⏳ Оформление аренды...", priority=PRIORITY_HIGH)
+    try:
+        details = (await rent_catalog.get_offers(country_id, hours, fresh=True))['services'].get(service_code)
+        if details is None:
+            raise Exception(f"Сервис {service_code} недоступен для аренды в стране {country_id}")
+        cost_kopecks = int(float(details['cost']) * 100)
+    except Exception as e:
+        logging.error(f"Не удалось определить стоимость аренды: {e}")
+        await sender.edit_caption(callback_query.message, "Ошибка при проверке цены.", priority=PRIORITY_HIGH)
+        return
+
+    hold_id = await db.reserve_funds(user_id, cost_kopecks, f"Аренда {service_code} на {hours} ч.")
+    if hold_id is None:
+        await sender.edit_caption(callback_query.message, "❌ Аренда не удалась! Недостаточно средств.", priority=PRIORITY_HIGH)
+        return
+
+    try:
+        response = await api.get_rent_number(service_code, country_id, hours)
+        phone = response.get('phone') if isinstance(response, dict) and response.get('status') == 'success' else None
+        if not isinstance(phone, dict):
+            await db.release_hold(hold_id)
+            await sender.edit_caption(callback_query.message, f"❌ **Ошибка аренды!**\nПричина: `{response}`. Средства возвращены.", priority=PRIORITY_HIGH)
+            return
+
+        rent_id, number = int(phone['id']), str(phone['number'])
+        expires_at = time.time() + hours * 3600
+        chat_id = callback_query.message.chat.id
+        if not await db.log_rental(user_id, rent_id, service_code, str(country_id), number, expires_at,
+                                   cost_kopecks, chat_id, hold_id):
+            # An unrecorded rental would never be tracked, so give the number back now
+            await api.set_rent_status(rent_id, RENT_STATUS_CANCEL)
+            raise Exception(f"Аренда {rent_id} не сохранена")
+        rentals.add(rent_id, chat_id, number, expires_at)
+
+        keyboard = types.InlineKeyboardMarkup()
+        keyboard.add(types.InlineKeyboardButton(text="📱 Открыть аренду", callback_data=callbacks.RENT_VIEW.new(rent_id)))
+        await sender.edit_caption(
+            callback_query.message,
+            f"✅ **Номер арендован на {rent_duration_label(hours)}**\n\n**Номер:** `{number}`\n\n"
+            f"Все СМС на этот номер будут приходить сюда.",
+            reply_markup=keyboard, priority=PRIORITY_HIGH
+        )
+    except Exception as e:
+        logging.error(f"Ошибка при аренде номера: {e}")
+        await db.release_hold(hold_id)
+        await sender.edit_caption(callback_query.message, "Произошла непредвиденная ошибка. Средства возвращены.", priority=PRIORITY_HIGH)
+
+# --- Managing rentals ---
+
+async def show_rentals(callback_query: types.CallbackQuery, db: Database):
+    await callback_query.answer()
+    rows = await db.get_user_rentals(callback_query.from_user.id)
+    keyboard = types.InlineKeyboardMarkup()
+    for rent_id, service, phone, expires_at in rows:
+        keyboard.add(types.InlineKeyboardButton(
+            text=f"{SERVICE_NAME_MAP.get(service, service)} {phone} до {str(expires_at)[:16]}",
+            callback_data=callbacks.RENT_VIEW.new(rent_id)
+        ))
+    keyboard.add(types.InlineKeyboardButton(text="📅 Арендовать номер", callback_data=callbacks.RENT_MENU.new()))
+    keyboard.add(types.InlineKeyboardButton(text="⬅️ Назад в главное меню", callback_data=callbacks.MAIN_MENU.new()))
+    caption = "**Ваши активные аренды:**" if rows else "У вас нет активных аренд."
+    await sender.edit_caption(callback_query.message, caption, reply_markup=keyboard)
+
+async def show_rental(callback_query: types.CallbackQuery, db: Database, api: SmsActivateClient, rent_id: int):
+    await callback_query.answer()
+    rental = await db.get_rental(callback_query.from_user.id, rent_id)
+    if rental is None or rental[4] != 'active':
+        await sender.edit_caption(callback_query.message, "Аренда не найдена или уже завершена.")
+        return
+    service, _, phone, expires_at, _, _, age, sms_seen = rental
+
+    messages = rent_messages(await api.get_rent_status(rent_id))
+    text = (f"📱 **Аренда: {SERVICE_NAME_MAP.get(service, service)}**\n\n**Номер:** `{phone}`\n"
+            f"**Действует до:** {str(expires_at)[:16]} (UTC)\n\n")
+    if messages is None:
+        text += "Не удалось загрузить СМС, попробуйте обновить."
+    elif not messages:
+        text += "СМС пока нет."
+    else:
+        text += f"**СМС ({len(messages)}):**\n"
+        text += "\n".join(f"• {m.get('date', '')[:16]} от {m.get('phoneFrom', '—')}: {m.get('text', '')}"
+                          for m in messages[-RENT_SMS_SHOWN:])
+    sms_count = max(sms_seen or 0, len(messages or []))
+    await sender.edit_caption(callback_query.message, text,
+                              reply_markup=build_rental_keyboard(rent_id, can_cancel_rental(age, sms_count)))
+
+async def show_extend_durations(callback_query: types.CallbackQuery, rent_id: int):
+    await callback_query.answer()
+    await sender.edit_caption(
+        callback_query.message, "На сколько продлить аренду?",
+        reply_markup=build_rent_durations_keyboard(lambda hours: callbacks.RENT_EXTEND_TIME.new(rent_id, hours),
+                                                   callbacks.RENT_VIEW.new(rent_id))
+    )
+
+async def extend_rental(callback_query: types.CallbackQuery, db: Database, api: SmsActivateClient,
+                        rent_catalog: RentCatalog, rentals: RentalScheduler, rent_id: int, hours: int):
+    user_id = callback_query.from_user.id
+
+    rental = await db.get_rental(user_id, rent_id)
+    if rental is None or rental[4] != 'active':
+        await callback_query.answer("Аренда уже завершена.", show_alert=True)
+        return
+    service, country, phone = rental[:3]
+    await callback_query.answer()
+    await sender.edit_caption(callback_query.message, "⏳ Продление аренды...", priority=PRIORITY_HIGH)
+
+    try:
+        details = (await rent_catalog.get_offers(int(country), hours, fresh=True))['services'].get(service)
+        if details is None:
+            raise Exception(f"Сервис {service} больше не сдается в аренду в стране {country}")
+        cost_kopecks = int(float(details['cost']) * 100)
+    except Exception as e:
+        logging.error(f"Не удалось определить стоимость продления: {e}")
+        await sender.edit_caption(callback_query.message, "Продление сейчас недоступно.", priority=PRIORITY_HIGH)
+        return
+
+    hold_id = await db.reserve_funds(user_id, cost_kopecks, f"Продление аренды {phone} на {hours} ч.")
+    if hold_id is None:
+        await sender.edit_caption(callback_query.message, "❌ Недостаточно средств для продления.", priority=PRIORITY_HIGH)
+        return
+
+    try:
+        response = await api.continue_rent_number(rent_id, hours)
+        if not (isinstance(response, dict) and response.get('status') == 'success'):
+            await db.release_hold(hold_id)
+            await sender.edit_caption(callback_query.message, f"❌ **Не удалось продлить аренду.**\nПричина: `{response}`. Средства возвращены.", priority=PRIORITY_HIGH)
+            return
+
+        current = rentals.rentals.get(rent_id)
+        expires_at = max(time.time(), current.expires_at if current else 0) + hours * 3600
+        if not await db.extend_rental(rent_id, expires_at, hold_id):
+            # The provider has already been paid, but the user was not charged
+            logging.critical(f"Аренда {rent_id} продлена у провайдера на {hours} ч., но продление не сохранено "
+                             f"и не списано с пользователя {user_id} (hold {hold_id})")
+            raise Exception(f"Продление аренды {rent_id} не сохранено")
+        rentals.extend(rent_id, expires_at)
+        keyboard = types.InlineKeyboardMarkup()
+        keyboard.add(types.InlineKeyboardButton(text="📱 Открыть аренду", callback_data=callbacks.RENT_VIEW.new(rent_id)))
+        await sender.edit_caption(callback_query.message,
+                                  f"✅ Аренда номера `{phone}` продлена на {rent_duration_label(hours)}",
+                                  reply_markup=keyboard, priority=PRIORITY_HIGH)
+    except Exception as e:
+        logging.error(f"Ошибка при продлении аренды: {e}")
+        await db.release_hold(hold_id)
+        await sender.edit_caption(callback_query.message, "Произошла непредвиденная ошибка. Средства возвращены.", priority=PRIORITY_HIGH)
+
+async def close_rental(callback_query: types.CallbackQuery, db: Database, api: SmsActivateClient,
+                       rentals: RentalScheduler, rent_id: int):
+    rental = await db.get_rental(callback_query.from_user.id, rent_id)
+    if rental is None or rental[4] != 'active':
+        await callback_query.answer("Аренда уже завершена.", show_alert=True)
+        return
+    _, _, phone, _, _, cost, age, sms_seen = rental
+    await callback_query.answer()
+
+    cancel = can_cancel_rental(age, sms_seen)
+    response = await api.set_rent_status(rent_id, RENT_STATUS_CANCEL if cancel else RENT_STATUS_FINISH)
+    if cancel and isinstance(response, dict) and response.get('error') == 'CANT_CANCEL':
+        # An SMS came since the last check: the rental can only be finished now
+        cancel = False
+        response = await api.set_rent_status(rent_id, RENT_STATUS_FINISH)
+    if isinstance(response, dict) and 'error' in response and response['error'] not in ('STATUS_FINISH', 'STATUS_CANCEL'):
+        logging.error(f"Не удалось закрыть аренду {rent_id}: {response['error']}")
+        await sender.edit_caption(callback_query.message, f"❌ Не удалось завершить аренду: `{response['error']}`",
+                                  reply_markup=build_rental_keyboard(rent_id, cancel))
+        return
+
+    try:
+        closed = await db.finish_rental(rent_id, 'cancelled' if cancel else 'finished', [], time.time(),
+                                        refund=(cost or 0) if cancel else 0)
+    except Exception as e:
+        logging.error(f"Ошибка при закрытии аренды {rent_id}: {e}")
+        await sender.edit_caption(callback_query.message, "Произошла ошибка, попробуйте еще раз.",
+                                  reply_markup=build_rental_keyboard(rent_id, cancel))
+        return
+    rentals.remove(rent_id)
+
+    keyboard = types.InlineKeyboardMarkup()
+    keyboard.add(types.InlineKeyboardButton(text="⬅️ К моим арендам", callback_data=callbacks.RENT_LIST.new()))
+    if closed and cancel:
+        text = f"Аренда номера `{phone}` отменена. Средства возвращены."
+    else:
+        text = f"Аренда номера `{phone}` завершена."
+    await sender.edit_caption(callback_query.message, text, reply_markup=keyboard)
+
+# --- Registration ---
+
+def register_rent_handlers(dp: Dispatcher, db: Database, api: SmsActivateClient, catalog: Catalog,
+                           rentals: RentalScheduler):
+    rent_catalog = RentCatalog(api)
+
+    router = callbacks.get_callback_router(dp)
+    router.add(callbacks.RENT_MENU, lambda c: show_rent_countries(c, catalog, rent_catalog))
+    router.add(callbacks.RENT_COUNTRY_PAGE, lambda c, page: show_rent_countries(c, catalog, rent_catalog, page))
+    router.add(callbacks.RENT_COUNTRY, show_rent_durations)
+    router.add(callbacks.RENT_TIME, lambda c, *args: show_rent_services(c, rent_catalog, *args))
+    router.add(callbacks.RENT_SERVICE_PAGE, lambda c, *args: show_rent_services(c, rent_catalog, *args))
+    router.add(callbacks.RENT_SERVICE, lambda c, *args: rent_number(c, db, api, rent_catalog, rentals, *args))
+    router.add(callbacks.RENT_LIST, lambda c: show_rentals(c, db))
+    router.add(callbacks.RENT_VIEW, lambda c, rent_id: show_rental(c, db, api, rent_id))
+    router.add(callbacks.RENT_EXTEND, show_extend_durations)
+    router.add(callbacks.RENT_EXTEND_TIME, lambda c, *args: extend_rental(c, db, api, rent_catalog, rentals, *args))
+    router.add(callbacks.RENT_CLOSE, lambda c, rent_id: close_rental(c, db, api, rentals, rent_id))
@@ -1,13 +1,33 @@
 import logging
 from aiogram import Dispatcher, types
-from bot.states import get_user_state, clear_user_state
+from bot import callbacks
+from bot.states import set_user_state, get_user_state, clear_user_state
 from bot.utils import create_paginated_keyboard
-from bot.handlers.buy_number import COUNTRY_LIST_CACHE, SERVICE_PRICE_CACHE, SERVICE_NAME_MAP
+from bot.catalog import Catalog, SERVICE_NAME_MAP
+from bot.search_index import CatalogSearch
+from bot.media import get_photo
+from bot.sender import sender
 from config import IMAGE_COUNTRIES, IMAGE_SERVICES
 
-async def search_handler(message: types.Message):
+# Search results are shown on a single page
+COUNTRY_RESULTS_LIMIT = 18
+SERVICE_RESULTS_LIMIT = 12
+
+async def start_country_search(callback_query: types.CallbackQuery):
+    """Handles the 'Search' button on the country list."""
+    await set_user_state(callback_query.from_user.id, 'searching_country')
+    await callback_query.answer()
+    await sender.answer(callback_query.message, "🔎 Введите название страны (можно латиницей):")
+
+async def start_service_search(callback_query: types.CallbackQuery, country_id: int):
+    """Handles the 'Search' button on the service list."""
+    await set_user_state(callback_query.from_user.id, 'searching_service', {'country_id': country_id})
+    await callback_query.answer()
+    await sender.answer(callback_query.message, "🔎 Введите название сервиса (например, «телега» или «whatsapp»):")
+
+async def search_handler(message: types.Message, catalog: Catalog, search: CatalogSearch):
     user_id = message.from_user.id
-    user_state = get_user_state(user_id)
+    user_state = await get_user_state(user_id)
 
     if not user_state:
         return # Not in a search state, do nothing
@@ -24,61 +44,69 @@ async def search_handler(message: types.Message):
         pass # Ignore if we can't delete
 
     if state == 'searching_country':
-        await handle_country_search(message, query)
+        await handle_country_search(message, query, catalog, search)
     elif state == 'searching_service':
         country_id = user_state.get('context', {}).get('country_id')
         if country_id is not None:
-            await handle_service_search(message, query, country_id)
+            await handle_service_search(message, query, country_id, catalog, search)
 
-    clear_user_state(user_id)
+    await clear_user_state(user_id)
 
-async def handle_country_search(message: types.Message, query: str):
-    filtered_countries = [c for c in COUNTRY_LIST_CACHE if query.lower() in c['rus'].lower()]
+async def handle_country_search(message: types.Message, query: str, catalog: Catalog, search: CatalogSearch):
+    await catalog.get_countries()
+    filtered_countries = search.search_countries(query, limit=COUNTRY_RESULTS_LIMIT)
 
     if not filtered_countries:
-        await message.answer("По вашему запросу страны не найдены.")
+        await sender.answer(message, "По вашему запросу страны не найдены.")
         return
 
-    buttons = [(f"{c['rus']}", f"buy_country:{c['id']}") for c in filtered_countries]
-    keyboard = create_paginated_keyboard(buttons, 0, 18, "buy_country_page", columns=3)
-    keyboard.inline_keyboard.append([types.InlineKeyboardButton(text="⬅️ Назад к странам", callback_data="buy_menu")])
+    buttons = [(c.rus, callbacks.BUY_COUNTRY.new(c.id)) for c in filtered_countries]
+    keyboard = create_paginated_keyboard(buttons, 0, 18, callbacks.BUY_COUNTRY_PAGE.new, columns=3)
+    keyboard.inline_keyboard.append([types.InlineKeyboardButton(text="⬅️ Назад к странам", callback_data=callbacks.BUY_MENU.new())])
 
-    await message.answer_photo(
-        photo=IMAGE_COUNTRIES,
+    await sender.answer_photo(
+        message,
+        photo=get_photo(IMAGE_COUNTRIES),
         caption=f"Результаты поиска по запросу '{query}':",
         reply_markup=keyboard
     )
 
-async def handle_service_search(message: types.Message, query: str, country_id: int):
-    country_prices = SERVICE_PRICE_CACHE.get(country_id, {})
+async def handle_service_search(message: types.Message, query: str, country_id: int, catalog: Catalog,
+                                search: CatalogSearch):
+    country_prices = await catalog.get_prices(country_id)
     if not country_prices:
-        await message.answer("Сначала выберите страну.")
+        await sender.answer(message, "Сначала выберите страну.")
         return
 
     filtered_services = [
-        (sc, dt) for sc, dt in country_prices.items()
-        if query.lower() in SERVICE_NAME_MAP.get(sc, sc).lower()
+        (sc, country_prices[sc]) for sc in search.search_services(query, country_prices, limit=SERVICE_RESULTS_LIMIT)
     ]
 
     if not filtered_services:
-        await message.answer("По вашему запросу сервисы не найдены.")
+        await sender.answer(message, "По вашему запросу сервисы не найдены.")
         return
 
     buttons = []
-    for service_code, details in filtered_services:
+    for service_code, price in filtered_services:
         full_name = SERVICE_NAME_MAP.get(service_code, service_code)
-        button_text = f"{full_name} - {details['cost']} RUB ({details['count']} шт.)"
-        buttons.append((button_text, f"buy_service:{service_code}:{country_id}"))
+        button_text = f"{full_name} - {price.cost} RUB ({price.count} шт.)"
+        buttons.append((button_text, callbacks.BUY_SERVICE.new(service_code, country_id)))
 
-    keyboard = create_paginated_keyboard(buttons, 0, 12, f"buy_service_page:{country_id}", columns=2)
-    keyboard.inline_keyboard.append([types.InlineKeyboardButton(text="⬅️ Назад к странам", callback_data="buy_menu")])
+    keyboard = create_paginated_keyboard(buttons, 0, 12, lambda page: callbacks.BUY_SERVICE_PAGE.new(country_id, page),
+                                         columns=2)
+    keyboard.inline_keyboard.append([types.InlineKeyboardButton(text="⬅️ Назад к странам", callback_data=callbacks.BUY_MENU.new())])
 
-    await message.answer_photo(
-        photo=IMAGE_SERVICES,
+    await sender.answer_photo(
+        message,
+        photo=get_photo(IMAGE_SERVICES),
         caption=f"Результаты поиска по запросу '{query}':",
         reply_markup=keyboard
     )
 
-def register_search_handlers(dp: Dispatcher):
+def register_search_handlers(dp: Dispatcher, catalog: Catalog):
+    search = CatalogSearch(catalog)
+    router = callbacks.get_callback_router(dp)
+    router.add(callbacks.SEARCH_COUNTRY, start_country_search)
+    router.add(callbacks.SEARCH_SERVICE, start_service_search)
     # This handler should only work for users who are in a search state
-    dp.register_message_handler(search_handler, content_types=['text'], state="*")
+    dp.register_message_handler(lambda msg: search_handler(msg, catalog, search), content_types=['text'], state="*")
@@ -1,7 +1,9 @@
 from aiogram import Dispatcher, types
-from aiogram.dispatcher.filters import Text
+from bot import callbacks
 from bot.keyboards.inline import main_menu_keyboard, account_menu_keyboard
 from bot.db import Database
+from bot.media import get_photo
+from bot.sender import sender
 from config import IMAGE_MAIN_MENU, IMAGE_PROFILE
 
 async def start_handler(message: types.Message, db: Database):
@@ -18,15 +20,16 @@ async def start_handler(message: types.Message, db: Database):
         except (ValueError, IndexError):
             pass
 
-    db.add_user(user.id, user.username, user.first_name, referred_by)
+    await db.add_user(user.id, user.username, user.first_name, referred_by)
 
     welcome_text = (
         f"Добро пожаловать в Uni SMS, {user.first_name}!\n\n"
         "Ваш универсальный бот для работы с виртуальными номерами. "
         "Используйте меню для навигации."
     )
-    await message.answer_photo(
-        photo=IMAGE_MAIN_MENU,
+    await sender.answer_photo(
+        message,
+        photo=get_photo(IMAGE_MAIN_MENU),
         caption=welcome_text,
         reply_markup=main_menu_keyboard()
     )
@@ -34,16 +37,18 @@ async def start_handler(message: types.Message, db: Database):
 async def main_menu_callback_handler(callback_query: types.CallbackQuery):
     """Handles the 'Back to Main Menu' button."""
     await callback_query.answer()
-    await callback_query.message.edit_media(
-        media=types.InputMediaPhoto(media=IMAGE_MAIN_MENU, caption="Главное меню:"),
+    await sender.edit_media(
+        callback_query.message,
+        media=types.InputMediaPhoto(media=get_photo(IMAGE_MAIN_MENU), caption="Главное меню:"),
         reply_markup=main_menu_keyboard()
     )
 
 async def account_menu_callback_handler(callback_query: types.CallbackQuery):
     """Handles the 'My Account' button."""
     await callback_query.answer()
-    await callback_query.message.edit_media(
-        media=types.InputMediaPhoto(media=IMAGE_PROFILE, caption="Личный кабинет:"),
+    await sender.edit_media(
+        callback_query.message,
+        media=types.InputMediaPhoto(media=get_photo(IMAGE_PROFILE), caption="Личный кабинет:"),
         reply_markup=account_menu_keyboard()
     )
 
@@ -52,11 +57,6 @@ def register_start_handlers(dp: Dispatcher, db: Database):
         lambda msg: start_handler(msg, db),
         commands=['start']
     )
-    dp.register_callback_query_handler(
-        main_menu_callback_handler,
-        Text(equals="main_menu")
-    )
-    dp.register_callback_query_handler(
-        account_menu_callback_handler,
-        Text(equals="account_menu")
-    )
+    router = callbacks.get_callback_router(dp)
+    router.add(callbacks.MAIN_MENU, main_menu_callback_handler)
+    router.add(callbacks.ACCOUNT_MENU, account_menu_callback_handler)
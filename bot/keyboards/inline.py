@@ -1,4 +1,5 @@
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+from bot import callbacks
 
 def main_menu_keyboard():
     """
@@ -6,10 +7,13 @@ def main_menu_keyboard():
     """
     keyboard = [
         [
-            InlineKeyboardButton(text="🛒 Купить номер", callback_data="buy_menu"),
+            InlineKeyboardButton(text="🛒 Купить номер", callback_data=callbacks.BUY_MENU.new()),
         ],
         [
-            InlineKeyboardButton(text="👤 Мой кабинет", callback_data="account_menu"),
+            InlineKeyboardButton(text="📅 Аренда номера", callback_data=callbacks.RENT_MENU.new()),
+        ],
+        [
+            InlineKeyboardButton(text="👤 Мой кабинет", callback_data=callbacks.ACCOUNT_MENU.new()),
         ],
         # Support feature is disabled for now
         # [
@@ -24,14 +28,14 @@ def account_menu_keyboard():
     """
     keyboard = [
         [
-            InlineKeyboardButton(text="💰 Баланс", callback_data="check_balance"),
-            InlineKeyboardButton(text="➕ Пополнить", callback_data="top_up_balance"),
+            InlineKeyboardButton(text="💰 Баланс", callback_data=callbacks.CHECK_BALANCE.new()),
+            InlineKeyboardButton(text="➕ Пополнить", callback_data=callbacks.TOP_UP_BALANCE.new()),
         ],
         [
-            InlineKeyboardButton(text="📚 История операций", callback_data="history_menu"),
+            InlineKeyboardButton(text="📚 История операций", callback_data=callbacks.HISTORY_MENU.new()),
         ],
         [
-            InlineKeyboardButton(text="⬅️ Назад в главное меню", callback_data="main_menu"),
+            InlineKeyboardButton(text="⬅️ Назад в главное меню", callback_data=callbacks.MAIN_MENU.new()),
         ]
     ]
     return InlineKeyboardMarkup(inline_keyboard=keyboard)
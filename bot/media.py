@@ -0,0 +1,46 @@
+# This file keeps track of the menu header images on Telegram's side.
+# Each image is uploaded once and afterwards sent by its file_id, which is
+# stored in the database keyed by the file's content hash, so restarts reuse it.
+
+import asyncio
+import hashlib
+import logging
+from aiogram import Bot, types
+from bot.db import Database
+
+MEDIA_FILE_IDS = {}  # {image_path: file_id}
+
+def get_photo(path: str):
+    """Returns the image's file_id if it has been uploaded, otherwise the file itself."""
+    file_id = MEDIA_FILE_IDS.get(path)
+    return file_id if file_id else types.InputFile(path)
+
+def _file_hash(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+async def preload_media(bot: Bot, db: Database, upload_chat_id: int, paths):
+    """
+    Makes sure every image has a file_id. Images missing from the database are
+    uploaded to upload_chat_id (the upload message is deleted right away).
+    """
+    bot_id = (await bot.get_me()).id
+    for path in paths:
+        try:
+            content_hash = await asyncio.to_thread(_file_hash, path)
+            file_id = await db.get_media_file_id(bot_id, content_hash)
+            if file_id is None:
+                message = await bot.send_photo(upload_chat_id, types.InputFile(path), disable_notification=True)
+                file_id = message.photo[-1].file_id
+                await db.save_media_file_id(bot_id, content_hash, file_id)
+                try:
+                    await message.delete()
+                except Exception:
+                    pass
+                logging.info(f"Изображение {path} загружено в Telegram.")
+            MEDIA_FILE_IDS[path] = file_id
+        except Exception as e:
+            logging.error(f"Не удалось подготовить изображение {path}: {e}")
@@ -0,0 +1,349 @@
+import asyncio
+import contextvars
+import functools
+import inspect
+import logging
+import time
+from collections import deque
+from aiohttp import web
+from aiogram import types
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from bot.callbacks import action_name
+
+# Histogram bucket bounds (in seconds), from fast dict lookups to slow upstream calls.
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# Recent observations kept per series for the p50/p95/p99 shown by /stats.
+QUANTILE_WINDOW = 1024
+# How often the event-loop lag is sampled (in seconds).
+LOOP_LAG_INTERVAL = 0.5
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def quantile(sorted_values, q: float) -> float:
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * q))]
+
+
+class _HistogramSeries:
+    __slots__ = ('buckets', 'counts', 'sum', 'count', 'recent')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+        self.recent = deque(maxlen=QUANTILE_WINDOW)
+
+    def observe(self, value: float):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+        self.recent.append(value)
+
+    def quantiles(self, qs=(0.5, 0.95, 0.99)):
+        """Returns the requested quantiles of the recent observations, or None if there are none."""
+        if not self.recent:
+            return None
+        values = sorted(self.recent)
+        return [quantile(values, q) for q in qs]
+
+
+class _CounterSeries:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: int = 1):
+        self.value += amount
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name: str, help: str, labels=(), registry=None):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._series = {}
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def labels(self, *values):
+        series = self._series.get(values)
+        if series is None:
+            series = self._series[values] = self._new_series()
+        return series
+
+    def series(self) -> dict:
+        return self._series
+
+    def _new_series(self):
+        raise NotImplementedError
+
+    def render(self) -> list:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"] + self._render_samples()
+
+    def _render_samples(self) -> list:
+        raise NotImplementedError
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str, labels=(), buckets=DEFAULT_BUCKETS, registry=None):
+        self.buckets = tuple(buckets)
+        super().__init__(name, help, labels, registry)
+
+    def _new_series(self):
+        return _HistogramSeries(self.buckets)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def _render_samples(self) -> list:
+        lines = []
+        for values, series in self._series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, series.counts):
+                cumulative += count
+                labels = _format_labels(self.label_names, values, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.label_names, values, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{labels} {series.count}")
+            labels = _format_labels(self.label_names, values)
+            lines.append(f"{self.name}_sum{labels} {_format_value(series.sum)}")
+            lines.append(f"{self.name}_count{labels} {series.count}")
+        return lines
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def _new_series(self):
+        return _CounterSeries()
+
+    def inc(self, amount: int = 1):
+        self.labels().inc(amount)
+
+    def _render_samples(self) -> list:
+        return [f"{self.name}{_format_labels(self.label_names, values)} {series.value}"
+                for values, series in self._series.items()]
+
+
+class Gauge(_Metric):
+    """A value read from a callback at scrape time."""
+    kind = 'gauge'
+
+    def __init__(self, name: str, help: str, read, registry=None):
+        self.read = read
+        super().__init__(name, help, (), registry)
+
+    def value(self):
+        try:
+            return self.read()
+        except Exception as e:
+            logging.error(f"Не удалось прочитать метрику {self.name}: {e}")
+            return None
+
+    def _render_samples(self) -> list:
+        value = self.value()
+        return [] if value is None else [f"{self.name} {_format_value(value)}"]
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric: _Metric):
+        # Re-registering a name replaces the old metric, so gauges can be rebound to new objects
+        self.metrics[metric.name] = metric
+
+    def render(self) -> str:
+        """Returns every metric in the Prometheus text exposition format."""
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+HANDLER_LATENCY = Histogram('bot_handler_seconds', "Time spent in an update handler.", labels=('handler',))
+HANDLER_ERRORS = Counter('bot_handler_errors_total', "Handler calls that raised.", labels=('handler',))
+THROTTLED = Counter('bot_throttled_total', "Messages and buttons turned away by the per-user rate limits.",
+                    labels=('group',))
+API_LATENCY = Histogram('sms_activate_request_seconds', "Duration of SMS-Activate calls.", labels=('method',))
+API_ERRORS = Counter('sms_activate_errors_total', "SMS-Activate calls that raised or returned an error.", labels=('method',))
+DB_LATENCY = Histogram('db_call_seconds', "Duration of database calls, including queueing.", labels=('method',))
+DB_ERRORS = Counter('db_errors_total', "Database calls that raised.", labels=('method',))
+LOOP_LAG = Histogram('event_loop_lag_seconds', "How late a periodic timer fires on the event loop.")
+
+
+# --- Instrumentation ---
+
+_current_route = contextvars.ContextVar('metrics_route', default=None)
+
+
+def route_name(event) -> str:
+    """A low-cardinality name of the handler an update is routed to, e.g. 'callback:buy_country'."""
+    if isinstance(event, types.CallbackQuery):
+        return f"callback:{action_name(event.data)}"
+    command = event.get_command(pure=True) if event.is_command() else None
+    return f"message:/{command}" if command else "message:text"
+
+
+class MetricsMiddleware(BaseMiddleware):
+    """
+    Records the latency of every handled message and callback query, labelled with
+    the route (command or callback-data prefix), and counts the ones that raised.
+    The handlers are registered as lambdas, so the route names them better than
+    the handler object does.
+    """
+    async def on_pre_process_update(self, update: types.Update, data: dict):
+        _current_route.set(None)
+
+    async def on_process_message(self, message: types.Message, data: dict):
+        self._started(route_name(message), data)
+
+    async def on_process_callback_query(self, callback_query: types.CallbackQuery, data: dict):
+        self._started(route_name(callback_query), data)
+
+    async def on_post_process_message(self, message: types.Message, results, data: dict):
+        self._finished(data)
+
+    async def on_post_process_callback_query(self, callback_query: types.CallbackQuery, results, data: dict):
+        self._finished(data)
+
+    async def on_pre_process_error(self, update: types.Update, error: Exception, data: dict):
+        route = _current_route.get()
+        if route is not None:
+            HANDLER_ERRORS.labels(route).inc()
+
+    @staticmethod
+    def _started(route: str, data: dict):
+        _current_route.set(route)
+        data['metrics_route'] = route
+        data['metrics_started'] = time.perf_counter()
+
+    @staticmethod
+    def _finished(data: dict):
+        started = data.get('metrics_started')
+        if started is not None:
+            HANDLER_LATENCY.labels(data['metrics_route']).observe(time.perf_counter() - started)
+
+
+def _timed(method, series: _HistogramSeries, errors: _CounterSeries, is_error):
+    @functools.wraps(method)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            result = await method(*args, **kwargs)
+        except Exception:
+            errors.inc()
+            raise
+        finally:
+            series.observe(time.perf_counter() - started)
+        if is_error is not None and is_error(result):
+            errors.inc()
+        return result
+    return wrapper
+
+
+def instrument(obj, latency: Histogram, errors: Counter, is_error=None, exclude=('close',)):
+    """
+    Replaces every public coroutine method of obj (on the instance only) with a
+    timed version that records into latency and errors, labelled with the method name.
+    is_error(result) may flag results that are errors without raising.
+    """
+    for name in dir(type(obj)):
+        if name.startswith('_') or name in exclude:
+            continue
+        method = getattr(obj, name)
+        if inspect.iscoroutinefunction(method):
+            setattr(obj, name, _timed(method, latency.labels(name), errors.labels(name), is_error))
+    return obj
+
+
+def is_api_error(result) -> bool:
+    return isinstance(result, dict) and 'error' in result
+
+
+class LoopLagMonitor:
+    """Measures how late a periodic sleep wakes up, i.e. how long the event loop was blocked."""
+    def __init__(self, interval: float = LOOP_LAG_INTERVAL):
+        self.interval = interval
+        self.lag = 0.0
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            self.lag = max(0.0, loop.time() - expected)
+            LOOP_LAG.observe(self.lag)
+
+
+# --- Reporting ---
+
+def summary(histogram: Histogram, limit: int = None) -> list:
+    """Returns (label, count, p50, p95, p99) rows of a labelled histogram, slowest p95 first."""
+    rows = []
+    for values, series in histogram.series().items():
+        quantiles = series.quantiles()
+        if quantiles is not None:
+            rows.append((':'.join(map(str, values)) or histogram.name, series.count, *quantiles))
+    rows.sort(key=lambda row: row[3], reverse=True)
+    return rows[:limit] if limit is not None else rows
+
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    return web.Response(text=REGISTRY.render(), headers={'Content-Type': PROMETHEUS_CONTENT_TYPE})
+
+
+async def start_metrics_server(host: str, port: int, ready=None) -> web.AppRunner:
+    """
+    Serves GET /metrics for Prometheus on host:port. If ready (a callable) is
+    given, GET /ready answers 200 once it returns True and 503 until then.
+    """
+    app = web.Application()
+    app.router.add_get('/metrics', metrics_handler)
+    if ready is not None:
+        async def ready_handler(request: web.Request) -> web.Response:
+            return web.Response(status=200 if ready() else 503)
+        app.router.add_get('/ready', ready_handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logging.info(f"Метрики доступны на http://{host}:{port}/metrics")
+    return runner
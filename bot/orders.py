@@ -0,0 +1,78 @@
+import asyncio
+from aiogram import Bot
+from aiogram.utils.exceptions import MessageNotModified
+from bot.catalog import SERVICE_NAME_MAP
+from bot.db import Database
+from bot.router import ProviderRouter, SOLD_OUT_ERRORS
+from bot.sender import sender, PRIORITY_HIGH
+
+# Quantities offered for a bulk order; no order may ask for more than the largest.
+BULK_QUANTITIES = (5, 10, 20, 50)
+BULK_MAX_QUANTITY = max(BULK_QUANTITIES)
+# get_number calls in flight for one order.
+BULK_CONCURRENCY = 5
+# How often the progress of the acquisition is shown to the user (in seconds).
+PROGRESS_INTERVAL = 1
+
+ORDER_STATUSES = {'active': "⏳ ожидает СМС", 'cancelled': "❌ отменена", 'expired': "⌛ истекла"}
+
+
+async def acquire_numbers(router: ProviderRouter, service: str, country: int, quantity: int, acquired: list,
+                          max_cost: float = None, save=None):
+    """
+    Buys up to `quantity` numbers with at most BULK_CONCURRENCY get_number calls in flight,
+    appending each successful response to `acquired` as it arrives, so the caller can
+    show progress. If given, `save(response)` is awaited first and a number it returns
+    False for is left out. Stops asking once no provider has numbers left, or once a provider
+    failed in a way that may have sold a number anyway. Returns the last error and those
+    uncertain responses.
+    """
+    semaphore = asyncio.Semaphore(BULK_CONCURRENCY)
+    last_error = None
+    sold_out = False
+    uncertain = []
+
+    async def buy_one():
+        nonlocal last_error, sold_out
+        async with semaphore:
+            if sold_out:
+                return
+            response = await router.get_number(service, country, max_cost)
+        if isinstance(response, dict) and 'activation_id' in response:
+            if save is None or await save(response):
+                acquired.append(response)
+            return
+        last_error = response
+        if isinstance(response, dict) and response.get('uncertain'):
+            uncertain.append(response)
+            sold_out = True
+        elif isinstance(response, dict) and response.get('error') in SOLD_OUT_ERRORS:
+            sold_out = True
+
+    await asyncio.gather(*(buy_one() for _ in range(quantity)))
+    return last_error, uncertain
+
+
+def render_order(service: str, purchases) -> str:
+    """The status message of a bulk order, from its (phone_number, status, sms_code, cost) rows."""
+    lines = [f"📦 **Заказ: {SERVICE_NAME_MAP.get(service, service)}, {len(purchases)} шт.**", ""]
+    for i, (phone, status, sms_code, _) in enumerate(purchases, 1):
+        state = f"✉️ `{sms_code}`" if status == 'completed' else ORDER_STATUSES.get(status, status)
+        lines.append(f"{i}. `{phone}` — {state}")
+
+    completed = [cost or 0 for _, status, _, cost in purchases if status == 'completed']
+    lines.append("")
+    lines.append(f"Получено кодов: {len(completed)} из {len(purchases)}")
+    if not any(status == 'active' for _, status, _, _ in purchases):
+        refunded = sum(cost or 0 for _, status, _, cost in purchases if status != 'completed')
+        lines.append(f"Заказ завершен. Списано: {sum(completed) / 100:.2f} RUB, возвращено: {refunded / 100:.2f} RUB.")
+    return "\n".join(lines)
+
+
+async def update_order_message(bot: Bot, db: Database, chat_id: int, message_id: int, hold_id: int, service: str):
+    """Re-renders a bulk order's status message from the database."""
+    purchases = await db.get_order_purchases(hold_id)
+    try:
+        await sender.edit_message_text(bot, chat_id, message_id, render_order(service, purchases), PRIORITY_HIGH)
+    except MessageNotModified:
+        pass
@@ -0,0 +1,253 @@
+import asyncio
+import logging
+import random
+import time
+from aiogram import Bot
+from aiogram.utils.exceptions import MessageToEditNotFound, MessageCantBeEdited
+from bot.api import DEFAULT_PROVIDER
+from bot.broadcast import UNREACHABLE_ERRORS
+from bot.db import Database
+from bot.metrics import Counter
+from bot.orders import update_order_message
+from bot.router import ProviderRouter
+from bot.sender import sender, PRIORITY_HIGH
+
+# Jobs claimed per round; a round runs them grouped by kind.
+CLAIM_BATCH_SIZE = 100
+# Jobs of one kind running at once.
+KIND_CONCURRENCY = 10
+# A claimed job is handed out again if nobody reports its result within this time (in seconds).
+LEASE_SECONDS = 120
+# Retries back off exponentially: BACKOFF_BASE * 2^(attempt - 1) seconds, capped and jittered.
+BACKOFF_BASE = 5
+BACKOFF_MAX = 600
+MAX_ATTEMPTS = 12
+# Longest sleep between rounds when nothing is due (in seconds).
+IDLE_INTERVAL = 30
+# Open holds older than this that no active purchase owns are released (in seconds).
+ORPHAN_HOLD_AGE = 300
+ORPHAN_SWEEP_INTERVAL = 300
+# A reconcile job looks at the provider's activations this long after the
+# failed purchase, so a late answer has landed (in seconds)...
+RECONCILE_DELAY = 30
+# ...and gives purchases being saved right then this long to appear in the database.
+RECONCILE_GRACE = 5
+# Finished jobs are kept this many days.
+JOB_RETENTION_DAYS = 7
+
+# setStatus errors meaning the activation is already closed upstream: nothing is left to do.
+SETTLED_ERRORS = {'NO_ACTIVATION', 'STATUS_CANCEL', 'STATUS_FINISH', 'ALREADY_FINISH', 'ALREADY_CANCEL', 'BAD_STATUS'}
+
+OUTBOX_JOBS = Counter('outbox_jobs_total', "Outbox jobs run, by kind and result.", labels=('kind', 'result'))
+
+
+class JobFailed(Exception):
+    """Raised by a job handler when retrying cannot help."""
+
+
+def set_status_job(provider: str, activation_id: int, status: int):
+    return ('set_status', f"set_status:{provider}:{activation_id}:{status}",
+            {'provider': provider, 'activation_id': activation_id, 'status': status})
+
+
+def notify_job(chat_id: int, text: str, key: str):
+    return 'notify', f"notify:{key}", {'chat_id': chat_id, 'text': text}
+
+
+def order_update_job(chat_id: int, message_id: int, hold_id: int, service: str, key: str):
+    return ('order_update', f"order_update:{key}",
+            {'chat_id': chat_id, 'message_id': message_id, 'hold_id': hold_id, 'service': service})
+
+
+def reconcile_job(provider: str, service: str, country, after_id, count: int, key: str):
+    return ('reconcile', f"reconcile:{provider}:{key}",
+            {'provider': provider, 'service': service, 'country': str(country), 'after_id': after_id, 'count': count})
+
+
+def reconcile_jobs(responses, service: str, country, key: str) -> list:
+    """One reconcile job per provider for the uncertain get_number responses of a purchase."""
+    calls = {}
+    for response in responses:
+        calls.setdefault(response['provider'], []).append(response.get('after_id'))
+    return [reconcile_job(provider, service, country, None if None in after_ids else min(after_ids),
+                          len(after_ids), key)
+            for provider, after_ids in calls.items()]
+
+
+def backoff(attempts: int) -> float:
+    """Returns the delay before the next attempt of a job that has failed `attempts` times."""
+    return min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (attempts - 1)) * random.uniform(0.8, 1.2)
+
+
+class Outbox:
+    """
+    Runs the side effects of state changes (setStatus calls, notifications) from the
+    `jobs` table, so they survive restarts. Jobs are written in the same transaction
+    as the change they follow from and carry an idempotency key, so a job is never
+    enqueued twice. Each round claims the due jobs under a lease, runs them grouped
+    by kind with bounded concurrency, and saves all results in one write; failed
+    jobs are retried with exponential backoff.
+    The outbox also releases holds left open by a process that stopped mid-purchase.
+    """
+    def __init__(self, router: ProviderRouter, bot: Bot, db: Database):
+        self.router = router
+        self.bot = bot
+        self.db = db
+        self.handlers = {'set_status': self._set_status, 'notify': self._notify, 'order_update': self._update_order,
+                         'reconcile': self._reconcile}
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def wake(self):
+        """Makes the outbox look for due jobs now instead of at its next scheduled round."""
+        self._wakeup.set()
+
+    async def enqueue(self, jobs, delay: float = 0):
+        await self.db.enqueue_jobs(jobs, time.time() + delay)
+        self.wake()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        await self.db.purge_jobs(JOB_RETENTION_DAYS)
+        next_orphan_sweep = 0
+        while True:
+            self._wakeup.clear()
+            try:
+                if time.monotonic() >= next_orphan_sweep:
+                    await self._release_orphans()
+                    next_orphan_sweep = time.monotonic() + ORPHAN_SWEEP_INTERVAL
+                if await self.run_due() == CLAIM_BATCH_SIZE:
+                    continue
+                next_run_at = await self.db.next_job_time()
+                delay = IDLE_INTERVAL if next_run_at is None else max(0.0, next_run_at - time.time())
+                delay = min(delay, IDLE_INTERVAL, next_orphan_sweep - time.monotonic())
+            except Exception as e:
+                logging.error(f"Ошибка очереди заданий: {e}")
+                delay = 1
+
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=max(0.0, delay))
+            except asyncio.TimeoutError:
+                pass
+
+    async def _release_orphans(self):
+        released = await self.db.release_orphan_holds(ORPHAN_HOLD_AGE)
+        if released:
+            logging.warning(f"Возвращены средства по {released} незавершенным покупкам")
+
+    async def run_due(self) -> int:
+        """Runs one round of due jobs; returns how many were claimed."""
+        now = time.time()
+        jobs = await self.db.claim_jobs(now, CLAIM_BATCH_SIZE, now + LEASE_SECONDS)
+        if not jobs:
+            return 0
+
+        by_kind = {}
+        for job in jobs:
+            by_kind.setdefault(job[1], []).append(job)
+        results = await asyncio.gather(*(self._run_kind(kind, batch) for kind, batch in by_kind.items()))
+
+        done, retries, failures = [], [], []
+        for kind_done, kind_retries, kind_failures in results:
+            done += kind_done
+            retries += kind_retries
+            failures += kind_failures
+        await self.db.settle_jobs(done, retries, failures)
+        return len(jobs)
+
+    async def _run_kind(self, kind: str, batch):
+        """Runs the jobs of one kind concurrently; returns their (done, retries, failures)."""
+        handler = self.handlers.get(kind)
+        semaphore = asyncio.Semaphore(KIND_CONCURRENCY)
+
+        async def run_one(payload):
+            if handler is None:
+                raise JobFailed(f"Неизвестный тип задания: {kind}")
+            async with semaphore:
+                await handler(payload)
+
+        outcomes = await asyncio.gather(*(run_one(payload) for _, _, payload, _ in batch), return_exceptions=True)
+
+        done, retries, failures = [], [], []
+        for (job_id, _, _, attempts), outcome in zip(batch, outcomes):
+            if outcome is None:
+                done.append(job_id)
+                OUTBOX_JOBS.labels(kind, 'done').inc()
+            elif isinstance(outcome, JobFailed) or attempts >= MAX_ATTEMPTS:
+                logging.error(f"Задание #{job_id} ({kind}) не выполнено после {attempts} попыток: {outcome}")
+                failures.append((job_id, str(outcome)))
+                OUTBOX_JOBS.labels(kind, 'failed').inc()
+            else:
+                logging.warning(f"Задание #{job_id} ({kind}) будет повторено: {outcome}")
+                retries.append((job_id, time.time() + backoff(attempts), str(outcome)))
+                OUTBOX_JOBS.labels(kind, 'retried').inc()
+        return done, retries, failures
+
+    # --- Handlers ---
+
+    async def _set_status(self, payload: dict):
+        # Jobs enqueued before providers were tracked belong to SMS-Activate
+        provider = self.router.provider(payload.get('provider', DEFAULT_PROVIDER))
+        if provider is None:
+            raise JobFailed(f"Провайдер {payload.get('provider')} не настроен")
+        response = await provider.set_status(payload['activation_id'], payload['status'])
+        if isinstance(response, dict) and 'error' in response and response['error'] not in SETTLED_ERRORS:
+            raise Exception(f"setStatus {payload['status']} для активации {payload['activation_id']}: {response['error']}")
+
+    async def _reconcile(self, payload: dict):
+        """
+        Cancels numbers sold by get_number calls whose answer never reached the bot.
+        Only activations such a call could have created are looked at: same service
+        and country, issued after the last ID the bot had seen from the provider
+        before the call, and with no purchase record. A call sells at most one
+        number, so when there are more of them than failed calls some belong to
+        someone else on the same account, and none is cancelled.
+        """
+        provider = self.router.provider(payload['provider'])
+        if provider is None:
+            raise JobFailed(f"Провайдер {payload['provider']} не настроен")
+        response = await provider.get_active_activations()
+        if isinstance(response, dict) and response.get('error') == 'NO_ACTIVATIONS':
+            return
+        if not (isinstance(response, dict) and isinstance(response.get('activeActivations'), list)):
+            raise Exception(f"getActiveActivations: {response}")
+        service, country, after_id = payload['service'], payload.get('country'), payload.get('after_id')
+        issued = {int(item['activationId']) for item in response['activeActivations']
+                  if item.get('serviceCode', service) == service
+                  and (country is None or str(item.get('countryCode', country)) == country)
+                  and (after_id is None or int(item['activationId']) > after_id)}
+        if not issued:
+            return
+        await asyncio.sleep(RECONCILE_GRACE)
+        orphans = issued - await self.db.get_known_activations(provider.name, list(issued))
+        if len(orphans) > payload.get('count', 1):
+            logging.error(f"Активаций {payload['provider']} без записи о покупке больше, чем неудачных покупок, "
+                          f"ни одна не отменена: {sorted(orphans)}")
+        elif orphans:
+            logging.warning(f"Отменяю активации {payload['provider']} без записи о покупке: {sorted(orphans)}")
+            await self.enqueue([set_status_job(provider.name, activation_id, 8) for activation_id in orphans])
+
+    async def _notify(self, payload: dict):
+        try:
+            await sender.send_message(self.bot, payload['chat_id'], payload['text'], PRIORITY_HIGH)
+        except UNREACHABLE_ERRORS as e:
+            raise JobFailed(str(e))
+
+    async def _update_order(self, payload: dict):
+        try:
+            await update_order_message(self.bot, self.db, payload['chat_id'], payload['message_id'],
+                                       payload['hold_id'], payload['service'])
+        except UNREACHABLE_ERRORS + (MessageToEditNotFound, MessageCantBeEdited) as e:
+            raise JobFailed(str(e))
@@ -0,0 +1,235 @@
+import asyncio
+import heapq
+import logging
+import time
+from bot.api import SmsActivateClient
+from bot.catalog import CacheEntry
+from bot.db import Database
+from bot.outbox import Outbox, notify_job
+
+# Rental periods offered to users (in hours).
+RENT_DURATIONS = (4, 24, 72, 168)
+# How long cached rental offers count as fresh (in seconds).
+RENT_OFFERS_TTL = 5 * 60
+# How often an active rental is checked for new SMS (in seconds).
+RENT_POLL_INTERVAL = 60
+# getRentStatus calls in flight at once.
+RENT_CHECK_CONCURRENCY = 10
+# A rental may be cancelled for a refund this long after it started, if no SMS came (in seconds).
+RENT_CANCEL_WINDOW = 20 * 60
+
+# getRentStatus errors meaning the rental is already closed upstream.
+RENT_CLOSED_ERRORS = {'STATUS_CANCEL', 'STATUS_FINISH', 'NO_ID_RENT'}
+
+
+def rent_messages(response):
+    """
+    Returns the SMS of a getRentStatus response, oldest first, as dicts with
+    'phoneFrom', 'text' and 'date'; None if the response is an error.
+    """
+    if isinstance(response, dict) and response.get('error') == 'STATUS_WAIT_CODE':
+        return []
+    if not isinstance(response, dict) or response.get('status') != 'success':
+        return None
+    values = response.get('values') or {}
+    messages = list(values.values()) if isinstance(values, dict) else list(values)
+    return sorted(messages, key=lambda m: str(m.get('date', '')))
+
+
+def rent_duration_label(hours: int) -> str:
+    if hours % 24:
+        return f"{hours} ч."
+    return f"{hours // 24} дн."
+
+
+class RentCatalog:
+    """Caches the rental offers (countries, services and prices) per country and period."""
+    def __init__(self, api: SmsActivateClient):
+        self.api = api
+        self._offers = {}
+
+    async def get_offers(self, country: int, hours: int, fresh: bool = False) -> dict:
+        """
+        Returns the getRentServicesAndCountries response: {'countries': ..., 'services':
+        {code: {'cost': ..., 'quant': ...}}}. Pass fresh=True when charging.
+        """
+        entry = self._offers.get((country, hours))
+        if entry is None or fresh or entry.age >= RENT_OFFERS_TTL:
+            response = await self.api.get_rent_services_and_countries(country, hours)
+            if not isinstance(response, dict) or not isinstance(response.get('services'), dict):
+                raise Exception(f"Invalid rent offers: {response}")
+            entry = self._offers[(country, hours)] = CacheEntry(response)
+        return entry.value
+
+
+class Rental:
+    """An active rental as the scheduler tracks it."""
+    __slots__ = ('rent_id', 'chat_id', 'phone', 'expires_at', 'sms_seen', 'version')
+
+    def __init__(self, rent_id: int, chat_id: int, phone: str, expires_at: float, sms_seen: int = 0):
+        self.rent_id = rent_id
+        self.chat_id = chat_id
+        self.phone = phone
+        self.expires_at = expires_at
+        self.sms_seen = sms_seen
+        # Bumped on every reschedule; heap entries with an older version are stale
+        self.version = 0
+
+
+class RentalScheduler:
+    """
+    Drives every active rental from one timer heap instead of a task per rental.
+
+    Each rental has one live heap entry: its next SMS check, or its expiry if that
+    comes first. A single loop sleeps until the earliest entry is due, pops every
+    due entry and handles them with bounded concurrency, so an event costs
+    O(log n) and idle rentals cost nothing but their heap slot. Rescheduling
+    (e.g. after an extension) pushes a new entry and bumps the rental's version;
+    stale entries are skipped when they surface. Expiry times and the number of
+    SMS already forwarded live in rental_history, so restore() rebuilds the heap
+    after a restart. New SMS and expiry notices are sent through the outbox.
+    """
+    def __init__(self, api: SmsActivateClient, db: Database, outbox: Outbox):
+        self.api = api
+        self.db = db
+        self.outbox = outbox
+        self.rentals = {}
+        self._heap = []
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def add(self, rent_id: int, chat_id: int, phone: str, expires_at: float, sms_seen: int = 0):
+        """Starts tracking a rental; expires_at is Unix time."""
+        rental = self.rentals[rent_id] = Rental(rent_id, chat_id, phone, expires_at, sms_seen)
+        self._schedule(rental, self._next_event(rental, time.time()))
+
+    def restore(self, rentals):
+        """
+        Resumes the rentals of a previous process, given as
+        (rent_id, chat_id, expires_at, sms_seen, phone). Their first checks are
+        spread over one poll interval instead of all running at once.
+        """
+        now = time.time()
+        for i, (rent_id, chat_id, expires_at, sms_seen, phone) in enumerate(rentals):
+            rental = self.rentals[rent_id] = Rental(rent_id, chat_id, phone, expires_at, sms_seen or 0)
+            self._heap.append((min(rental.expires_at, now + RENT_POLL_INTERVAL * i / len(rentals)), rent_id, 0))
+        heapq.heapify(self._heap)
+        if rentals:
+            logging.info(f"Восстановлено активных аренд: {len(rentals)}")
+        self._wakeup.set()
+
+    def extend(self, rent_id: int, expires_at: float):
+        rental = self.rentals.get(rent_id)
+        if rental is not None:
+            rental.expires_at = expires_at
+            self._schedule(rental, self._next_event(rental, time.time()))
+
+    def remove(self, rent_id: int):
+        # Its heap entries become stale and are dropped when they come up
+        self.rentals.pop(rent_id, None)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    # --- Scheduling ---
+
+    @staticmethod
+    def _next_event(rental: Rental, now: float) -> float:
+        return min(now + RENT_POLL_INTERVAL, rental.expires_at)
+
+    def _schedule(self, rental: Rental, at: float):
+        rental.version += 1
+        heapq.heappush(self._heap, (at, rental.rent_id, rental.version))
+        if self._heap[0][1] == rental.rent_id:
+            self._wakeup.set()
+
+    def _pop_due(self, now: float) -> list:
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            _, rent_id, version = heapq.heappop(self._heap)
+            rental = self.rentals.get(rent_id)
+            if rental is not None and rental.version == version:
+                due.append(rental)
+        return due
+
+    async def _run(self):
+        semaphore = asyncio.Semaphore(RENT_CHECK_CONCURRENCY)
+
+        async def process(rental):
+            async with semaphore:
+                await self._process(rental)
+
+        while True:
+            due = self._pop_due(time.time())
+            if due:
+                await asyncio.gather(*(process(rental) for rental in due))
+                continue
+
+            self._wakeup.clear()
+            delay = self._heap[0][0] - time.time() if self._heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _process(self, rental: Rental):
+        try:
+            # A last check first, so SMS that came just before the expiry are not lost
+            closed = await self._check(rental)
+            if not closed and time.time() >= rental.expires_at:
+                await self._expire(rental)
+                closed = True
+        except Exception as e:
+            logging.error(f"Ошибка при проверке аренды (ID: {rental.rent_id}): {e}")
+            # Retry after the poll interval, even if the rental is past its expiry
+            if rental.rent_id in self.rentals:
+                self._schedule(rental, time.time() + RENT_POLL_INTERVAL)
+            return
+        if not closed and rental.rent_id in self.rentals:
+            self._schedule(rental, self._next_event(rental, time.time()))
+
+    async def _check(self, rental: Rental) -> bool:
+        """Forwards the rental's new SMS. Returns True if the rental turned out to be closed upstream."""
+        response = await self.api.get_rent_status(rental.rent_id)
+        if isinstance(response, dict) and response.get('error') in RENT_CLOSED_ERRORS:
+            if time.time() >= rental.expires_at:
+                await self._expire(rental)
+            else:
+                await self._close(rental, 'finished', f"Аренда номера `{rental.phone}` завершена.")
+            return True
+        messages = rent_messages(response)
+        if messages is None:
+            logging.warning(f"Не удалось получить СМС аренды (ID: {rental.rent_id}): {response}")
+            return False
+        if len(messages) <= rental.sms_seen:
+            return False
+
+        jobs = [
+            notify_job(rental.chat_id,
+                       f"📩 **СМС на номер** `{rental.phone}`\nОт: {m.get('phoneFrom', '—')}\n\n{m.get('text', '')}",
+                       f"rent:{rental.rent_id}:sms:{i}")
+            for i, m in enumerate(messages[rental.sms_seen:], rental.sms_seen)
+        ]
+        await self.db.record_rental_sms(rental.rent_id, len(messages), jobs, time.time())
+        rental.sms_seen = len(messages)
+        self.outbox.wake()
+        return False
+
+    async def _expire(self, rental: Rental):
+        await self._close(rental, 'expired', f"⌛ Срок аренды номера `{rental.phone}` истек.")
+
+    async def _close(self, rental: Rental, status: str, text: str):
+        jobs = [notify_job(rental.chat_id, text, f"rent:{rental.rent_id}:{status}")]
+        await self.db.finish_rental(rental.rent_id, status, jobs, time.time())
+        self.remove(rental.rent_id)
+        self.outbox.wake()
@@ -0,0 +1,187 @@
+import logging
+import random
+import time
+from collections import deque
+from bot.api import Provider, DEFAULT_PROVIDER
+from bot.metrics import Counter
+
+# Finished activations remembered per (provider, country, service) route.
+STATS_WINDOW = 50
+# Pseudo-observations blended into every route's statistics, so untried routes get
+# a fair chance and a single slow activation doesn't write a provider off.
+PRIOR_WEIGHT = 3
+PRIOR_SUCCESS_RATE = 0.8
+PRIOR_TIME_TO_SMS = 60
+# What a failed activation costs the user (in seconds): the whole wait before giving up.
+FAILURE_COST = 600
+# Every route gets this many purchases before it is judged by its statistics.
+WARMUP_PURCHASES = 5
+# Share of purchases sent to a random provider, so routes that once looked worse are re-measured.
+EXPLORE_RATE = 0.05
+# A route that answered "no numbers" is tried last for this long (in seconds).
+SOLD_OUT_COOLDOWN = 30
+# A provider whose get_number failed for any other reason is tried last for this long.
+PROVIDER_COOLDOWN = 60
+
+# get_number errors that concern only the requested country and service.
+SOLD_OUT_ERRORS = {'NO_NUMBERS', 'BAD_SERVICE', 'WRONG_OPERATOR', 'OPERATORS_NOT_FOUND', 'WHATSAPP_NOT_AVAILABLE'}
+# get_number errors meaning the provider refused outright, so no number was sold.
+# Any other error (a timeout, a dropped connection) may hide a number that was
+# sold, so the purchase stops there instead of buying a second one elsewhere.
+REFUSED_ERRORS = {'BAD_KEY', 'NO_KEY', 'NO_BALANCE', 'BANNED', 'ACCOUNT_INACTIVE'}
+
+PROVIDER_NUMBERS = Counter('provider_numbers_total', "get_number calls, by provider and result.",
+                           labels=('provider', 'result'))
+
+
+class RouteStats:
+    """Rolling time-to-SMS and success statistics of one (provider, country, service) route."""
+    __slots__ = ('outcomes', 'successes', 'total_time', 'purchases', 'sold_out_until')
+
+    def __init__(self):
+        self.outcomes = deque()
+        self.successes = 0
+        self.total_time = 0.0
+        self.purchases = 0
+        self.sold_out_until = 0.0
+
+    def add(self, time_to_sms):
+        """Records a finished activation: seconds until the SMS arrived, or None if it never did."""
+        if len(self.outcomes) == STATS_WINDOW:
+            self._count(self.outcomes.popleft(), -1)
+        self.outcomes.append(time_to_sms)
+        self._count(time_to_sms, 1)
+
+    def _count(self, time_to_sms, sign: int):
+        if time_to_sms is not None:
+            self.successes += sign
+            self.total_time += sign * time_to_sms
+
+    @property
+    def success_rate(self) -> float:
+        return (self.successes + PRIOR_WEIGHT * PRIOR_SUCCESS_RATE) / (len(self.outcomes) + PRIOR_WEIGHT)
+
+    @property
+    def mean_time_to_sms(self) -> float:
+        return (self.total_time + PRIOR_WEIGHT * PRIOR_TIME_TO_SMS) / (self.successes + PRIOR_WEIGHT)
+
+    def expected_wait(self) -> float:
+        """Expected seconds until the user has a code, counting each failure as a lost full wait."""
+        rate = self.success_rate
+        return self.mean_time_to_sms + (1 - rate) / rate * FAILURE_COST
+
+
+class ProviderRouter:
+    """
+    Sends each number purchase to the provider expected to deliver the SMS soonest
+    for that country and service, and fails over to the next one when a provider
+    has no numbers or refuses the request. Expected delivery time comes from the rolling
+    statistics the scheduler reports with record_result. New routes get a few
+    purchases first and a small share of traffic is spread at random, so every
+    provider's statistics stay current; providers that just failed are tried
+    last for a while. Activation calls go to the provider that sold the number,
+    looked up with provider(name).
+    """
+    def __init__(self, providers, clock=time.monotonic, seed=None):
+        self.providers = {provider.name: provider for provider in providers}
+        self.clock = clock
+        self.random = random.Random(seed)
+        self.routes = {}
+        self._cooldown_until = {}
+        # provider -> highest activation ID it has issued to this router
+        self._last_issued = {}
+
+    def provider(self, name: str) -> Provider:
+        return self.providers.get(name)
+
+    def route(self, provider: str, country, service: str) -> RouteStats:
+        key = (provider, str(country), service)
+        stats = self.routes.get(key)
+        if stats is None:
+            stats = self.routes[key] = RouteStats()
+        return stats
+
+    def rank(self, country, service: str) -> list:
+        """Returns the provider names for a purchase, best first; recently failing ones go last."""
+        now = self.clock()
+
+        def key(name):
+            stats = self.route(name, country, service)
+            cooling = stats.sold_out_until > now or self._cooldown_until.get(name, 0) > now
+            return cooling, stats.purchases >= WARMUP_PURCHASES, stats.expected_wait()
+
+        keys = {name: key(name) for name in self.providers}
+        ranked = sorted(self.providers, key=keys.get)
+        available = [name for name in ranked if not keys[name][0]]
+        if len(available) > 1 and self.random.random() < EXPLORE_RATE:
+            explored = self.random.choice(available)
+            ranked.remove(explored)
+            ranked.insert(0, explored)
+        return ranked
+
+    async def get_number(self, service: str, country: int, max_cost: float = None):
+        """
+        Buys a number from the best provider that has one.
+        Returns the provider's response with a 'provider' key added, or the last error.
+        An error after which the provider may still have sold a number also carries
+        'provider', 'uncertain': True and 'after_id', the highest activation ID that
+        provider had issued before the call (None if unknown), so the caller can
+        reconcile it.
+
+        max_cost is the price the user was quoted, which is SMS-Activate's; other
+        providers are only used if their own price is not above it.
+        """
+        response = {'error': 'NO_NUMBERS'}
+        for name in self.rank(country, service):
+            if max_cost is not None and name != DEFAULT_PROVIDER:
+                cost = await self._get_cost(name, service, country)
+                if cost is None or cost > max_cost:
+                    PROVIDER_NUMBERS.labels(name, 'too_expensive').inc()
+                    continue
+            after_id = self._last_issued.get(name)
+            response = await self.providers[name].get_number(service, country)
+            if isinstance(response, dict) and 'activation_id' in response:
+                PROVIDER_NUMBERS.labels(name, 'ok').inc()
+                self._last_issued[name] = max(int(response['activation_id']), self._last_issued.get(name, 0))
+                self.route(name, country, service).purchases += 1
+                return dict(response, provider=name)
+
+            error = response.get('error') if isinstance(response, dict) else response
+            if error in SOLD_OUT_ERRORS:
+                PROVIDER_NUMBERS.labels(name, 'sold_out').inc()
+                self.route(name, country, service).sold_out_until = self.clock() + SOLD_OUT_COOLDOWN
+            elif error in REFUSED_ERRORS:
+                PROVIDER_NUMBERS.labels(name, 'error').inc()
+                self._cooldown_until[name] = self.clock() + PROVIDER_COOLDOWN
+                logging.warning(f"Провайдер {name} не выдал номер ({service}, {country}): {error}")
+            else:
+                PROVIDER_NUMBERS.labels(name, 'uncertain').inc()
+                self._cooldown_until[name] = self.clock() + PROVIDER_COOLDOWN
+                logging.error(f"Провайдер {name} не ответил на покупку номера ({service}, {country}): {error}")
+                return dict(response if isinstance(response, dict) else {'error': error},
+                            provider=name, uncertain=True, after_id=after_id)
+        return response
+
+    async def _get_cost(self, name: str, service: str, country: int):
+        """The provider's current price of a number, or None if it cannot be told."""
+        try:
+            response = await self.providers[name].get_prices(country=country, service=service)
+            return float(response[str(country)][service]['cost'])
+        except Exception as e:
+            logging.warning(f"Не удалось узнать цену у провайдера {name} ({service}, {country}): {e}")
+            return None
+
+    def record_result(self, provider: str, country, service: str, time_to_sms):
+        """Feeds a finished activation into the statistics: time_to_sms is None if no SMS came."""
+        self.route(provider, country, service).add(time_to_sms)
+
+    def get_stats(self, limit: int = None) -> list:
+        """Returns (provider, country, service, activations, success_rate, mean_time_to_sms) of the busiest routes."""
+        rows = [(provider, country, service, len(stats.outcomes), stats.success_rate, stats.mean_time_to_sms)
+                for (provider, country, service), stats in self.routes.items() if stats.outcomes]
+        rows.sort(key=lambda row: row[3], reverse=True)
+        return rows[:limit] if limit is not None else rows
+
+    async def close(self):
+        for provider in self.providers.values():
+            await provider.close()
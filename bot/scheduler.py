@@ -0,0 +1,254 @@
+import asyncio
+import logging
+import time
+from bot.api import DEFAULT_PROVIDER
+from bot.db import Database
+from bot.outbox import Outbox, set_status_job, notify_job, order_update_job
+from bot.router import ProviderRouter
+
+# How long we wait for an SMS before giving up on an activation (10 minutes).
+ACTIVATION_TIMEOUT = 600
+# Adaptive polling: young activations are checked often, old ones less so.
+# Each entry is (max_age_seconds, interval_seconds); None means "any age".
+POLL_SCHEDULE = ((60, 5), (180, 10), (None, 20))
+# Upper bound on parallel getStatus calls when the bulk call is unavailable.
+FALLBACK_CONCURRENCY = 10
+
+
+def poll_interval(age: float) -> int:
+    """Returns how long to wait before re-checking an activation of the given age."""
+    for max_age, interval in POLL_SCHEDULE:
+        if max_age is None or age < max_age:
+            return interval
+
+
+class PendingActivation:
+    """An activation that is still waiting for an SMS, with the hold that pays for it."""
+    __slots__ = ('activation_id', 'chat_id', 'hold_id', 'provider', 'service', 'country', 'message_id',
+                 'created_at', 'next_check_at')
+
+    def __init__(self, activation_id: int, chat_id: int, hold_id: int, provider: str = DEFAULT_PROVIDER,
+                 service: str = None, country=None, message_id: int = None, age: float = 0.0):
+        self.activation_id = activation_id
+        self.chat_id = chat_id
+        self.hold_id = hold_id
+        self.provider = provider
+        self.service = service
+        self.country = country
+        # Set for the numbers of a bulk order, which share one status message
+        self.message_id = message_id
+        self.created_at = time.monotonic() - age
+        self.next_check_at = self.created_at + poll_interval(age)
+
+    @property
+    def key(self):
+        # Activation IDs are only unique within one provider
+        return self.provider, self.activation_id
+
+
+class ActivationScheduler:
+    """
+    Owns every pending activation and polls their statuses in batched sweeps.
+    A sweep asks each provider for all its active activations in a single request and
+    only falls back to per-activation getStatus calls (with bounded concurrency)
+    when the bulk call fails or does not mention an activation.
+    The activation's hold is captured when the SMS arrives and released when
+    the activation is cancelled or times out; the setStatus call and the message
+    to the user are enqueued in the outbox in the same transaction, and the
+    outcome is fed into the router's delivery statistics.
+    """
+    def __init__(self, router: ProviderRouter, db: Database, outbox: Outbox):
+        self.router = router
+        self.db = db
+        self.outbox = outbox
+        self.pending = {}
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def add(self, activation_id: int, chat_id: int, hold_id: int, provider: str = DEFAULT_PROVIDER,
+            service: str = None, country=None, message_id: int = None):
+        """
+        Starts tracking an activation; the result will be sent to chat_id, or shown
+        in the order status message message_id for a number of a bulk order.
+        """
+        activation = PendingActivation(activation_id, chat_id, hold_id, provider, service, country, message_id)
+        self.pending[activation.key] = activation
+        self._wakeup.set()
+
+    def restore(self, purchases):
+        """
+        Resumes the activations a previous process was waiting for, given as
+        (activation_id, chat_id, hold_id, age_seconds, provider, service, country, message_id).
+        They are all checked in the first sweep, which asks each provider about
+        them in a single request.
+        """
+        now = time.monotonic()
+        for activation_id, chat_id, hold_id, age, provider, service, country, message_id in purchases:
+            activation = PendingActivation(activation_id, chat_id, hold_id, provider or DEFAULT_PROVIDER,
+                                           service, country, message_id, age)
+            activation.next_check_at = now
+            self.pending[activation.key] = activation
+        if purchases:
+            logging.info(f"Восстановлено ожидающих активаций: {len(purchases)}")
+        self._wakeup.set()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            now = time.monotonic()
+            if self.pending:
+                delay = min(a.next_check_at for a in self.pending.values()) - now
+            else:
+                delay = None
+
+            if delay is None or delay > 0:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            try:
+                await self._sweep()
+            except Exception as e:
+                logging.error(f"Ошибка при проверке активаций: {e}")
+                await asyncio.sleep(1)
+
+    async def _sweep(self):
+        """Checks every activation that is due in one batch."""
+        now = time.monotonic()
+        due = [a for a in self.pending.values() if a.next_check_at <= now]
+        if not due:
+            return
+
+        statuses = await self._fetch_statuses(due)
+        for activation in due:
+            status_res = statuses.get(activation.key)
+            try:
+                finished = await self._handle_status(activation, status_res)
+            except Exception as e:
+                logging.error(f"Ошибка при обработке статуса (ID: {activation.activation_id}): {e}")
+                finished = False
+
+            if finished:
+                self.pending.pop(activation.key, None)
+                continue
+
+            age = time.monotonic() - activation.created_at
+            if age >= ACTIVATION_TIMEOUT:
+                try:
+                    await self._expire(activation)
+                    self.pending.pop(activation.key, None)
+                    continue
+                except Exception as e:
+                    logging.error(f"Не удалось завершить активацию (ID: {activation.activation_id}): {e}")
+            activation.next_check_at = time.monotonic() + poll_interval(age)
+
+    async def _fetch_statuses(self, due):
+        """
+        Returns {(provider, activation_id): status_string} for the given activations.
+        Uses one getActiveActivations call per provider and falls back to getStatus
+        only for the activations the bulk responses could not answer.
+        """
+        by_provider = {}
+        for activation in due:
+            by_provider.setdefault(activation.provider, []).append(activation)
+        results = await asyncio.gather(*(self._fetch_provider_statuses(name, activations)
+                                         for name, activations in by_provider.items()))
+        statuses = {}
+        for provider_statuses in results:
+            statuses.update(provider_statuses)
+        return statuses
+
+    async def _fetch_provider_statuses(self, name: str, due):
+        provider = self.router.provider(name)
+        if provider is None:
+            logging.error(f"Провайдер {name} не настроен, активации {[a.activation_id for a in due]} не проверяются")
+            return {}
+
+        statuses = {}
+        response = await provider.get_active_activations()
+        if isinstance(response, dict) and isinstance(response.get('activeActivations'), list):
+            for item in response['activeActivations']:
+                try:
+                    statuses[(name, int(item['activationId']))] = _status_from_active(item)
+                except (KeyError, TypeError, ValueError):
+                    continue
+        elif not (isinstance(response, dict) and response.get('error') == 'NO_ACTIVATIONS'):
+            logging.warning(f"Массовая проверка активаций {name} недоступна: {response}")
+
+        missing = [a.activation_id for a in due if a.key not in statuses]
+        if missing:
+            semaphore = asyncio.Semaphore(FALLBACK_CONCURRENCY)
+
+            async def fetch_one(activation_id):
+                async with semaphore:
+                    statuses[(name, activation_id)] = await provider.get_status(activation_id)
+
+            await asyncio.gather(*(fetch_one(a) for a in missing))
+        return statuses
+
+    async def _handle_status(self, activation: PendingActivation, status_res) -> bool:
+        """Delivers a final status to the user. Returns True if the activation is finished."""
+        if isinstance(status_res, dict) and status_res.get('error') in ('STATUS_CANCEL', 'NO_ACTIVATION'):
+            # The library reports a cancelled activation as an error
+            status_res = "STATUS_CANCEL"
+        if not isinstance(status_res, str):
+            if status_res is not None:
+                logging.error(f"Ошибка при проверке СМС (ID: {activation.activation_id}): {status_res}")
+            return False
+
+        if "STATUS_OK" in status_res:
+            sms_code = status_res.split(':')[1]
+            await self._finish(activation, 'completed', f"✉️ **Получено СМС!**\n\nКод: `{sms_code}`", 6, sms_code)
+            return True
+        elif "STATUS_CANCEL" in status_res:
+            await self._finish(activation, 'cancelled', "❌ Активация была отменена. Средства возвращены.")
+            return True
+        return False
+
+    async def _expire(self, activation: PendingActivation):
+        await self._finish(activation, 'expired', "Ожидание СМС завершено (10 минут). Средства возвращены.", 8)
+
+    async def _finish(self, activation: PendingActivation, status: str, text: str, provider_status: int = None,
+                      sms_code: str = None):
+        """Settles the purchase and enqueues the setStatus call (if any) and the message to the user."""
+        key = f"{activation.provider}:{activation.activation_id}:{status}"
+        if activation.message_id is not None:
+            jobs = [order_update_job(activation.chat_id, activation.message_id, activation.hold_id,
+                                     activation.service, key)]
+        else:
+            jobs = [notify_job(activation.chat_id, text, key)]
+        if provider_status is not None:
+            jobs.append(set_status_job(activation.provider, activation.activation_id, provider_status))
+        if await self.db.finish_activation(activation.provider, activation.activation_id, activation.hold_id,
+                                           status, jobs, time.time(), sms_code):
+            age = time.monotonic() - activation.created_at
+            self.router.record_result(activation.provider, activation.country, activation.service,
+                                      age if status == 'completed' else None)
+        self.outbox.wake()
+
+
+def _status_from_active(item: dict) -> str:
+    """Converts a getActiveActivations entry into a getStatus-style string."""
+    sms_code = item.get('smsCode')
+    if isinstance(sms_code, list):
+        sms_code = sms_code[-1] if sms_code else None
+    if sms_code:
+        return f"STATUS_OK:{sms_code}"
+    if str(item.get('activationStatus')) == '8':
+        return "STATUS_CANCEL"
+    return "STATUS_WAIT_CODE"
@@ -0,0 +1,182 @@
+import logging
+import re
+import time
+from bot.catalog import Catalog, SERVICE_NAME_MAP
+
+# Extra spellings users type for popular services (Cyrillic names, slang).
+SERVICE_ALIASES = {
+    'tg': ["Телеграм", "Телега"], 'wa': ["Ватсап", "Вотсап"], 'vi': ["Вайбер"],
+    'ig': ["Инстаграм", "Инста"], 'fb': ["Фейсбук"], 'go': ["Гугл", "Ютуб", "Gmail"],
+    'vk': ["VK", "VKontakte", "Вк"], 'ok': ["Odnoklassniki"], 'mm': ["Мейл"],
+    'ya': ["Yandex"], 'ds': ["Дискорд"], 'am': ["Амазон"], 'tw': ["Твиттер", "X"],
+    'st': ["Стим"], 'ub': ["Убер"], 'nf': ["Нетфликс"], 'tk': ["Тикток"],
+}
+
+# Minimum share of the query's trigrams a name must contain to count as a fuzzy match.
+TRIGRAM_THRESHOLD = 0.45
+
+CYRILLIC_TO_LATIN = {
+    'а': 'a', 'б': 'b', 'в': 'v', 'г': 'g', 'д': 'd', 'е': 'e', 'ё': 'e', 'ж': 'zh', 'з': 'z',
+    'и': 'i', 'й': 'y', 'к': 'k', 'л': 'l', 'м': 'm', 'н': 'n', 'о': 'o', 'п': 'p', 'р': 'r',
+    'с': 's', 'т': 't', 'у': 'u', 'ф': 'f', 'х': 'h', 'ц': 'ts', 'ч': 'ch', 'ш': 'sh', 'щ': 'sch',
+    'ъ': '', 'ы': 'y', 'ь': '', 'э': 'e', 'ю': 'yu', 'я': 'ya',
+}
+# Latin spellings that sound the same, folded so "vatsap" meets "whatsapp".
+PHONETIC_FOLDS = (('wh', 'v'), ('w', 'v'), ('ph', 'f'), ('kh', 'h'), ('ck', 'k'), ('q', 'k'), ('x', 'ks'))
+_NON_ALNUM = re.compile(r'[^a-z0-9]+')
+_REPEATS = re.compile(r'(.)\1+')
+
+
+def normalize(text: str) -> str:
+    """Lowercases and transliterates text into a folded Latin form used for matching."""
+    text = ''.join(CYRILLIC_TO_LATIN.get(ch, ch) for ch in text.lower())
+    for old, new in PHONETIC_FOLDS:
+        text = text.replace(old, new)
+    text = _NON_ALNUM.sub(' ', text)
+    return _REPEATS.sub(r'\1', text).strip()
+
+
+def trigrams(text: str) -> set:
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class _TrieNode:
+    __slots__ = ('children', 'docs')
+
+    def __init__(self):
+        self.children = {}
+        self.docs = set()
+
+
+class SearchIndex:
+    """
+    A prefix trie plus a trigram index over the names of a fixed set of documents.
+    Every name is normalized (transliterated, phonetically folded), so Latin and
+    Cyrillic spellings of the same word meet. Results are ranked: exact match,
+    then whole-name prefix, then word prefix, then trigram similarity.
+    """
+    def __init__(self):
+        self._keys = []
+        self._names = []
+        self._root = _TrieNode()
+        self._trigrams = {}
+
+    def add(self, key, names):
+        """Indexes a document under all of its names."""
+        doc = len(self._keys)
+        self._keys.append(key)
+        normalized = {n for n in (normalize(str(name)) for name in names) if n}
+        self._names.append(normalized)
+        for name in normalized:
+            words = name.split(' ')
+            for i in range(len(words)):
+                self._insert(' '.join(words[i:]), doc)
+            for gram in trigrams(name):
+                self._trigrams.setdefault(gram, set()).add(doc)
+
+    def _insert(self, text: str, doc: int):
+        node = self._root
+        node.docs.add(doc)
+        for ch in text:
+            node = node.children.setdefault(ch, _TrieNode())
+            node.docs.add(doc)
+
+    def _prefix_docs(self, text: str) -> set:
+        node = self._root
+        for ch in text:
+            node = node.children.get(ch)
+            if node is None:
+                return set()
+        return node.docs
+
+    def search(self, query: str, limit: int = None, allowed=None) -> list:
+        """Returns the keys of matching documents, best match first."""
+        q = normalize(query)
+        if not q:
+            return []
+
+        scores = {}
+        for doc in self._prefix_docs(q):
+            names = self._names[doc]
+            if q in names:
+                scores[doc] = 3.0
+            elif any(name.startswith(q) for name in names):
+                scores[doc] = 2.0
+            else:
+                scores[doc] = 1.5
+
+        query_grams = trigrams(q)
+        counts = {}
+        for gram in query_grams:
+            for doc in self._trigrams.get(gram, ()):
+                counts[doc] = counts.get(doc, 0) + 1
+        for doc, count in counts.items():
+            similarity = count / len(query_grams)
+            if similarity >= TRIGRAM_THRESHOLD and doc not in scores:
+                scores[doc] = similarity
+
+        if allowed is not None:
+            scores = {doc: score for doc, score in scores.items() if self._keys[doc] in allowed}
+        ranked = sorted(scores, key=lambda doc: (-scores[doc], doc))
+        if limit is not None:
+            ranked = ranked[:limit]
+        return [self._keys[doc] for doc in ranked]
+
+    def __len__(self):
+        return len(self._keys)
+
+
+class CatalogSearch:
+    """
+    Keeps country and service search indexes in sync with the catalog.
+    Price-only changes don't affect any searchable name, so the indexes are
+    only rebuilt when the country list or the set of service codes changes.
+    """
+    def __init__(self, catalog: Catalog):
+        self.catalog = catalog
+        self.countries = {}
+        self.country_index = SearchIndex()
+        self.service_index = SearchIndex()
+        self.version = None
+        self._indexed_countries = None
+        self._indexed_codes = None
+        catalog.add_listener(self.rebuild)
+
+    def rebuild(self, version: int = None):
+        """Rebuilds both indexes from whatever the catalog currently holds."""
+        countries = self.catalog.cached_countries()
+        codes = self.catalog.cached_service_codes() | set(SERVICE_NAME_MAP)
+        self.version = self.catalog.version
+        if countries is self._indexed_countries and codes == self._indexed_codes:
+            return
+
+        started = time.perf_counter()
+        country_index = SearchIndex()
+        for country in countries:
+            country_index.add(country.id, [country.rus, country.eng])
+
+        service_index = SearchIndex()
+        for code in sorted(codes):
+            names = [code, SERVICE_NAME_MAP.get(code, code)] + SERVICE_ALIASES.get(code, [])
+            service_index.add(code, names)
+
+        self.countries = {country.id: country for country in countries}
+        self.country_index, self.service_index = country_index, service_index
+        self._indexed_countries, self._indexed_codes = countries, codes
+        logging.info(f"Поисковый индекс перестроен за {(time.perf_counter() - started) * 1000:.1f} мс "
+                     f"({len(country_index)} стран, {len(service_index)} сервисов)")
+
+    def _ensure_current(self):
+        if self.version != self.catalog.version:
+            self.rebuild()
+
+    def search_countries(self, query: str, limit: int = None) -> list:
+        """Returns matching Country records, best match first."""
+        self._ensure_current()
+        return [self.countries[cid] for cid in self.country_index.search(query, limit) if cid in self.countries]
+
+    def search_services(self, query: str, country_prices: dict, limit: int = None) -> list:
+        """Returns matching service codes available in country_prices, best match first."""
+        self._ensure_current()
+        return self.service_index.search(query, limit, allowed=country_prices)
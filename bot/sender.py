@@ -0,0 +1,294 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from collections import deque
+from aiogram import Bot, types
+from aiogram.utils.exceptions import RetryAfter
+
+# Lanes, most urgent first. SMS codes and purchase results must not wait behind menu re-renders.
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+# Mass mailings only use capacity that interactive traffic leaves free.
+PRIORITY_BULK = 3
+PRIORITY_NAMES = {PRIORITY_HIGH: 'high', PRIORITY_NORMAL: 'normal', PRIORITY_LOW: 'low', PRIORITY_BULK: 'bulk'}
+
+# Telegram allows about 30 messages per second overall and about 1 per second per chat.
+GLOBAL_RATE = 30
+GLOBAL_BURST = 30
+CHAT_RATE = 1
+CHAT_BURST = 3
+# Calls in flight at the same time.
+MAX_IN_FLIGHT = 30
+# Per-chat buckets unused for this long are dropped (in seconds).
+IDLE_BUCKET_TTL = 60
+# Kinds of message edit. Only an edit of the same kind replaces a queued one: a
+# caption edit cannot stand in for a queued photo change.
+EDIT_KINDS = ('text', 'caption', 'media')
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        """Seconds until a token is available (0 if one is available now)."""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+
+class _Job:
+    __slots__ = ('priority', 'seq', 'chat_id', 'call', 'futures', 'coalesce_key', 'enqueued_at')
+
+    def __init__(self, priority, seq, chat_id, call, coalesce_key):
+        self.priority = priority
+        self.seq = seq
+        self.chat_id = chat_id
+        self.call = call
+        self.futures = [asyncio.get_running_loop().create_future()]
+        self.coalesce_key = coalesce_key
+        self.enqueued_at = time.monotonic()
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class MessageSender:
+    """
+    A central queue for every outgoing Telegram call.
+
+    Calls are sent in priority order while respecting a global token bucket and
+    one bucket per chat. A RetryAfter from Telegram pauses only the chat it came
+    from, and the call is retried once the pause is over. A newer edit of a
+    message that still has an edit of the same kind queued replaces the queued
+    one, so only the latest state is sent; edits of other kinds are sent in order.
+    """
+    def __init__(self, global_rate: float = GLOBAL_RATE, chat_rate: float = CHAT_RATE):
+        self.chat_rate = chat_rate
+        self.chat_burst = CHAT_BURST
+        self._global = TokenBucket(global_rate, GLOBAL_BURST)
+        self._chats = {}
+        self._paused_until = {}
+        self._queue = []
+        self._pending_edits = {}
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._in_flight = asyncio.Semaphore(MAX_IN_FLIGHT)
+        self._task = None
+        self._dispatched = 0
+        self.stats = {'sent': 0, 'failed': 0, 'retried': 0, 'coalesced': 0}
+        self._latencies = {priority: deque(maxlen=1000) for priority in PRIORITY_NAMES}
+
+    # --- Public API ---
+
+    async def submit(self, chat_id: int, call, priority: int = PRIORITY_NORMAL, coalesce_key=None):
+        """
+        Queues call() (a coroutine function doing one Telegram request) and returns its result.
+        Calls sharing a coalesce_key, (kind, chat_id, message_id) for an edit, replace
+        each other while they wait in the queue.
+        """
+        if coalesce_key is not None:
+            self._raise_queued_edits(coalesce_key, priority)
+        if coalesce_key is not None and coalesce_key in self._pending_edits:
+            job = self._pending_edits[coalesce_key]
+            job.call = call
+            future = asyncio.get_running_loop().create_future()
+            job.futures.append(future)
+            self.stats['coalesced'] += 1
+            return await future
+
+        job = _Job(priority, next(self._seq), chat_id, call, coalesce_key)
+        if coalesce_key is not None:
+            self._pending_edits[coalesce_key] = job
+        heapq.heappush(self._queue, job)
+        self._wakeup.set()
+        return await job.futures[0]
+
+    async def send_message(self, bot: Bot, chat_id: int, text: str, priority: int = PRIORITY_NORMAL, **kwargs):
+        return await self.submit(chat_id, lambda: bot.send_message(chat_id, text, **kwargs), priority)
+
+    async def answer(self, message: types.Message, text: str, priority: int = PRIORITY_NORMAL, **kwargs):
+        return await self.submit(message.chat.id, lambda: message.answer(text, **kwargs), priority)
+
+    async def answer_photo(self, message: types.Message, photo, priority: int = PRIORITY_NORMAL, **kwargs):
+        return await self.submit(message.chat.id, lambda: message.answer_photo(photo, **kwargs), priority)
+
+    async def edit_text(self, message: types.Message, text: str, priority: int = PRIORITY_LOW, **kwargs):
+        return await self.submit(message.chat.id, lambda: message.edit_text(text, **kwargs), priority,
+                                 coalesce_key=('text', message.chat.id, message.message_id))
+
+    async def edit_message_text(self, bot: Bot, chat_id: int, message_id: int, text: str,
+                                priority: int = PRIORITY_LOW, **kwargs):
+        return await self.submit(chat_id, lambda: bot.edit_message_text(text, chat_id, message_id, **kwargs), priority,
+                                 coalesce_key=('text', chat_id, message_id))
+
+    async def edit_caption(self, message: types.Message, caption: str, priority: int = PRIORITY_LOW, **kwargs):
+        return await self.submit(message.chat.id, lambda: message.edit_caption(caption, **kwargs), priority,
+                                 coalesce_key=('caption', message.chat.id, message.message_id))
+
+    async def edit_media(self, message: types.Message, media, priority: int = PRIORITY_LOW, **kwargs):
+        return await self.submit(message.chat.id, lambda: message.edit_media(media, **kwargs), priority,
+                                 coalesce_key=('media', message.chat.id, message.message_id))
+
+    def set_rate_limits(self, global_rate: float, chat_rate: float, global_burst: float = GLOBAL_BURST,
+                        chat_burst: float = CHAT_BURST):
+        """Replaces the rate limits, e.g. to take Telegram's limits out of a benchmark."""
+        self._global = TokenBucket(global_rate, global_burst)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self._chats.clear()
+
+    def get_stats(self) -> dict:
+        """Queue depth, counters and send latency percentiles (in ms) per lane."""
+        stats = dict(self.stats, queue_depth=len(self._queue), chats_tracked=len(self._chats))
+        for priority, name in PRIORITY_NAMES.items():
+            latencies = sorted(self._latencies[priority])
+            if latencies:
+                stats[f'{name}_p50_ms'] = round(latencies[len(latencies) // 2] * 1000, 1)
+                stats[f'{name}_p95_ms'] = round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000, 1)
+        return stats
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    # --- Scheduling ---
+
+    def _raise_queued_edits(self, coalesce_key, priority: int):
+        # Queued edits of the message go out no later than the new one, so a later
+        # caption is not overwritten by an earlier photo change that it overtook
+        _, chat_id, message_id = coalesce_key
+        raised = False
+        for kind in EDIT_KINDS:
+            job = self._pending_edits.get((kind, chat_id, message_id))
+            if job is not None and priority < job.priority:
+                job.priority = priority
+                raised = True
+        if raised:
+            # Restore heap order after raising the queued jobs' priority
+            heapq.heapify(self._queue)
+
+    def _chat_wait(self, chat_id: int, now: float) -> float:
+        paused = self._paused_until.get(chat_id, 0) - now
+        if paused > 0:
+            return paused
+        self._paused_until.pop(chat_id, None)
+        bucket = self._chats.get(chat_id)
+        return bucket.wait_time(now) if bucket else 0.0
+
+    def _next_job(self, now: float):
+        """Pops the most urgent job whose chat may send now; returns (job, seconds_to_wait)."""
+        skipped = []
+        job, wait = None, None
+        while self._queue:
+            candidate = heapq.heappop(self._queue)
+            chat_wait = self._chat_wait(candidate.chat_id, now)
+            if chat_wait <= 0:
+                job = candidate
+                break
+            skipped.append(candidate)
+            wait = chat_wait if wait is None else min(wait, chat_wait)
+        for candidate in skipped:
+            heapq.heappush(self._queue, candidate)
+        return job, wait
+
+    async def _run(self):
+        while True:
+            now = time.monotonic()
+            job, wait = self._next_job(now)
+            if job is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            if all(future.done() for future in job.futures):
+                # Every caller has given up on this call (e.g. a cancelled broadcast)
+                if job.coalesce_key is not None:
+                    self._pending_edits.pop(job.coalesce_key, None)
+                continue
+
+            global_wait = self._global.wait_time(now)
+            if global_wait > 0:
+                heapq.heappush(self._queue, job)
+                await asyncio.sleep(global_wait)
+                continue
+
+            self._global.take(now)
+            bucket = self._chats.get(job.chat_id)
+            if bucket is None:
+                bucket = self._chats[job.chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+            bucket.take(now)
+            if job.coalesce_key is not None:
+                self._pending_edits.pop(job.coalesce_key, None)
+
+            await self._in_flight.acquire()
+            asyncio.create_task(self._execute(job))
+            self._dispatched += 1
+            if self._dispatched % 1000 == 0:
+                self._evict_idle_buckets(now)
+
+    async def _execute(self, job: _Job):
+        try:
+            result = await job.call()
+        except RetryAfter as e:
+            self.stats['retried'] += 1
+            logging.warning(f"Flood control для чата {job.chat_id}: пауза {e.timeout} с")
+            self._paused_until[job.chat_id] = time.monotonic() + e.timeout
+            if job.coalesce_key is not None and job.coalesce_key in self._pending_edits:
+                # A newer edit is already queued; this one is obsolete
+                newer = self._pending_edits[job.coalesce_key]
+                newer.futures.extend(job.futures)
+            else:
+                if job.coalesce_key is not None:
+                    self._pending_edits[job.coalesce_key] = job
+                heapq.heappush(self._queue, job)
+                self._wakeup.set()
+            return
+        except Exception as e:
+            self.stats['failed'] += 1
+            for future in job.futures:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        finally:
+            self._in_flight.release()
+
+        self.stats['sent'] += 1
+        self._latencies[job.priority].append(time.monotonic() - job.enqueued_at)
+        for future in job.futures:
+            if not future.done():
+                future.set_result(result)
+
+    def _evict_idle_buckets(self, now: float):
+        for chat_id in [c for c, b in self._chats.items() if now - b.updated > IDLE_BUCKET_TTL]:
+            del self._chats[chat_id]
+
+
+# The bot-wide sender; started in main.py
+sender = MessageSender()
@@ -0,0 +1,108 @@
+import asyncio
+import logging
+import time
+from aiogram import types
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+# Longest a warm-up stage may take before startup goes on without it (in seconds).
+STAGE_TIMEOUT = 30
+
+
+class StartupFailed(Exception):
+    """Raised when a required warm-up stage fails."""
+
+
+class Stage:
+    __slots__ = ('name', 'func', 'required', 'timeout', 'seconds', 'error')
+
+    def __init__(self, name: str, func, required: bool, timeout: float):
+        self.name = name
+        self.func = func
+        self.required = required
+        self.timeout = timeout
+        self.seconds = None
+        self.error = None
+
+
+class StartupPipeline:
+    """
+    Runs the warm-up stages (caches, database, upstream checks) concurrently
+    before the bot accepts updates, and logs how long each one took.
+
+    A required stage that fails or times out aborts startup. An optional one
+    only logs a warning, and the bot falls back to doing that work lazily.
+    `ready` is set once every stage has finished. `started_at` is the
+    time.monotonic() of process start, so the time to ready and to the first
+    handled update include the imports.
+    """
+    def __init__(self, started_at: float = None, budget: float = None):
+        self.started_at = time.monotonic() if started_at is None else started_at
+        self.budget = budget
+        self.stages = []
+        self.ready = asyncio.Event()
+        self.ready_after = None
+        self.first_update_after = None
+
+    def add(self, name: str, func, required: bool = True, timeout: float = STAGE_TIMEOUT):
+        """Adds a stage; func is an async callable taking no arguments."""
+        self.stages.append(Stage(name, func, required, timeout))
+
+    async def run(self):
+        await asyncio.gather(*(self._run_stage(stage) for stage in self.stages))
+        failed = [stage for stage in self.stages if stage.error is not None and stage.required]
+        if failed:
+            raise StartupFailed(", ".join(f"{stage.name}: {stage.error}" for stage in failed))
+
+        self.ready_after = time.monotonic() - self.started_at
+        self.ready.set()
+        logging.info(f"Бот готов к работе через {self.ready_after * 1000:.0f} мс после запуска "
+                     f"({', '.join(f'{s.name} {s.seconds * 1000:.0f} мс' for s in self.stages)})")
+
+    async def _run_stage(self, stage: Stage):
+        start = time.monotonic()
+        try:
+            await asyncio.wait_for(stage.func(), timeout=stage.timeout)
+        except asyncio.TimeoutError:
+            stage.error = f"не завершен за {stage.timeout} с"
+        except Exception as e:
+            stage.error = str(e) or type(e).__name__
+        stage.seconds = time.monotonic() - start
+
+        if stage.error is None:
+            logging.info(f"Этап запуска «{stage.name}» завершен за {stage.seconds * 1000:.0f} мс")
+        elif stage.required:
+            logging.error(f"Этап запуска «{stage.name}» не выполнен: {stage.error}")
+        else:
+            logging.warning(f"Этап запуска «{stage.name}» пропущен: {stage.error}")
+
+    def first_update_handled(self):
+        """Records the time to the first handled update and warns if it is over budget."""
+        if self.first_update_after is not None:
+            return
+        self.first_update_after = time.monotonic() - self.started_at
+        logging.info(f"Первое обновление обработано через {self.first_update_after:.2f} с после запуска")
+        if self.budget and self.first_update_after > self.budget:
+            logging.warning(f"Холодный старт дольше бюджета: {self.first_update_after:.2f} с > {self.budget} с")
+
+    def get_stats(self) -> dict:
+        return {
+            'ready': self.ready.is_set(),
+            'ready_after_s': round(self.ready_after, 3) if self.ready_after is not None else None,
+            'first_update_after_s': round(self.first_update_after, 3) if self.first_update_after is not None else None,
+            'stages': {stage.name: {'ms': round(stage.seconds * 1000) if stage.seconds is not None else None,
+                                    'error': stage.error}
+                       for stage in self.stages},
+        }
+
+
+class ColdStartMiddleware(BaseMiddleware):
+    """Reports the first handled message or callback query to the pipeline."""
+    def __init__(self, pipeline: StartupPipeline):
+        super().__init__()
+        self.pipeline = pipeline
+
+    async def on_post_process_message(self, message: types.Message, results, data: dict):
+        self.pipeline.first_update_handled()
+
+    async def on_post_process_callback_query(self, callback_query: types.CallbackQuery, results, data: dict):
+        self.pipeline.first_update_handled()
@@ -1,20 +1,108 @@
 # This file manages the user's current state, for features like search.
-# A simple dictionary is used as an in-memory state machine.
+# States live in a pluggable storage and expire after STATE_TTL seconds:
+# - MemoryStateStorage keeps them in this process, bounded in size (LRU eviction);
+#   they are lost on restart.
+# - SQLiteStateStorage keeps them in the database, so several bot processes
+#   share them and they survive a restart.
 # {user_id: {'state': 'searching_country', 'context': {...}} }
 
-USER_STATE = {}
+import time
+from collections import OrderedDict
+from bot.db import Database
 
-def set_user_state(user_id, state, context=None):
+# How long a state stays valid without being used (in seconds).
+STATE_TTL = 15 * 60
+# Maximum number of users whose state is kept in memory.
+MEMORY_STATE_MAX_USERS = 100_000
+# The SQLite storage deletes expired rows once every this many writes.
+SQLITE_PURGE_EVERY = 500
+
+
+class StateStorage:
+    """Interface of a user-state storage."""
+    async def get(self, user_id: int):
+        raise NotImplementedError
+
+    async def set(self, user_id: int, value: dict, ttl: float):
+        raise NotImplementedError
+
+    async def delete(self, user_id: int):
+        raise NotImplementedError
+
+
+class MemoryStateStorage(StateStorage):
+    """
+    In-process storage with per-entry TTL and least-recently-used eviction.
+    States are lost when the process restarts.
+    """
+    def __init__(self, max_size: int = MEMORY_STATE_MAX_USERS):
+        self.max_size = max_size
+        self._states = OrderedDict()  # {user_id: (expires_at, value)}
+
+    async def get(self, user_id: int):
+        entry = self._states.get(user_id)
+        if entry is None:
+            return None
+        if entry[0] <= time.monotonic():
+            del self._states[user_id]
+            return None
+        self._states.move_to_end(user_id)
+        return entry[1]
+
+    async def set(self, user_id: int, value: dict, ttl: float):
+        now = time.monotonic()
+        self._states[user_id] = (now + ttl, value)
+        self._states.move_to_end(user_id)
+        # The least recently used entries sit at the front; drop expired ones and any overflow
+        while self._states:
+            oldest_id, (expires_at, _) = next(iter(self._states.items()))
+            if expires_at > now and len(self._states) <= self.max_size:
+                break
+            del self._states[oldest_id]
+
+    async def delete(self, user_id: int):
+        self._states.pop(user_id, None)
+
+    def __len__(self):
+        return len(self._states)
+
+
+class SQLiteStateStorage(StateStorage):
+    """Database-backed storage shared by every bot process using the same database file."""
+    def __init__(self, db: Database):
+        self.db = db
+        self._writes = 0
+
+    async def get(self, user_id: int):
+        return await self.db.get_user_state(user_id, time.time())
+
+    async def set(self, user_id: int, value: dict, ttl: float):
+        await self.db.set_user_state(user_id, value, time.time() + ttl)
+        self._writes += 1
+        if self._writes % SQLITE_PURGE_EVERY == 0:
+            await self.db.purge_user_states(time.time())
+
+    async def delete(self, user_id: int):
+        await self.db.delete_user_state(user_id)
+
+
+_storage = MemoryStateStorage()
+
+def configure_state_storage(storage: StateStorage):
+    """Replaces the storage used by the functions below."""
+    global _storage
+    _storage = storage
+
+async def set_user_state(user_id, state, context=None):
     """Sets the state for a given user."""
     if context is None:
         context = {}
-    USER_STATE[user_id] = {'state': state, 'context': context}
+    await _storage.set(user_id, {'state': state, 'context': context}, STATE_TTL)
 
-def get_user_state(user_id):
+async def get_user_state(user_id):
     """Gets the state for a given user."""
-    return USER_STATE.get(user_id)
+    return await _storage.get(user_id)
 
-def clear_user_state(user_id):
+async def clear_user_state(user_id):
     """Clears the state for a given user."""
-    if user_id in USER_STATE:
-        del USER_STATE[user_id]
+    await _storage.delete(user_id)
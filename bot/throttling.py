@@ -0,0 +1,124 @@
+# Per-user rate limits, so one user tapping "Вперед ➡️" or typing searches as
+# fast as they can cannot burn the provider's quota or the bot's Telegram
+# rate limit for everyone else. Buckets live in memory: in multi-process mode
+# every user's updates reach the same worker, so its buckets see all of them.
+
+import time
+from aiogram import types
+from aiogram.dispatcher.handler import CancelHandler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from bot import callbacks
+from bot.metrics import THROTTLED
+from bot.sender import sender, TokenBucket
+
+NAVIGATION = 'navigation'
+SEARCH = 'search'
+PURCHASE = 'purchase'
+ADMIN = 'admin'
+# (requests per second, burst) for each group; a rate of 0 turns the limit off.
+DEFAULT_LIMITS = {
+    NAVIGATION: (2, 8),
+    SEARCH: (1, 3),
+    PURCHASE: (0.5, 3),
+    ADMIN: (10, 20),
+}
+# Buttons outside the navigation group, by action tag. Closing a rental stays in
+# navigation: it must not be blocked while another purchase runs.
+ACTION_GROUPS = {
+    callbacks.SEARCH_COUNTRY.tag: SEARCH,
+    callbacks.SEARCH_SERVICE.tag: SEARCH,
+    callbacks.BUY_SERVICE.tag: PURCHASE,
+    callbacks.BUY_MANY.tag: PURCHASE,
+    callbacks.RENT_SERVICE.tag: PURCHASE,
+    callbacks.RENT_EXTEND_TIME.tag: PURCHASE,
+}
+NAVIGATION_COMMANDS = {'start', 'balance', 'service_balance'}
+# Full buckets are dropped after this many checks.
+EVICT_EVERY = 1000
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """
+    Applies a token bucket per user and handler group (navigation, search,
+    purchase, admin) before a message or button is handled. A button pressed
+    too fast is answered with a short notice instead of being handled; a
+    message gets the notice once until the user slows down. A user also
+    cannot start a purchase while their previous one is still running.
+
+    Limits are given as {group: (rate, burst)} and override DEFAULT_LIMITS.
+    Messages of admin_id go to the admin group.
+    """
+    def __init__(self, limits: dict = None, admin_id: int = None):
+        super().__init__()
+        self.limits = dict(DEFAULT_LIMITS, **(limits or {}))
+        self.admin_id = admin_id
+        # group -> {user ID: bucket}
+        self._buckets = {group: {} for group in self.limits}
+        # group -> users already told to slow down
+        self._warned = {group: set() for group in self.limits}
+        self._purchasing = set()
+        self._checks = 0
+
+    async def on_process_callback_query(self, callback_query: types.CallbackQuery, data: dict):
+        user_id = callback_query.from_user.id
+        group = ACTION_GROUPS.get((callback_query.data or '').partition(callbacks.SEPARATOR)[0], NAVIGATION)
+        if group == PURCHASE and user_id in self._purchasing:
+            THROTTLED.labels(group).inc()
+            await callback_query.answer("⏳ Предыдущая покупка еще выполняется.")
+            raise CancelHandler()
+        if not self._allow(user_id, group):
+            await callback_query.answer("Слишком быстро! Подождите секунду.")
+            raise CancelHandler()
+        if group == PURCHASE:
+            self._purchasing.add(user_id)
+            data['throttling_purchase'] = user_id
+
+    async def on_post_process_callback_query(self, callback_query: types.CallbackQuery, results, data: dict):
+        user_id = data.get('throttling_purchase')
+        if user_id is not None:
+            self._purchasing.discard(user_id)
+
+    async def on_process_message(self, message: types.Message, data: dict):
+        user_id = message.from_user.id
+        if user_id == self.admin_id:
+            group = ADMIN
+        elif message.is_command() and message.get_command(pure=True) in NAVIGATION_COMMANDS:
+            group = NAVIGATION
+        else:
+            group = SEARCH
+        if not self._allow(user_id, group):
+            if user_id not in self._warned[group]:
+                self._warned[group].add(user_id)
+                await sender.answer(message, "Слишком много запросов. Подождите немного и повторите.")
+            raise CancelHandler()
+
+    def get_stats(self) -> dict:
+        return {'users_tracked': sum(len(buckets) for buckets in self._buckets.values()),
+                'purchases_in_flight': len(self._purchasing)}
+
+    def _allow(self, user_id: int, group: str) -> bool:
+        rate, burst = self.limits[group]
+        if not rate:
+            return True
+        now = time.monotonic()
+        self._checks += 1
+        if self._checks % EVICT_EVERY == 0:
+            self._evict_full_buckets(now)
+
+        buckets = self._buckets[group]
+        bucket = buckets.get(user_id)
+        if bucket is None:
+            bucket = buckets[user_id] = TokenBucket(rate, burst)
+        if bucket.wait_time(now) > 0:
+            THROTTLED.labels(group).inc()
+            return False
+        bucket.take(now)
+        self._warned[group].discard(user_id)
+        return True
+
+    def _evict_full_buckets(self, now: float):
+        # A bucket that has refilled is the same as a new one
+        for group, buckets in self._buckets.items():
+            for user_id in [u for u, b in buckets.items() if b.tokens + (now - b.updated) * b.rate >= b.capacity]:
+                del buckets[user_id]
+                self._warned[group].discard(user_id)
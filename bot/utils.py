@@ -1,13 +1,17 @@
+from collections import OrderedDict
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
 
-def create_paginated_keyboard(buttons, page, page_size, callback_prefix, columns=2):
+# Maximum number of rendered keyboard pages kept in memory.
+KEYBOARD_CACHE_SIZE = 1024
+
+def create_paginated_keyboard(buttons, page, page_size, page_callback, columns=2):
     """
     Creates a paginated inline keyboard with a variable number of columns.
 
     :param buttons: A list of (text, callback_data) tuples.
     :param page: The current page number (0-indexed).
     :param page_size: The number of items per page.
-    :param callback_prefix: A prefix for the pagination callbacks.
+    :param page_callback: A function returning the callback data that opens a given page.
     :param columns: The number of columns for the buttons.
     :return: An InlineKeyboardMarkup.
     """
@@ -19,11 +23,51 @@ def create_paginated_keyboard(buttons, page, page_size, callback_prefix, columns
 
     nav_buttons = []
     if page > 0:
-        nav_buttons.append(InlineKeyboardButton(text="⬅️ Назад", callback_data=f"{callback_prefix}:{page-1}"))
+        nav_buttons.append(InlineKeyboardButton(text="⬅️ Назад", callback_data=page_callback(page - 1)))
     if end < len(buttons):
-        nav_buttons.append(InlineKeyboardButton(text="Вперед ➡️", callback_data=f"{callback_prefix}:{page+1}"))
+        nav_buttons.append(InlineKeyboardButton(text="Вперед ➡️", callback_data=page_callback(page + 1)))
 
     if nav_buttons:
         keyboard.append(nav_buttons)
 
     return InlineKeyboardMarkup(inline_keyboard=keyboard)
+
+
+class KeyboardCache:
+    """
+    An LRU cache of fully rendered keyboard pages.
+    Keys are (view, country, page, catalog_version) tuples, so a page is built
+    once per catalog version and every later page flip is a dict lookup.
+    Cached keyboards are shared between messages and must not be modified.
+    """
+    def __init__(self, max_size: int = KEYBOARD_CACHE_SIZE):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._pages = OrderedDict()
+
+    def get_or_build(self, key, build) -> InlineKeyboardMarkup:
+        """Returns the cached keyboard for key, building it with build() on a miss."""
+        keyboard = self._pages.get(key)
+        if keyboard is not None:
+            self.hits += 1
+            self._pages.move_to_end(key)
+            return keyboard
+
+        self.misses += 1
+        keyboard = self._pages[key] = build()
+        if len(self._pages) > self.max_size:
+            self._pages.popitem(last=False)
+        return keyboard
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def invalidate(self, version: int = None):
+        """Drops every cached page, e.g. when the catalog changes."""
+        self._pages.clear()
+
+    def __len__(self):
+        return len(self._pages)
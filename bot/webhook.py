@@ -0,0 +1,110 @@
+import asyncio
+import logging
+import secrets
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from bot.workers import UpdateConsumer
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+class WebhookServer:
+    """
+    Receives updates from Telegram over HTTP.
+
+    Each request is checked against the secret token, put on a bounded queue and
+    acknowledged right away; an UpdateConsumer feeds the queue to the dispatcher,
+    `workers` updates at once and each user's in order. Without a secret a
+    random one is generated; pass `self.secret` to set_webhook.
+    When the queue is full the server answers 503 so Telegram retries the update
+    later instead of it being lost. On shutdown the server stops accepting
+    updates and drains the ones it has already acknowledged.
+
+    With a pool (bot.workers.WorkerPool) updates are handed to the worker
+    processes instead, and the pool's queues take the place of this one.
+    """
+    def __init__(self, dp: Dispatcher, path: str = '/webhook', secret: str = None,
+                 queue_size: int = 1000, workers: int = 16, pool=None):
+        self.dp = dp
+        self.pool = pool
+        self.path = path
+        # Anyone who finds the URL could otherwise post forged updates
+        self.secret = secret or secrets.token_urlsafe(32)
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.consumer = UpdateConsumer(dp, concurrency=workers)
+        self.stats = {'received': 0, 'rejected': 0}
+        self._accepting = False
+        self._runner = None
+        self._feed_task = None
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post(self.path, self.handle_update)
+        return app
+
+    async def handle_update(self, request: web.Request) -> web.Response:
+        if not secrets.compare_digest(request.headers.get(SECRET_HEADER, ''), self.secret):
+            return web.Response(status=401)
+        if not self._accepting:
+            return web.Response(status=503)
+        try:
+            data = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+
+        if self.pool is not None:
+            if not self.pool.submit(data):
+                self.stats['rejected'] += 1
+                return web.Response(status=503)
+        else:
+            try:
+                self.queue.put_nowait(data)
+            except asyncio.QueueFull:
+                self.stats['rejected'] += 1
+                return web.Response(status=503)
+        self.stats['received'] += 1
+        return web.Response()
+
+    def get_stats(self) -> dict:
+        return dict(self.stats, **self.consumer.stats)
+
+    async def _feed(self):
+        Bot.set_current(self.dp.bot)
+        Dispatcher.set_current(self.dp)
+        while True:
+            data = await self.queue.get()
+            try:
+                await self.consumer.submit(data)
+            finally:
+                self.queue.task_done()
+
+    async def start(self, host: str, port: int, app: web.Application = None):
+        """Starts feeding the dispatcher and the HTTP server. A prepared app may be passed to share the server."""
+        if self.pool is None:
+            self._feed_task = asyncio.create_task(self._feed())
+        if app is None:
+            app = self.app()
+        else:
+            app.router.add_post(self.path, self.handle_update)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        self._accepting = True
+        logging.info(f"Вебхук слушает {host}:{port}{self.path}")
+
+    async def stop(self, drain_timeout: float = 30):
+        """Stops accepting updates and waits for queued ones to finish."""
+        self._accepting = False
+        try:
+            await asyncio.wait_for(self._drain(), timeout=drain_timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f"Не все обновления обработаны при остановке: {self.queue.qsize()} в очереди")
+        if self._feed_task is not None:
+            self._feed_task.cancel()
+            await asyncio.gather(self._feed_task, return_exceptions=True)
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    async def _drain(self):
+        await self.queue.join()
+        await self.consumer.join()
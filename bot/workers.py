@@ -0,0 +1,228 @@
+# Multi-process mode: a front process receives updates (webhook or long
+# polling) and hands each one to the worker process that owns its user.
+# Workers run the whole bot and share state through the database, so any of
+# them can serve any user after a restart; sharding only keeps one user's
+# updates in one process, in order.
+
+import asyncio
+import logging
+import multiprocessing
+import queue
+import time
+from functools import partial
+from aiogram import Bot, Dispatcher, types
+
+# Updates one worker handles at once (of different users).
+WORKER_CONCURRENCY = 16
+# How often the front checks that its workers are alive (in seconds).
+MONITOR_INTERVAL = 1
+# A worker that crashes again is restarted after 1, 2, 4... seconds, at most
+# RESTART_DELAY_MAX; the delay resets once it has run for HEALTHY_AFTER.
+RESTART_DELAY_MAX = 30
+HEALTHY_AFTER = 60
+# Seconds the front waits between long-polling requests after an error.
+POLL_RETRY_DELAY = 1
+POLL_TIMEOUT = 20
+
+_USER_EVENTS = ('message', 'edited_message', 'callback_query', 'inline_query', 'chosen_inline_result',
+                'shipping_query', 'pre_checkout_query', 'poll_answer', 'my_chat_member', 'chat_member',
+                'chat_join_request')
+_CHAT_EVENTS = ('channel_post', 'edited_channel_post')
+
+
+def update_user_id(update: dict) -> int:
+    """The ID of the user a raw update comes from (of the chat for channel posts), or 0."""
+    for key in _USER_EVENTS:
+        event = update.get(key)
+        if event:
+            user = event.get('from') or event.get('user')
+            if user:
+                return user['id']
+    for key in _CHAT_EVENTS:
+        event = update.get(key)
+        if event:
+            return event['chat']['id']
+    return 0
+
+
+def shard_of(user_id: int, shards: int) -> int:
+    """The index of the worker that handles a user's updates."""
+    return user_id % shards
+
+
+class WorkerPool:
+    """
+    Runs `target(index, count, updates)` in `workers` processes and routes each
+    update to the one that owns its user. Every worker has its own bounded
+    queue: when it is full, submit returns False and the update is left for
+    Telegram to resend. A worker that exits is restarted with a growing delay
+    if it keeps crashing; updates waiting in its queue go to the new process.
+    """
+    def __init__(self, target, workers: int, queue_size: int = 1000):
+        # 'spawn' gives every worker a fresh interpreter: no event loop, threads
+        # or SQLite connections inherited from the front
+        self._context = multiprocessing.get_context('spawn')
+        self.target = target
+        self.workers = workers
+        self.queues = [self._context.Queue(queue_size) for _ in range(workers)]
+        self.processes = [None] * workers
+        self.stats = {'submitted': 0, 'rejected': 0, 'restarts': 0}
+        self._started_at = [0.0] * workers
+        self._crashes = [0] * workers
+        self._restart_at = [None] * workers
+        self._task = None
+
+    def start(self):
+        for index in range(self.workers):
+            self._spawn(index)
+        self._task = asyncio.create_task(self._monitor())
+        logging.info(f"Запущено рабочих процессов: {self.workers}")
+
+    def submit(self, update: dict) -> bool:
+        """Queues a raw update for its user's worker; False if that worker is too far behind."""
+        index = shard_of(update_user_id(update), self.workers)
+        try:
+            self.queues[index].put_nowait(update)
+        except queue.Full:
+            self.stats['rejected'] += 1
+            return False
+        self.stats['submitted'] += 1
+        return True
+
+    async def stop(self, timeout: float = 30):
+        """Asks every worker to finish its queued updates and exit; kills the ones that do not in time."""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await asyncio.get_running_loop().run_in_executor(None, self._join, timeout)
+
+    def get_stats(self) -> dict:
+        return dict(self.stats, alive=sum(1 for p in self.processes if p is not None and p.is_alive()))
+
+    def _spawn(self, index: int):
+        process = self._context.Process(target=self.target, args=(index, self.workers, self.queues[index]),
+                                        name=f"bot-worker-{index}", daemon=True)
+        process.start()
+        self.processes[index] = process
+        self._started_at[index] = time.monotonic()
+
+    async def _monitor(self):
+        while True:
+            await asyncio.sleep(MONITOR_INTERVAL)
+            now = time.monotonic()
+            for index, process in enumerate(self.processes):
+                if process.is_alive():
+                    continue
+                if self._restart_at[index] is None:
+                    if now - self._started_at[index] >= HEALTHY_AFTER:
+                        self._crashes[index] = 0
+                    delay = min(RESTART_DELAY_MAX, 2 ** self._crashes[index] - 1)
+                    self._crashes[index] += 1
+                    self._restart_at[index] = now + delay
+                    logging.error(f"Рабочий процесс {index} завершился с кодом {process.exitcode}, "
+                                  f"перезапуск через {delay} с")
+                if now >= self._restart_at[index]:
+                    self._restart_at[index] = None
+                    self.stats['restarts'] += 1
+                    self._spawn(index)
+
+    def _join(self, timeout: float):
+        deadline = time.monotonic() + timeout
+        for updates in self.queues:
+            try:
+                updates.put(None, timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Full:
+                pass
+        for index, process in enumerate(self.processes):
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                logging.warning(f"Рабочий процесс {index} не завершился вовремя и будет остановлен")
+                process.terminate()
+                process.join()
+
+
+class UpdateConsumer:
+    """
+    Feeds updates to a dispatcher. Updates of different users run
+    concurrently, up to `concurrency` at once; one user's updates run one
+    after another, in the order they were submitted.
+
+    In a worker process `run` takes the updates the front sends over `updates`
+    until it sends None, then finishes the ones already taken. Single-process
+    webhook mode passes no queue and calls `submit` itself.
+    """
+    def __init__(self, dp: Dispatcher, updates=None, concurrency: int = WORKER_CONCURRENCY):
+        self.dp = dp
+        self.updates = updates
+        self.stats = {'processed': 0, 'failed': 0}
+        self._slots = asyncio.Semaphore(concurrency)
+        # user ID -> task of their latest update
+        self._last = {}
+
+    async def run(self):
+        Bot.set_current(self.dp.bot)
+        Dispatcher.set_current(self.dp)
+        loop = asyncio.get_running_loop()
+        while True:
+            update = await loop.run_in_executor(None, self._next_update)
+            if update is None:
+                break
+            await self.submit(update)
+        await self.join()
+
+    async def submit(self, update: dict):
+        """Waits for a free slot, then starts a raw update after its user's previous one."""
+        await self._slots.acquire()
+        user_id = update_user_id(update)
+        task = asyncio.create_task(self._handle(update, self._last.get(user_id)))
+        self._last[user_id] = task
+        task.add_done_callback(partial(self._forget, user_id))
+
+    async def join(self):
+        """Waits for the updates submitted so far."""
+        # Each user's latest task waits for their earlier ones
+        await asyncio.gather(*self._last.values(), return_exceptions=True)
+
+    def _next_update(self):
+        # Also returns None if the front died without saying goodbye
+        parent = multiprocessing.parent_process()
+        while True:
+            try:
+                return self.updates.get(timeout=1)
+            except queue.Empty:
+                if parent is not None and not parent.is_alive():
+                    return None
+
+    async def _handle(self, update: dict, previous: asyncio.Task):
+        try:
+            if previous is not None:
+                await asyncio.wait([previous])
+            await self.dp.process_update(types.Update(**update))
+            self.stats['processed'] += 1
+        except Exception as e:
+            self.stats['failed'] += 1
+            logging.error(f"Ошибка при обработке обновления {update.get('update_id')}: {e}")
+        finally:
+            self._slots.release()
+
+    def _forget(self, user_id: int, task: asyncio.Task):
+        if self._last.get(user_id) is task:
+            del self._last[user_id]
+
+
+async def poll_updates(bot: Bot, pool: WorkerPool):
+    """Long-polls Telegram and hands every update to the pool; runs until cancelled."""
+    offset = None
+    while True:
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=POLL_TIMEOUT)
+        except Exception as e:
+            logging.error(f"Не удалось получить обновления: {e}")
+            await asyncio.sleep(POLL_RETRY_DELAY)
+            continue
+        for update in updates:
+            # A full queue means that worker is behind: wait for it rather than drop the update
+            while not pool.submit(update.to_python()):
+                await asyncio.sleep(0.1)
+            offset = update.update_id + 1
@@ -1,3 +1,4 @@
+import json
 import os
 
 # This file manages the bot's configuration.
@@ -25,6 +26,78 @@ except ImportError:
     SMS_ACTIVATE_API_KEY = os.environ.get("SMS_ACTIVATE_API_KEY")
     ADMIN_ID = os.environ.get("ADMIN_ID")
 
+
+def _optional(name, default=None, cast=None):
+    """
+    Reads an optional setting. `settings.py` wins over environment variables,
+    and the default is used when neither defines it.
+    """
+    try:
+        import settings
+        if hasattr(settings, name):
+            return getattr(settings, name)
+    except ImportError:
+        pass
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return cast(value) if cast else value
+
+
+# --- SMS-Activate client ---
+# The API endpoint can be pointed at a local fake server for testing.
+SMS_ACTIVATE_API_URL = _optional("SMS_ACTIVATE_API_URL", "https://api.sms-activate.org/stubs/handler_api.php")
+# Maximum number of simultaneous requests to SMS-Activate.
+SMS_ACTIVATE_MAX_CONCURRENCY = _optional("SMS_ACTIVATE_MAX_CONCURRENCY", 20, int)
+# Default timeout (in seconds) for a single SMS-Activate request.
+SMS_ACTIVATE_TIMEOUT = _optional("SMS_ACTIVATE_TIMEOUT", 15, float)
+
+# Further providers that speak the SMS-Activate protocol, as a list of
+# {"name": ..., "api_url": ..., "api_key": ...}; purchases are routed between
+# them and SMS-Activate by observed SMS delivery time and success rate.
+EXTRA_PROVIDERS = _optional("EXTRA_PROVIDERS", [], json.loads)
+
+# --- Update ingestion ---
+# "polling" (default) or "webhook".
+RUN_MODE = _optional("RUN_MODE", "polling")
+# Public HTTPS address Telegram sends updates to, e.g. "https://bot.example.com".
+WEBHOOK_HOST = _optional("WEBHOOK_HOST")
+WEBHOOK_PATH = _optional("WEBHOOK_PATH", "/webhook")
+# Telegram sends this secret with every update; requests without it are rejected.
+WEBHOOK_SECRET = _optional("WEBHOOK_SECRET")
+# Local address the webhook server listens on.
+WEBAPP_HOST = _optional("WEBAPP_HOST", "0.0.0.0")
+WEBAPP_PORT = _optional("WEBAPP_PORT", 8080, int)
+# Updates waiting for a worker; when full, Telegram is asked to retry later.
+WEBHOOK_QUEUE_SIZE = _optional("WEBHOOK_QUEUE_SIZE", 1000, int)
+WEBHOOK_WORKERS = _optional("WEBHOOK_WORKERS", 16, int)
+# Worker processes that handle updates, each for its share of the users;
+# this process then only receives updates and hands them out. 0 or 1 handles
+# everything in this process. With workers, WEBHOOK_QUEUE_SIZE and
+# WEBHOOK_WORKERS apply to each of them.
+WORKER_PROCESSES = _optional("WORKER_PROCESSES", 0, int)
+
+# --- Metrics ---
+# Prometheus metrics are served on http://METRICS_HOST:METRICS_PORT/metrics; 0 disables the endpoint.
+METRICS_HOST = _optional("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = _optional("METRICS_PORT", 9090, int)
+
+# --- Startup ---
+# Target time (in seconds) from process start to the first handled update;
+# a slower cold start is logged as a warning.
+STARTUP_BUDGET = _optional("STARTUP_BUDGET", 10, float)
+
+# --- Throttling ---
+# Per-user limits as {group: [requests per second, burst]} for the groups
+# "navigation", "search", "purchase" and "admin"; only the groups given here
+# change, and a rate of 0 turns a group's limit off.
+THROTTLE_LIMITS = _optional("THROTTLE_LIMITS", {}, json.loads)
+
+# --- User state ---
+# "memory" keeps search states in this process; "sqlite" stores them in the
+# database so they survive restarts and are shared by several bot processes.
+STATE_BACKEND = _optional("STATE_BACKEND", "memory")
+
 # --- Image File Paths ---
 # Path to the images that will be used as headers in the bot menus.
 # These files should be in the main project directory.
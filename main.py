@@ -1,10 +1,17 @@
+import time
+# Cold-start timings count from here
+STARTED_AT = time.monotonic()
+
+import asyncio
 import logging
+import signal
 import sys
-from aiogram import Bot, Dispatcher, executor, types
+from aiogram import Bot, Dispatcher, types
 
 # Import config and perform startup check
 try:
-    from config import BOT_TOKEN, ADMIN_ID
+    from config import BOT_TOKEN, ADMIN_ID, IMAGE_MAIN_MENU, IMAGE_PROFILE, IMAGE_COUNTRIES, IMAGE_SERVICES
+    import config
     if not all([BOT_TOKEN, ADMIN_ID]):
         raise ImportError
 except ImportError:
@@ -16,11 +23,26 @@ except ImportError:
     sys.exit("Бот не может быть запущен без полной конфигурации.")
 
 # Import other components
-from bot.api import SmsActivateWrapper
+from bot.api import SmsActivateClient
+from bot.broadcast import Broadcaster
+from bot.catalog import Catalog
 from bot.db import Database
+from bot.media import preload_media
+from bot.metrics import (MetricsMiddleware, LoopLagMonitor, Gauge, instrument, is_api_error, start_metrics_server,
+                         API_LATENCY, API_ERRORS, DB_LATENCY, DB_ERRORS)
+from bot.outbox import Outbox
+from bot.rentals import RentalScheduler
+from bot.router import ProviderRouter
+from bot.scheduler import ActivationScheduler
+from bot.sender import sender, GLOBAL_RATE, CHAT_RATE
+from bot.startup import StartupPipeline, ColdStartMiddleware
+from bot.states import configure_state_storage, SQLiteStateStorage
+from bot.throttling import ThrottlingMiddleware
+from bot.workers import WorkerPool, UpdateConsumer, poll_updates, shard_of
 from bot.handlers.start import register_start_handlers
 from bot.handlers.balance import register_balance_handlers
 from bot.handlers.buy_number import register_buy_handlers
+from bot.handlers.rent import register_rent_handlers
 from bot.handlers.history import register_history_handlers
 from bot.handlers.billing import register_billing_handlers
 from bot.handlers.admin import register_admin_handlers
@@ -35,25 +57,208 @@ dp = Dispatcher(bot)
 
 # Initialize API and DB
 db = Database()
-api = SmsActivateWrapper()
+api = SmsActivateClient()
+providers = [api] + [SmsActivateClient(p['api_key'], p['api_url'], name=p['name']) for p in config.EXTRA_PROVIDERS]
+router = ProviderRouter(providers)
+catalog = Catalog(api, db)
+if config.STATE_BACKEND == 'sqlite':
+    configure_state_storage(SQLiteStateStorage(db))
+outbox = Outbox(router, bot, db)
+scheduler = ActivationScheduler(router, db, outbox)
+rentals = RentalScheduler(api, db, outbox)
+broadcaster = Broadcaster(bot, db, int(ADMIN_ID))
+
+# Metrics
+for provider in providers:
+    instrument(provider, API_LATENCY, API_ERRORS, is_error=is_api_error)
+instrument(db, DB_LATENCY, DB_ERRORS)
+# Before the metrics middleware, so turned-away updates are not timed as handled ones
+dp.middleware.setup(ThrottlingMiddleware(config.THROTTLE_LIMITS, int(ADMIN_ID)))
+dp.middleware.setup(MetricsMiddleware())
+pipeline = StartupPipeline(STARTED_AT, config.STARTUP_BUDGET)
+dp.middleware.setup(ColdStartMiddleware(pipeline))
+loop_lag = LoopLagMonitor()
+metrics_runner = None
+# (index, count) of this process's share of the users when WORKER_PROCESSES
+# workers handle the updates; (0, 1) when this process handles all of them
+shard = (0, 1)
+Gauge('catalog_hit_rate', "Share of catalog lookups served from the cache.", lambda: catalog.get_stats()['hit_rate'])
+Gauge('pending_activations', "Activations waiting for an SMS.", lambda: len(scheduler.pending))
+Gauge('active_rentals', "Rentals tracked by the rental scheduler.", lambda: len(rentals.rentals))
+Gauge('sender_queue_depth', "Outgoing Telegram calls waiting in the queue.", lambda: sender.get_stats()['queue_depth'])
+Gauge('startup_ready_seconds', "Time from process start until the bot was ready for updates.",
+      lambda: pipeline.ready_after or 0)
+Gauge('event_loop_lag_seconds_last', "Event-loop lag at the last sample.", lambda: loop_lag.lag)
 
 def register_all_handlers(dispatcher: Dispatcher):
     """Registers all handlers for the bot."""
     register_start_handlers(dispatcher, db)
     register_balance_handlers(dispatcher, db, api)
-    register_buy_handlers(dispatcher, db, api)
+    register_buy_handlers(dispatcher, db, router, catalog, scheduler)
+    register_rent_handlers(dispatcher, db, api, catalog, rentals)
     register_history_handlers(dispatcher, db)
     register_billing_handlers(dispatcher)
-    register_admin_handlers(dispatcher, db)
-    register_search_handlers(dispatcher)
+    register_admin_handlers(dispatcher, db, catalog, broadcaster, router)
+    register_search_handlers(dispatcher, catalog)
 
     logging.info("Все обработчики успешно зарегистрированы.")
 
 
+def is_own(chat_id: int) -> bool:
+    """Whether this process handles the user's updates (always, unless running as one of several workers)."""
+    index, count = shard
+    return shard_of(chat_id, count) == index
+
+async def restore_activations():
+    scheduler.restore([purchase for purchase in await db.get_active_purchases() if is_own(purchase[1])])
+    rentals.restore([rental for rental in await db.get_active_rentals() if is_own(rental[1])])
+
+async def probe_providers():
+    """Checks that every provider answers; also opens their keep-alive connections."""
+    responses = await asyncio.gather(*(provider.get_balance() for provider in providers), return_exceptions=True)
+    failed = [f"{provider.name}: {response}" for provider, response in zip(providers, responses)
+              if isinstance(response, Exception) or (isinstance(response, dict) and 'error' in response)]
+    if failed:
+        raise Exception("; ".join(failed))
+
+pipeline.add('db', db.warm_up)
+pipeline.add('activations', restore_activations)
+pipeline.add('catalog', catalog.warm_up, required=False)
+pipeline.add('media', lambda: preload_media(bot, db, int(ADMIN_ID),
+                                            [IMAGE_MAIN_MENU, IMAGE_PROFILE, IMAGE_COUNTRIES, IMAGE_SERVICES]),
+             required=False)
+pipeline.add('upstream', probe_providers, required=False)
+
+
 async def on_startup(dispatcher):
+    global metrics_runner
+    index, count = shard
     logging.info("Регистрация обработчиков...")
     register_all_handlers(dispatcher)
+    loop_lag.start()
+    if config.METRICS_PORT:
+        # Worker i serves its own metrics on METRICS_PORT + i
+        metrics_runner = await start_metrics_server(config.METRICS_HOST, config.METRICS_PORT + index,
+                                                    pipeline.ready.is_set)
+    if count > 1:
+        # Telegram's limit is per bot: every worker gets its share
+        sender.set_rate_limits(GLOBAL_RATE / count, CHAT_RATE)
+    sender.start()
+    outbox.start()
+    # Updates are accepted only after this returns: polling and the webhook start afterwards
+    await pipeline.run()
+    scheduler.start()
+    rentals.start()
+    # Only the first worker refreshes the catalog from the provider; the others reload what it stores
+    catalog.start(follow=index > 0)
+    # Broadcasts run where the admin's updates are handled
+    if is_own(int(ADMIN_ID)):
+        await broadcaster.resume()
     logging.info("Запуск бота...")
 
+async def on_shutdown(dispatcher):
+    await scheduler.stop()
+    await rentals.stop()
+    await outbox.stop()
+    await catalog.stop()
+    await broadcaster.stop()
+    await sender.stop()
+    await loop_lag.stop()
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+    await router.close()
+    await db.close()
+
+async def run_webhook():
+    """Runs the bot in webhook mode until SIGINT/SIGTERM, then drains in-flight updates."""
+    from bot.webhook import WebhookServer
+    # Tasks started in on_startup (the sender's) need the current bot, as under executor
+    Bot.set_current(bot)
+    Dispatcher.set_current(dp)
+    await on_startup(dp)
+    server = WebhookServer(dp, path=config.WEBHOOK_PATH, secret=config.WEBHOOK_SECRET,
+                           queue_size=config.WEBHOOK_QUEUE_SIZE, workers=config.WEBHOOK_WORKERS)
+    await server.start(config.WEBAPP_HOST, config.WEBAPP_PORT)
+    await bot.set_webhook(config.WEBHOOK_HOST + config.WEBHOOK_PATH, secret_token=server.secret)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass  # Windows: Ctrl+C raises KeyboardInterrupt instead
+    try:
+        await stop.wait()
+    finally:
+        logging.info("Остановка бота...")
+        await server.stop()
+        await on_shutdown(dp)
+        await (await bot.get_session()).close()
+
+def worker_main(index: int, count: int, updates):
+    """Entry point of a worker process: the whole bot, for the users of its shard."""
+    # Ctrl+C reaches the whole process group; workers stop when the front tells them to
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(run_worker(index, count, updates))
+
+async def run_worker(index: int, count: int, updates):
+    global shard
+    shard = (index, count)
+    Bot.set_current(bot)
+    Dispatcher.set_current(dp)
+    await on_startup(dp)
+    try:
+        await UpdateConsumer(dp, updates, config.WEBHOOK_WORKERS).run()
+    finally:
+        await on_shutdown(dp)
+        await (await bot.get_session()).close()
+
+async def run_front():
+    """
+    Receives updates (webhook or long polling) and hands them to WORKER_PROCESSES
+    worker processes by user until SIGINT/SIGTERM, then lets the workers drain.
+    """
+    pool = WorkerPool(worker_main, config.WORKER_PROCESSES, config.WEBHOOK_QUEUE_SIZE)
+    pool.start()
+    server = polling = None
+    if config.RUN_MODE == 'webhook':
+        from bot.webhook import WebhookServer
+        server = WebhookServer(dp, path=config.WEBHOOK_PATH, secret=config.WEBHOOK_SECRET, pool=pool)
+        await server.start(config.WEBAPP_HOST, config.WEBAPP_PORT)
+        await bot.set_webhook(config.WEBHOOK_HOST + config.WEBHOOK_PATH, secret_token=server.secret)
+    else:
+        await dp.reset_webhook(True)
+        await dp.skip_updates()
+        polling = asyncio.create_task(poll_updates(bot, pool))
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass
+    try:
+        await stop.wait()
+    finally:
+        logging.info("Остановка бота...")
+        if server is not None:
+            await server.stop()
+        if polling is not None:
+            polling.cancel()
+            await asyncio.gather(polling, return_exceptions=True)
+        await pool.stop()
+        await db.close()
+        await (await bot.get_session()).close()
+
 if __name__ == '__main__':
-    executor.start_polling(dp, skip_updates=True, on_startup=on_startup)
+    if config.RUN_MODE == 'webhook' and not config.WEBHOOK_HOST:
+        sys.exit("Для RUN_MODE = 'webhook' нужно указать WEBHOOK_HOST.")
+    if config.WORKER_PROCESSES > 1:
+        asyncio.run(run_front())
+    elif config.RUN_MODE == 'webhook':
+        asyncio.run(run_webhook())
+    else:
+        from aiogram import executor
+        executor.start_polling(dp, skip_updates=True, on_startup=on_startup, on_shutdown=on_shutdown)